@@ -1,21 +1,26 @@
+import copy
 import os
 import shutil
-from glob import glob
+import uuid
 from typing import Any, Dict, List
 import logging
 
-import yaml
 import json
 from dotenv import dotenv_values
 
 from . import connect, modes
+from .artifact import pack
 from .dag import DAG
+from .manifest import Manifest, fingerprints
+from .history import History, RunRecorder
+from .tracing import span, trace
 from .utils.jinja import Environment
-from .utils.paths import ensure_rooting, set_root
+from .utils.paths import ensure_rooting, find_project, sample_path, set_root, sweep_path
+from .utils.state import read_yaml, state_path
 from .utils.awsboto import Secrets, CFN
 
 class Pipeline:
-    def __init__(self,name:str = None, pipeline:str = None, compile_path:str = None, download:str = None, connection:str = None, context:List[Any] = list(),  meta:Dict[str, Any] = None):
+    def __init__(self,name:str = None, pipeline:str = None, compile_path:str = None, download:str = None, connection:str = None, context:List[Any] = list(),  meta:Dict[str, Any] = None, depends_on:List[str] = None):
         """
         Pipeline object that represents a Curie pipeline
         
@@ -27,8 +32,11 @@ class Pipeline:
             connection (str, optional): Connection to use for the pipeline. Defaults to None.
             context (List[Any], optional): Context to use for the pipeline. Defaults to list().
             meta (Dict[str, Any], optional): Meta information about the pipeline. Defaults to None.
+            depends_on (List[str], optional): Pipelines that finish before this one starts when they run together. Defaults to None.
         """
         
+        self.name = name
+        self.depends_on = list(depends_on) if depends_on else []
         self.path = pipeline
         self.compile_path = compile_path
         self.dag = None
@@ -37,6 +45,11 @@ class Pipeline:
         self.context = context
         self.connection = connection
         self.download = download
+        # Set by sample, which points compile_path and download at sample directories
+        self.sampling = None
+        self.paths = (compile_path, download)
+        # Set on the copies a sweep runs, see parameterized
+        self.label = None
 
         self.load(self.path)
 
@@ -49,59 +62,206 @@ class Pipeline:
         """
         if path:
             self.path = path
-        with open(ensure_rooting(self.path), 'r') as f:
-            pipe = yaml.safe_load(f)
-            self.arguments = pipe['arguments']
-            self.dag = DAG(pipe['etl'],defaults=self.arguments)
+        self.definition = read_yaml(ensure_rooting(self.path))
+        self.reset()
+
+    def reset(self):
+        """
+        Rebuilds the DAG from the parsed pipeline file, discarding state left by earlier compiles and runs
+        """
+        self.arguments = copy.deepcopy(self.definition['arguments'])
+        self.dag = DAG(copy.deepcopy(self.definition['etl']),defaults=self.arguments)
+        # Shared by a compile and the execute that follows it, so both land in one trace
+        self.run_id = None
+        return self
+
+    def trace(self, mode:str):
+        """
+        Collects trace spans and tags queries with the current run, starting a run if none is open
+        """
+        if not getattr(self, 'run_id', None):
+            self.run_id = uuid.uuid4().hex
+        return trace(self.run_id, pipeline=self.name, mode=mode, profile=self.connection if self.connection else 'default')
     
+    def sample(self, rows:int = None, pct:float = None, profiles:int = 1):
+        """
+        Compiles and executes on a sample of the data rather than all of it, for fast iteration
+
+        Queries are wrapped to return at most `rows` rows and/or `pct` percent of them. Tables
+        are built in sample schemas (<schema>_sample) and read the samples of the tables they
+        depend on, files are saved to <download>_sample and compiled to <compile_path>_sample.
+        Without rows or pct the pipeline goes back to full runs.
+
+        Args:
+            rows (int, optional): Rows each query returns at most. Defaults to None.
+            pct (float, optional): Percentage of rows each query keeps. Defaults to None.
+            profiles (int, optional): iterate_on variants expand only this many profiles. Defaults to 1.
+        """
+        compile_path, download = self.paths
+        if rows is None and pct is None:
+            self.sampling = None
+            self.compile_path, self.download = compile_path, download
+            return self
+        self.sampling = {'rows': rows, 'pct': pct, 'profiles': profiles}
+        self.compile_path, self.download = sample_path(compile_path), sample_path(download)
+        return self
+
+    def parameterized(self, label:str) -> 'Pipeline':
+        """
+        Returns a copy of the pipeline for one run of a sweep, with its own DAG and manifest,
+        compiling to <compile_path>/<label> and saving to <download>/<label>
+
+        Args:
+            label (str): Name of the run, from its overrides.
+        """
+        run = copy.copy(self)
+        run.label = label
+        run.paths = tuple(sweep_path(path, label) for path in self.paths)
+        run.compile_path, run.download = run.paths
+        run.sampling = None
+        return run.reset()
+
     def clean(self):
         """
         Cleans the compiled DAG
         """
         # Purge the contents of the compile path if it exists
-        # and the download path if it exists
-        if self.compile_path:
-            if os.path.exists(self.compile_path):
-                shutil.rmtree(self.compile_path)
-        if self.download:
-            if os.path.exists(self.download):
-                shutil.rmtree(self.download)
+        # and the download path if it exists, along with their samples
+        for path in self.paths:
+            for directory in [path, sample_path(path)]:
+                if directory and os.path.exists(directory):
+                    shutil.rmtree(directory)
         
-    def execute(self, mode:str,start:str = None, tables:List=None, args:dict = None):
+    def execute(self, mode:str,start:str = None, tables:List=None, args:dict = None, modified:bool = False, workers:int = 1, budget:Any = None):
         """
         Executes the DAG in the specified mode
         
         Args:
             mode (str): Mode to execute the DAG in
             args (dict, optional): Arguments to override the defaults. Defaults to None.
-        """
-        self.dag.execute(mode,start,tables, args, connection=self.context[self.connection], download_dir=self.download)
+            modified (bool, optional): Only run nodes whose definition, or an upstream definition, changed since their last successful run. Sample runs compare with the last live run. Defaults to False.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+            budget (threading.BoundedSemaphore, optional): Slots shared with the other runs of an invocation, see shared_budget. Defaults to None.
+        """
+        manifest = self.manifest(mode) if modified or not self.sampling else None
+        if modified:
+            tables = self.modified_tables(manifest, tables)
+        # A sample run says nothing about the live tables, it selects modified nodes from the manifest
+        # of the live runs but is not recorded in it, and is timed apart from full runs
+        if self.sampling:
+            manifest = None
+        with self.trace(mode):
+            run = self.history().start(self.name, f'{mode}-sample' if self.sampling else mode, self.connection, workers=workers, run_id=self.run_id)
+            self.run_id = None
+            try:
+                with span('execute', workers=workers):
+                    self.dag.execute(mode,start,tables, args, connection=self.context[self.connection], download_dir=self.download, manifest=manifest, history=run, workers=workers, budget=budget)
+            except BaseException as e:
+                run.finish('failed')
+                raise e
+            run.finish('success')
         return self
+
+    def plan(self, mode:str, start:str = None, tables:List = None, modified:bool = False, workers:int = 1) -> str:
+        """
+        Describes the order nodes would start in and the expected makespan from past run durations
+
+        Args:
+            mode (str): Mode to plan
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only plan these nodes. Defaults to None.
+            modified (bool, optional): Only plan nodes that changed since their last successful run. Defaults to False.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+        """
+        if modified:
+            tables = self.modified_tables(self.manifest(mode), tables)
+        run = RunRecorder(self.history(), None, self.name, mode, self.connection if self.connection else 'default')
+        return self.dag.plan(mode, start, tables, history=run, workers=workers)
+
+    def explain(self, mode:str, start:str = None, tables:List = None, workers:int = 4, threshold:float = None) -> str:
+        """
+        Ranks the compiled statements by the cost the database estimates for them
+
+        Args:
+            mode (str): Mode the pipeline was compiled in
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only explain these nodes. Defaults to None.
+            workers (int, optional): EXPLAINs in flight at once. Defaults to 4.
+            threshold (float, optional): Estimated cost that flags a statement. Defaults to None.
+        """
+        with self.trace(mode):
+            return self.dag.explain(mode, self.context[self.connection], start, tables, workers=workers, threshold=threshold)
+
+    def modified_tables(self, manifest:Manifest, tables:List = None) -> List[str]:
+        changed = manifest.modified()
+        candidates = tables if tables is not None else list(manifest.fingerprints.keys())
+        selected = [node for node in candidates if node in changed]
+        print(f'{len(selected)} modified nodes, skipping {len(candidates) - len(selected)} unchanged')
+        return selected
+
+    def history(self) -> History:
+        """
+        Returns the project's run history, shared by every pipeline
+        """
+        if getattr(self, 'run_history', None) is None:
+            self.run_history = History(state_path('history.db'))
+        return self.run_history
+
+    def manifest(self, mode:str) -> Manifest:
+        """
+        Returns the manifest of node fingerprints from the last successful runs in the specified mode
+
+        Args:
+            mode (str): Mode to fingerprint the DAG in
+        """
+        path = state_path('manifest', f'{self.name}.{self.label}.json' if self.label else f'{self.name}.json')
+        return Manifest(path, mode, self.connection, fingerprints(self.dag, mode, self.arguments))
     
-    def compile(self, mode:str, overrides:dict = None):
+    def compile(self, mode:str, overrides:dict = None, full_refresh:bool = False):
         """
         Compiles the DAG in the specified mode
 
         Args:
             mode (str): Mode to compile the DAG in
             overrides (dict, optional): Arguments to override the defaults. Defaults to None.
+            full_refresh (bool, optional): Ignore incremental state and rebuild from scratch. Defaults to False.
         """
         args = self.arguments
         if overrides:
             args.update(overrides)
-        self.dag.compile(mode, compile_path=self.compile_path, overrides=args, connection=self.context[self.connection], download_dir=self.download)
+        with self.trace(mode), span('compile'):
+            self.dag.compile(mode, compile_path=self.compile_path, overrides=args, connection=self.context[self.connection], download_dir=self.download, full_refresh=full_refresh, sample=self.sampling)
+            pack(self.dag, mode, self.plan_path(mode), pipeline=self.name, profile=self.connection, download_dir=self.download)
         return self
 
-    def describe(self, mode:str):
+    def plan_path(self, mode:str) -> str:
+        """
+        Returns where compile writes the packed plan for the specified mode
+        """
+        return ensure_rooting(f'{self.compile_path}/{mode}.plan')
+
+    def describe(self, mode:str, format:str = 'mermaid', collapse:int = None):
         """
         Describes the DAG in the specified mode
 
         Args:
             mode (str): Mode to describe the DAG in
+            format (str, optional): mermaid, dot or json. Defaults to 'mermaid'.
+            collapse (int, optional): Collapse fan in and fan out wider than this into summary nodes. Defaults to None.
         """
 
-        return self.dag.describe(mode)
+        return self.dag.describe(mode, format, collapse)
     
+    def lint_dependencies(self, mode:str, apply:bool = False):
+        """
+        Checks declared dependencies against the tables each compiled node reads
+
+        Args:
+            mode (str): Mode to check
+            apply (bool, optional): Add missing dependencies to the DAG. Defaults to False.
+        """
+        return self.dag.lint_dependencies(mode, apply=apply)
+
     def update_arguments(self, args:dict):
         """
         Updates the arguments for the DAG
@@ -135,19 +295,23 @@ class Pipeline:
 
 class ProjectManager:
     j2 = Environment() # Jinja2 environment for rendering templates
-    def __init__(self,root:str = None, path:str = None, defer_imports:bool = False):
+    def __init__(self,root:str = None, path:str = None, defer_imports:bool = False, connections_only:bool = False):
         """
         ProjectManager object for coordinating pipelines and connections
 
         Args:
             path (str, optional): Path to the project file. Defaults to None.
             defer_imports (bool, optional): Whether to defer imports of the connections. Defaults to False.
+            connections_only (bool, optional): Load the connections but none of the pipelines, e.g. to execute a packed plan. Defaults to False.
         """
         self.root = root
         self.path = path
         self.pipelines = {}
         self.connections = {}
         self.defer_imports = defer_imports
+        self.connections_only = connections_only
+        # Files the project was loaded from, a change to any of them invalidates the loaded project
+        self.sources = []
         set_root(root)
         self.load_pipelines(path)
 
@@ -164,6 +328,7 @@ class ProjectManager:
         """
         try:
             path = ensure_rooting(path)
+            self.sources.append(path)
             env = dotenv_values(path)
             if len(env) == 0:
                 raise Exception("No environment variables found")
@@ -222,19 +387,19 @@ class ProjectManager:
         Args:
             path (str, optional): Path to the connections configuration file. Defaults to None.
         """
-        with open(ensure_rooting(path), 'r') as f:
-            cons = yaml.safe_load(f)
-            for db in cons:
-                for profile in cons[db]:
-                    # > If there are secrets, load them and render the connection string
-                    if 'secrets' in cons[db][profile]:
-                        handler = list(cons[db][profile]['secrets'].keys())[0]
-                        logging.debug(f"Loading secrets for {db} {profile} using {handler}")
-                        secrets = getattr(self, handler)(**cons[db][profile]['secrets'][handler],profile=profile)
-                        for key in cons[db][profile]:
-                            if key != 'secrets':
-                                cons[db][profile][key] = self.j2.from_string(cons[db][profile][key]).render(**secrets)
-                    self.connections[profile] = getattr(connect, db)(**cons[db][profile], defer_import=self.defer_imports)
+        self.sources.append(ensure_rooting(path))
+        cons = read_yaml(ensure_rooting(path))
+        for db in cons:
+            for profile in cons[db]:
+                # > If there are secrets, load them and render the connection string
+                if 'secrets' in cons[db][profile]:
+                    handler = list(cons[db][profile]['secrets'].keys())[0]
+                    logging.debug(f"Loading secrets for {db} {profile} using {handler}")
+                    secrets = getattr(self, handler)(**cons[db][profile]['secrets'][handler],profile=profile)
+                    for key in cons[db][profile]:
+                        if key != 'secrets':
+                            cons[db][profile][key] = self.j2.from_string(cons[db][profile][key]).render(**secrets)
+                self.connections[profile] = getattr(connect, db)(**cons[db][profile], defer_import=self.defer_imports, profile=profile)
 
     def load_pipelines(self, path:str = None):
         """
@@ -245,11 +410,13 @@ class ProjectManager:
         """
         if path:
             self.path = path
-        with open(self.path, 'r') as f:
-            project = yaml.safe_load(f)
-            self.build_connections(project['Project']['Connections'])
-            for pipeline in project['Project']['Pipelines']:
-                self.pipelines[pipeline['name']] = Pipeline(**pipeline, context=self.connections)
+        self.sources.append(os.path.abspath(self.path))
+        project = read_yaml(self.path)
+        self.build_connections(project['Project']['Connections'])
+        if self.connections_only:
+            return None
+        for pipeline in project['Project']['Pipelines']:
+            self.pipelines[pipeline['name']] = Pipeline(**pipeline, context=self.connections)
     
     def clean(self, pipeline:str = 'all'):
         print(pipeline)
@@ -274,11 +441,12 @@ class Curie:
         path (str, optional): Path to the project file. Defaults to None.
         defer_imports (bool, optional): Whether to defer imports of the connections. Defaults to False.
     """
-    def __init__(self,root:str = None, path:str = None, defer_imports:bool = False):
+    def __init__(self,root:str = None, path:str = None, defer_imports:bool = False, connections_only:bool = False):
         self.path = path
         self.root = root
         self.project = None
         self.defer_imports = defer_imports
+        self.connections_only = connections_only
         self.load(root, path)
 
         self.active_pipeline_name = None
@@ -292,18 +460,30 @@ class Curie:
         Args:
             path (str, optional): Path to the project file. Defaults to None.
         """
+        if path is None:
+            path = find_project()
+            # The project lives where its file is, wherever it was found from
+            root = root if root else os.path.dirname(path)
         if root:
             set_root(root)
-        if path is None:
-            globbed = glob('**/project.yaml', recursive=True)
-            if len(globbed) == 0:
-                raise FileNotFoundError('Could not find project.yaml in the current directory or any of its parents.')
-            elif len(globbed) > 1:
-                raise FileNotFoundError('Found more than one project.yaml in the current directory or any of its parents.')
-            else:
-                path = globbed[0]
         self.path = path
-        self.project = ProjectManager(root, path, defer_imports=self.defer_imports)
+        self.project = ProjectManager(root, path, defer_imports=self.defer_imports, connections_only=self.connections_only)
+
+    def fork(self, pipelines:Dict[str, Pipeline] = None):
+        """
+        Returns a Curie sharing this project's pipelines and connections, with no active pipeline
+
+        Args:
+            pipelines (Dict[str, Pipeline], optional): Pipelines the fork uses in place of the project's, by name. Defaults to None.
+        """
+        forked = copy.copy(self)
+        if pipelines:
+            forked.project = copy.copy(self.project)
+            forked.project.pipelines = {**self.project.pipelines, **pipelines}
+        forked.active_pipeline_name = None
+        forked.active_pipeline = None
+        forked.compiled_pipeline = None
+        return forked
 
     def pipeline(self, name:str):
         """
@@ -316,29 +496,73 @@ class Curie:
         self.active_pipeline = self.project.pipelines[name]
         return self
     
-    def execute(self, mode:str, start:str = None,tables:List=None, args:dict = None):
+    def execute(self, mode:str, start:str = None,tables:List=None, args:dict = None, modified:bool = False, workers:int = 1, budget:Any = None):
         """
         Executes the pipeline in the specified mode
 
         Args:
             mode (str): Mode to execute the pipeline in
             args (dict, optional): Arguments to override the defaults. Defaults to None.
+            modified (bool, optional): Only run nodes that changed since their last successful run, and their dependents. Defaults to False.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+            budget (threading.BoundedSemaphore, optional): Slots shared with the other runs of an invocation, see shared_budget. Defaults to None.
         """
         if not self.compiled_pipeline:
             raise Exception('Pipeline must be compiled before it can be executed.')
-        self.active_pipeline.execute(mode,start,tables,args)
+        self.active_pipeline.execute(mode,start,tables,args,modified=modified,workers=workers,budget=budget)
         return self
+
+    def plan(self, mode:str, start:str = None, tables:List = None, modified:bool = False, workers:int = 1) -> str:
+        """
+        Describes the order nodes would start in and the expected makespan
+
+        Args:
+            mode (str): Mode to plan
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only plan these nodes. Defaults to None.
+            modified (bool, optional): Only plan nodes that changed since their last successful run. Defaults to False.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+        """
+        return self.active_pipeline.plan(mode, start, tables, modified=modified, workers=workers)
     
-    def compile(self, mode:str, overrides:dict = None):
+    def explain(self, mode:str, start:str = None, tables:List = None, workers:int = 4, threshold:float = None) -> str:
+        """
+        Ranks the compiled statements by the cost the database estimates for them
+
+        Args:
+            mode (str): Mode the pipeline was compiled in
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only explain these nodes. Defaults to None.
+            workers (int, optional): EXPLAINs in flight at once. Defaults to 4.
+            threshold (float, optional): Estimated cost that flags a statement. Defaults to None.
+        """
+        if not self.compiled_pipeline:
+            raise Exception('Pipeline must be compiled before it can be explained.')
+        return self.active_pipeline.explain(mode, start, tables, workers=workers, threshold=threshold)
+
+    def sample(self, rows:int = None, pct:float = None, profiles:int = 1):
+        """
+        Runs the pipeline on a sample of the data, see Pipeline.sample
+
+        Args:
+            rows (int, optional): Rows each query returns at most. Defaults to None.
+            pct (float, optional): Percentage of rows each query keeps. Defaults to None.
+            profiles (int, optional): iterate_on variants expand only this many profiles. Defaults to 1.
+        """
+        self.active_pipeline.sample(rows, pct, profiles)
+        return self
+
+    def compile(self, mode:str, overrides:dict = None, full_refresh:bool = False):
         """
         Compiles the pipeline in the specified mode
 
         Args:
             mode (str): Mode to compile the pipeline in
             overrides (dict, optional): Arguments to override the defaults. Defaults to None.
+            full_refresh (bool, optional): Ignore incremental state and rebuild from scratch. Defaults to False.
         """
         try:
-            self.active_pipeline.compile(mode,overrides)
+            self.active_pipeline.compile(mode,overrides,full_refresh=full_refresh)
             self.compiled_pipeline = True
         except Exception as e:
             self.compiled_pipeline = False
@@ -354,15 +578,29 @@ class Curie:
         """
         return self.active_pipeline.test_connection()
     
-    def describe(self, mode:str):
+    def describe(self, mode:str, format:str = 'mermaid', collapse:int = None):
         """
         Describes the DAG in the specified mode
 
         Args:
             mode (str): Mode to describe the DAG in
+            format (str, optional): mermaid, dot or json. Defaults to 'mermaid'.
+            collapse (int, optional): Collapse fan in and fan out wider than this into summary nodes. Defaults to None.
         """
-        return self.active_pipeline.describe(mode)
+        return self.active_pipeline.describe(mode, format, collapse)
     
+    def lint_dependencies(self, mode:str, apply:bool = False):
+        """
+        Checks declared dependencies against the tables each compiled node reads
+
+        Args:
+            mode (str): Mode to check
+            apply (bool, optional): Add missing dependencies to the DAG. Defaults to False.
+        """
+        if not self.compiled_pipeline:
+            raise Exception('Pipeline must be compiled before its dependencies can be checked.')
+        return self.active_pipeline.lint_dependencies(mode, apply=apply)
+
     def validate(self, mode:str, pipeline:str = None, node:str = None, connection:str = None):
         """
         Validates names are correct and that the DAG is valid
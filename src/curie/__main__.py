@@ -7,10 +7,41 @@ from zipfile import ZipFile
 import importlib.resources as pkg_resources
 
 from . import Curie, modes
+from .utils.paths import sweep_label
+from .utils.state import read_yaml
 from .document import generate_docs, serve_docs
 
+# etl arguments forwarded to a daemon by --server
+ETL_OPTIONS = ['mode', 'pipeline', 'start', 'tables', 'download', 'connection', 'compile', 'full_refresh', 'modified', 'workers', 'plan', 'explain', 'explain_threshold', 'lint_deps', 'infer_deps', 'override_names', 'override_values', 'from_plan', 'sample', 'sample_pct', 'sample_profiles', 'graph', 'collapse', 'override_matrix', 'sweep']
+
 
 def etl(args):
+    if args.server:
+        from .server import forward
+        sys.exit(forward(args.server, request_from_args(args)))
+    # A packed plan carries everything but the connection, so the pipelines are not loaded
+    run_etl(Curie(defer_imports=True, connections_only=bool(args.from_plan)), args)
+
+def request_from_args(args):
+    """
+    The etl arguments a daemon needs to repeat this invocation
+    """
+    request = dict((key, getattr(args, key)) for key in ETL_OPTIONS)
+    # The daemon may run from another directory
+    if request['override_matrix']:
+        request['override_matrix'] = os.path.abspath(request['override_matrix'])
+    return request
+
+def run_etl(curie, args):
+    if isinstance(args.pipeline, list) and ((len(args.pipeline) == 1 and (args.pipeline != ['all'] or args.mode == 'clean')) or getattr(args, 'from_plan', None)):
+        # A plan holds one pipeline, anything after its name is the start node
+        if len(args.pipeline) > 1 and args.start in [None, '.']:
+            args.start = args.pipeline[1]
+        args.pipeline = args.pipeline[0]
+    if isinstance(args.pipeline, list):
+        return run_pipelines(curie, args)
+    if getattr(args, 'from_plan', None):
+        return run_plan(curie, args)
     # Get all mode class names where the class is a subclass of Mode (excluding Mode itself)
     mode_names = ['clean'] + [name for name, obj in vars(modes).items() if isinstance(obj, type) and issubclass(obj, modes.Mode) and obj != modes.Mode]
     # Validate mode
@@ -18,13 +49,15 @@ def etl(args):
         logging.error('Mode must be one of: {}'.format(', '.join(mode_names+['clean'])))
         sys.exit(1)
     
-    # Create Curie instance and validate input parameters
-    curie = Curie(defer_imports=True).validate(args.mode, args.pipeline, args.start, args.connection)
+    # Validate input parameters
+    curie = curie.validate(args.mode, args.pipeline, args.start, args.connection)
 
     # In the case of clean, just clean and exit
     if args.mode == 'clean':
         curie.clean(args.pipeline)
         return
+    if getattr(args, 'override_matrix', None) or getattr(args, 'sweep', None):
+        return run_sweep(curie, args)
     
     # Load pipeline
     # print('Loading pipeline... {}'.format(args.pipeline))
@@ -32,6 +65,7 @@ def etl(args):
 
     if args.connection is None:
         args.connection = pipe.get_connection()
+    pipe.sample(args.sample, args.sample_pct, args.sample_profiles)
 
     # Get overrides
     overrides = {}
@@ -39,16 +73,219 @@ def etl(args):
         for name, value in zip(args.override_names, args.override_values):
             overrides[name] = value
     
+    if args.graph:
+        print(pipe.describe(args.mode, args.graph, args.collapse))
+        return
+
     # Execute mode
-    pipe.compile(args.mode,overrides=overrides)
+    pipe.compile(args.mode,overrides=overrides,full_refresh=args.full_refresh)
+    if args.lint_deps or args.infer_deps:
+        report = pipe.lint_dependencies(args.mode, apply=args.infer_deps)
+        print_dependency_report(report, applied=args.infer_deps)
     if args.compile:
         return
+    if args.plan:
+        print(pipe.plan(args.mode, args.start, args.tables, modified=args.modified, workers=args.workers))
+        return
     
     if pipe.test_connection() is False:
         logging.error('Connection test failed - please check connection details for {}'.format(args.connection))
         sys.exit(1)
 
-    pipe.execute(args.mode, args.start, args.tables)
+    if args.explain:
+        print(pipe.explain(args.mode, args.start, args.tables, workers=max(args.workers, 4), threshold=args.explain_threshold))
+        return
+
+    pipe.execute(args.mode, args.start, args.tables, modified=args.modified, workers=args.workers, budget=getattr(args, 'budget', None))
+
+def pipeline_names(curie, args) -> list:
+    """
+    Resolves the pipelines named on the command line, `all` being every pipeline of the project
+
+    A trailing name that is not a pipeline is the start node of a single pipeline run.
+    """
+    names = list(args.pipeline)
+    known = curie.project.pipelines
+    if len(names) > 1 and args.start in [None, '.'] and names[-1] not in known and names[-1] != 'all':
+        args.start = names.pop()
+    if 'all' in names:
+        names = list(known.keys())
+    unknown = [name for name in names if name not in known and name != '.']
+    if unknown:
+        logging.error('Unknown pipeline(s): {}'.format(', '.join(unknown)))
+        sys.exit(1)
+    for name in names:
+        missing = [dep for dep in getattr(known.get(name), 'depends_on', []) if dep not in known]
+        if missing:
+            logging.error('Pipeline {} depends on unknown pipeline(s): {}'.format(name, ', '.join(missing)))
+            sys.exit(1)
+    return list(dict.fromkeys(names))
+
+def run_pipelines(curie, args):
+    """
+    Runs several pipelines of one project in this process
+
+    They share the loaded project, its connection pools and template caches. A pipeline starts
+    once the pipelines it depends_on (in the project file) that are part of the run finished, and
+    is skipped if one of them failed. --workers is the budget of nodes running at once across
+    all of them.
+    """
+    names = pipeline_names(curie, args)
+    if len(names) == 1 or args.mode == 'clean':
+        for name in names:
+            run_etl(curie.fork() if len(names) > 1 else curie, argparse.Namespace(**{**vars(args), 'pipeline': name}))
+        return
+    if args.start not in [None, '.']:
+        logging.error('A start node only applies to a single pipeline')
+        sys.exit(1)
+
+    def run_one(name, budget):
+        run_etl(curie.fork(), argparse.Namespace(**{**vars(args), 'pipeline': name, 'budget': budget}))
+
+    dependencies = dict((name, curie.project.pipelines[name].depends_on) for name in names)
+    run_concurrently('pipeline', dependencies, run_one, args.workers, getattr(args, 'budget', None))
+
+def run_concurrently(kind:str, dependencies:dict, run_one, workers:int, budget = None, concurrent:bool = True):
+    """
+    Runs etl invocations in threads, each once the ones it depends on succeeded, and prints
+    a summary. Exits with status 1 if a run failed or was skipped. Without concurrent the
+    invocations run one at a time, in order.
+
+    The runs themselves take no slots: run_one is handed the budget, the node slots that the
+    nodes of every run share. It is `workers` slots, or the budget of an enclosing run, so
+    pipelines that each sweep still run at most `workers` nodes at once.
+    """
+    from .scheduler import DEFAULT_COST, Scheduler, shared_budget
+    slots = budget if budget is not None else shared_budget(workers)
+    def run(name):
+        print(f'{kind.capitalize()} {name} started')
+        try:
+            run_one(name, slots)
+        except SystemExit as e:
+            if e.code:
+                raise Exception(f'{kind.capitalize()} {name} exited with status {e.code}')
+
+    results = {}
+    def finished(name, seconds, status, error):
+        results[name] = (status, seconds, error)
+        print(f'{kind.capitalize()} {name} {"finished" if status == "success" else "failed"} in {seconds:.1f}s')
+
+    names = list(dependencies.keys())
+    scheduler = Scheduler(dependencies, dict((name, DEFAULT_COST) for name in names), workers=len(names) if concurrent else 1)
+    try:
+        scheduler.run(run, finished, keep_going=True)
+    except Exception:
+        pass
+    print(f'\n{kind:<30} {"status":<8} {"seconds":>8}')
+    for name in names:
+        status, seconds, error = results.get(name, ('skipped', None, None))
+        print(f'{name:<30} {status:<8} {"-" if seconds is None else f"{seconds:.1f}":>8}' + (f'  {str(error).splitlines()[0]}' if error and str(error) else ''))
+    if any(result[0] != 'success' for result in results.values()) or len(results) < len(names):
+        sys.exit(1)
+
+def sweep_runs(args) -> dict:
+    """
+    Expands --override-matrix and --sweep into the overrides of each run, by run label
+
+    A matrix file is either a list of runs, each a mapping of variables to values, or a mapping
+    of variables to lists of values. Lists and --sweep name=v1,v2 expand to every combination.
+    """
+    axes, runs = [], [{}]
+    if args.override_matrix:
+        matrix = read_yaml(os.path.abspath(args.override_matrix), cache=False)
+        if isinstance(matrix, list):
+            runs = [dict(run) for run in matrix]
+        elif isinstance(matrix, dict):
+            axes += [(name, values if isinstance(values, list) else [values]) for name, values in matrix.items()]
+        else:
+            logging.error('{} must hold a list of runs or a mapping of variables to values'.format(args.override_matrix))
+            sys.exit(1)
+    for sweep in args.sweep or []:
+        name, _, values = sweep.partition('=')
+        if not name or not values:
+            logging.error('--sweep takes name=value1,value2, not {}'.format(sweep))
+            sys.exit(1)
+        axes.append((name, values.split(',')))
+    for name, values in axes:
+        runs = [{**run, name: value} for run in runs for value in values]
+    labelled = {}
+    for run in runs:
+        label = sweep_label(run)
+        if label in labelled:
+            label = f'{label}-{len(labelled)}'
+        labelled[label] = run
+    return labelled
+
+def run_sweep(curie, args):
+    """
+    Runs one pipeline once per set of overrides, concurrently in this process
+
+    The runs share the loaded project, connection pools and template caches. Each compiles to
+    <compile_path>/<label> and saves to <download>/<label>, with its own DAG and manifest, and
+    --workers is the budget of nodes running at once across all of them. Modes that build
+    tables run one label at a time, since every run renders the same {{this}} targets.
+    """
+    runs = sweep_runs(args)
+    pipeline = curie.project.pipelines[args.pipeline]
+    names = list(args.override_names or [])
+    values = list(args.override_values or [])
+    # The runs of a mode that builds tables would build the same tables at once
+    concurrent = not getattr(getattr(modes, args.mode, None), 'materializes', False)
+    print('Sweeping {} over {} run(s){}: {}'.format(args.pipeline, len(runs), '' if concurrent else ' one at a time', ', '.join(runs.keys())))
+
+    def run_one(label, budget):
+        overrides = runs[label]
+        run_args = argparse.Namespace(**{**vars(args), 'override_matrix': None, 'sweep': None, 'budget': budget,
+                                          'override_names': names + list(overrides.keys()), 'override_values': values + list(overrides.values())})
+        run_etl(curie.fork({args.pipeline: pipeline.parameterized(label)}), run_args)
+
+    run_concurrently('run', dict((label, []) for label in runs), run_one, args.workers, getattr(args, 'budget', None), concurrent=concurrent)
+
+def run_plan(curie, args):
+    from .artifact import Plan, execute
+    plan = Plan(args.from_plan)
+    index = plan.index
+    plan.close()
+    if args.pipeline != index['pipeline'] or args.mode != index['mode']:
+        logging.error('{} is a {} plan of {}, not a {} plan of {}'.format(args.from_plan, index['mode'], index['pipeline'], args.mode, args.pipeline))
+        sys.exit(1)
+    profile = args.connection if args.connection else index['profile']
+    if profile not in curie.project.connections:
+        logging.error('Connection {} is not defined'.format(profile))
+        sys.exit(1)
+    connection = curie.project.connections[profile]
+    if connection.test() is False:
+        logging.error('Connection test failed - please check connection details for {}'.format(profile))
+        sys.exit(1)
+    execute(args.from_plan, connection, profile=profile, start=args.start, tables=args.tables, workers=args.workers)
+
+def print_dependency_report(report, applied=False):
+    issues = 0
+    for node in report:
+        for dep in report[node]['missing']:
+            issues += 1
+            print('{} {}: reads {} but does not depend on it'.format('Added' if applied else 'Missing', node, dep))
+        for dep in report[node]['unnecessary']:
+            issues += 1
+            print('Unnecessary {}: depends on {} but never reads it'.format(node, dep))
+    if issues == 0:
+        print('Dependencies match the compiled SQL for {} nodes.'.format(len(report)))
+
+def stats(args):
+    from .history import History, describe_stats, stats as summarize
+    from .utils.state import state_path
+    path = state_path('history.db')
+    if not os.path.exists(path):
+        print('No runs recorded.')
+        return
+    report = summarize(History(path), args.pipeline, mode=args.mode, node=args.node, days=args.days, baseline=args.baseline, threshold=args.threshold)
+    print(describe_stats(report, threshold=args.threshold))
+    if args.fail_on_regression and any(r['regressed'] for r in report):
+        sys.exit(1)
+
+def serve(args):
+    from .server import serve as serve_daemon
+    serve_daemon(host=args.host, port=args.port, socket_path=args.socket, pool_size=args.pool_size, allow_remote=args.allow_remote)
 
 def docs(args):
     actmap = {
@@ -113,8 +350,8 @@ def main():
 
     # ETL subparser
     etl_parser = subparsers.add_parser('etl', help='ETL')
-    etl_parser.add_argument('mode', choices=['run', 'save', 'clean','deploy'], help='Mode to run the pipeline in')
-    etl_parser.add_argument('pipeline', help='Path to the pipeline file')
+    etl_parser.add_argument('mode', choices=['run', 'save', 'test', 'clean','deploy'], help='Mode to run the pipeline in')
+    etl_parser.add_argument('pipeline', nargs='+', help='Pipelines to run, or all. Several pipelines run concurrently in one process.')
     # Optional arguments
     # The node to start at (required unless mode is clean)
     etl_parser.add_argument('start', nargs='?', help='Node to start at', default='.')
@@ -122,14 +359,51 @@ def main():
     etl_parser.add_argument('--download', help='Download directory')
     etl_parser.add_argument('--connection', help='Connection to use')
     etl_parser.add_argument('--compile', action='store_true', help='Compile the pipeline, no execution.')
+    etl_parser.add_argument('--full-refresh', action='store_true', help='Ignore incremental state and rebuild outputs from scratch.')
+    etl_parser.add_argument('--modified', action='store_true', help='Only run nodes whose definition changed since their last successful run, and their dependents.')
+    etl_parser.add_argument('--workers', type=int, default=1, help='Nodes to run at the same time, across all pipelines of the run. Defaults to 1.')
+    etl_parser.add_argument('--plan', action='store_true', help='Show the order nodes would start in and the expected makespan, no execution.')
+    etl_parser.add_argument('--from-plan', help='Execute a packed plan written by compile (<compile_path>/<mode>.plan) without loading the pipeline files.')
+    etl_parser.add_argument('--explain', action='store_true', help='EXPLAIN every compiled statement and rank them by estimated cost, no execution.')
+    etl_parser.add_argument('--explain-threshold', type=float, help='Estimated cost at which --explain flags a statement.')
+    etl_parser.add_argument('--sample', type=int, help='Run every query on at most this many rows, building tables in <schema>_sample and saving to <download>_sample.')
+    etl_parser.add_argument('--sample-pct', type=float, help='Run every query on this percentage of its rows, drawn at random. Combines with --sample.')
+    etl_parser.add_argument('--sample-profiles', type=int, default=1, help='When sampling, iterate_on variants expand only this many profiles. Defaults to 1.')
+    etl_parser.add_argument('--graph', choices=['mermaid', 'dot', 'json'], help='Print the DAG in this format, no execution.')
+    etl_parser.add_argument('--collapse', type=int, help='With --graph, draw fan in and fan out wider than this as one summary node.')
+    etl_parser.add_argument('--lint-deps', action='store_true', help='Report depends_on entries that are missing or unnecessary according to the compiled SQL.')
+    etl_parser.add_argument('--infer-deps', action='store_true', help='Add dependencies inferred from the compiled SQL before running.')
     # Override named arguments using --<argument>
     etl_parser.add_argument('--override-names', nargs='*', help='Names of variables to override')
     # Override named arguments using --<argument>=<value>
     etl_parser.add_argument('--override-values', nargs='*', help='Overrides for variables')
+    etl_parser.add_argument('--override-matrix', help='YAML file of override sets, one run of the pipeline each, run concurrently (one at a time in run mode).')
+    etl_parser.add_argument('--sweep', action='append', help='Run once per value, e.g. --sweep region=us,eu,apac. Repeat to sweep every combination.')
+    etl_parser.add_argument('--server', help='Send the run to a curie serve daemon, e.g. http://127.0.0.1:8765 or unix:///tmp/curie.sock')
+
+    # Stats subparser
+    stats_parser = subparsers.add_parser('stats', help='Report node durations and regressions from the run history')
+    stats_parser.add_argument('pipeline', help='Pipeline to report on')
+    stats_parser.add_argument('--mode', help='Only report runs in this mode')
+    stats_parser.add_argument('--node', help='Only report this node')
+    stats_parser.add_argument('--days', type=int, default=30, help='Ignore runs older than this many days. Defaults to 30')
+    stats_parser.add_argument('--baseline', type=int, default=10, help='Successful runs before the latest that form the baseline. Defaults to 10')
+    stats_parser.add_argument('--threshold', type=float, default=2.0, help='Slowdown over the baseline that counts as a regression. Defaults to 2.0')
+    stats_parser.add_argument('--fail-on-regression', action='store_true', help='Exit with status 1 when a node regressed')
+
+    # Serve subparser
+    serve_parser = subparsers.add_parser('serve', help='Run a daemon that keeps the project loaded and accepts etl runs')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='Address to listen on. Defaults to 127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8765, help='Port to listen on. Defaults to 8765')
+    serve_parser.add_argument('--socket', help='Listen on a Unix socket at this path instead of a port')
+    serve_parser.add_argument('--pool-size', type=int, default=4, help='Idle connections kept open per connection profile. Defaults to 4')
+    serve_parser.add_argument('--allow-remote', action='store_true', help='Allow --host to be a non-loopback address. Requires a token in CURIE_SERVE_TOKEN')
 
     # Docs subparser
     docs_parser = subparsers.add_parser('docs', help='Documentation')
     docs_parser.add_argument('action', choices=['generate', 'serve'], help='Command to run')
+    docs_parser.add_argument('--full', action='store_true', help='Render every page and rebuild the whole site, not only what changed.')
+    docs_parser.add_argument('--workers', type=int, help='Processes rendering pages. Defaults to the number of CPUs.')
 
     # Init subparser
     init_parser = subparsers.add_parser('init', help='Initialize new project')
@@ -155,7 +429,9 @@ def main():
     command_mapping = {
         'etl': etl,
         'docs': docs,
-        'init': initialize_project
+        'init': initialize_project,
+        'serve': serve,
+        'stats': stats
     }
     command_mapping[args.command](args)
 
@@ -0,0 +1,124 @@
+from typing import Any, Dict
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from .tracing import current_tags, record_span
+
+# Seconds the statements of the current node spent queued for admission, see waiting
+current_wait = contextvars.ContextVar('curie_queue_wait', default=None)
+
+class Admission:
+    """
+    Admission control for one connection profile, shared by everything executing against it
+
+    At most `max_concurrency` connections are checked out at once; a connection is held for a
+    whole statement or session, so this caps the queries the warehouse runs for Curie. Waiters
+    are admitted by priority, then in arrival order. Statements additionally take a token from
+    a bucket refilled at `queries_per_second`, holding at most `burst` tokens.
+
+    Args:
+        max_concurrency (int, optional): Connections in use at once. Defaults to no limit.
+        queries_per_second (float, optional): Sustained statement rate. Defaults to no limit.
+        burst (int, optional): Statements that may start back to back. Defaults to max_concurrency, or 1.
+        priorities (Dict[str, int], optional): Priority of pipelines and nodes by name, higher is admitted first. Defaults to 0 for all.
+    """
+    def __init__(self, max_concurrency:int = None, queries_per_second:float = None, burst:int = None, priorities:Dict[str, int] = None):
+        self.max_concurrency = int(max_concurrency) if max_concurrency else None
+        self.queries_per_second = float(queries_per_second) if queries_per_second else None
+        self.burst = float(burst) if burst else float(self.max_concurrency or 1)
+        self.priorities = dict((str(k), int(v)) for k, v in (priorities or {}).items())
+        self.lock = threading.Condition()
+        self.active = 0
+        self.waiters = []
+        self.arrivals = itertools.count()
+        self.tokens = self.burst
+        self.refilled = time.monotonic()
+
+    @classmethod
+    def from_profile(cls, profile:Dict[str, Any]) -> 'Admission':
+        return cls(profile.get('max_concurrency'), profile.get('queries_per_second'), profile.get('burst'), profile.get('priorities'))
+
+    def priority(self) -> int:
+        """
+        The priority of the current work: that of its node, else of its pipeline, else 0
+        """
+        values = current_tags.get()
+        for key in ['node', 'pipeline']:
+            if values.get(key) in self.priorities:
+                return self.priorities[values[key]]
+        return 0
+
+    def enter(self) -> float:
+        """
+        Waits for a connection slot, returning the seconds waited
+        """
+        if self.max_concurrency is None:
+            return 0.0
+        began = time.monotonic()
+        waited = False
+        with self.lock:
+            ticket = (-self.priority(), next(self.arrivals))
+            heapq.heappush(self.waiters, ticket)
+            while self.waiters[0] != ticket or self.active >= self.max_concurrency:
+                waited = True
+                self.lock.wait()
+            heapq.heappop(self.waiters)
+            self.active += 1
+            # The next waiter may fit too
+            self.lock.notify_all()
+        # A slot granted at once is not a wait, only the time spent blocked is queue time
+        return queued('admission', began) if waited else 0.0
+
+    def leave(self):
+        if self.max_concurrency is None:
+            return None
+        with self.lock:
+            self.active -= 1
+            self.lock.notify_all()
+
+    def throttle(self) -> float:
+        """
+        Takes a token for one statement, waiting for the bucket to refill if it is empty. Returns the seconds waited.
+        """
+        if self.queries_per_second is None:
+            return 0.0
+        began = time.monotonic()
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + (began - self.refilled) * self.queries_per_second)
+            self.refilled = began
+            # Tokens are reserved ahead, so waiters leave in the order they arrived
+            self.tokens -= 1
+            delay = -self.tokens / self.queries_per_second if self.tokens < 0 else 0.0
+        if delay > 0:
+            time.sleep(delay)
+        return queued('rate', began) if delay > 0 else 0.0
+
+def queued(reason:str, began:float) -> float:
+    """
+    Adds a wait to the current node's queue time and traces it as a queue span
+    """
+    seconds = time.monotonic() - began
+    if seconds <= 0:
+        return 0.0
+    total = current_wait.get()
+    if total is not None:
+        total[0] += seconds
+    end_ns = time.time_ns()
+    record_span('queue', end_ns - int(seconds * 1e9), end_ns, reason=reason)
+    return seconds
+
+@contextmanager
+def waiting():
+    """
+    Collects the seconds the statements run in the block wait for admission
+    """
+    total = [0.0]
+    token = current_wait.set(total)
+    try:
+        yield total
+    finally:
+        current_wait.reset(token)
@@ -0,0 +1,185 @@
+from typing import Any, Dict, List
+import datetime
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import uuid
+
+from . import modes
+from .dag import DAG, Node
+from .history import History
+from .tracing import span, trace
+from .utils.paths import ensure_rooting, unroot
+from .utils.state import state_path
+
+MAGIC = b'CURIEPLN'
+VERSION = 1
+# Magic, format version and the length of the index that follows
+HEADER = struct.Struct('<8sIQ')
+
+def digest(data:bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def pack(dag:DAG, mode:str, path:str, pipeline:str = None, profile:str = None, download_dir:str = None) -> str:
+    """
+    Writes a compiled DAG to a single plan file that can be executed without the pipeline files
+
+    The file is a fixed header, a JSON index and one JSON payload per node. The index holds the
+    topological order, each node's dependencies, the hashes of its compiled statements and the
+    files it writes, so it can be inspected or diffed without reading any payload. Payloads are
+    located by offset and only read, through a memory map, when their node runs.
+
+    Args:
+        dag (DAG): A compiled DAG.
+        mode (str): Mode the DAG was compiled in.
+        path (str): Path to write the plan to.
+        pipeline (str, optional): Name of the pipeline. Defaults to None.
+        profile (str, optional): Connection profile the DAG was compiled against. Defaults to None.
+        download_dir (str, optional): Where save nodes write their files. Defaults to None.
+
+    Returns:
+        str: The path written
+    """
+    order = dag.infer_dag(mode)
+    index = {
+        'version': VERSION,
+        'pipeline': pipeline,
+        'mode': mode,
+        'profile': profile,
+        'download': download_dir,
+        'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'order': order,
+        'nodes': {},
+    }
+    blob = bytearray()
+    for name in order:
+        node = dag.nodes[name]
+        node_mode = node.get_mode(mode)
+        payload = json.dumps({
+            'kind': type(node_mode).__name__,
+            'schema': node.schema,
+            'meta': node.meta,
+            'fields': node.fields,
+            'state': node_mode.packed_state(),
+        }, default=str, separators=(',', ':')).encode()
+        files = []
+        if hasattr(node_mode, 'jobs'):
+            files = [unroot(f'{job["path"]}.{job["filetype"]}' if not node_mode.writes_parts() else job['path']) for job in node_mode.jobs(name, download_dir)]
+        index['nodes'][name] = {
+            'offset': len(blob),
+            'length': len(payload),
+            'sha256': digest(payload),
+            'depends_on': getattr(node_mode, 'depends_on', []),
+            'statements': [digest(sql.encode())[:16] for sql in node_mode.compiled_sql()],
+            'files': files,
+        }
+        blob += payload
+    encoded = json.dumps(index, default=str, separators=(',', ':')).encode()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    # Written beside the target and renamed, so a worker never maps a half written plan
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(encoded)))
+            f.write(encoded)
+            f.write(blob)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+def placeholder(name:str) -> Node:
+    node = Node.__new__(Node)
+    node.name, node.schema, node.meta, node.fields, node.manifest = name, None, None, None, None
+    node.definitions, node.modes = {}, {}
+    return node
+
+class Plan:
+    """
+    A packed plan file, memory mapped
+
+    Args:
+        path (str): Path to the plan file.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, length = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise Exception(f'{path} is not a Curie plan file.')
+        if version != VERSION:
+            raise Exception(f'{path} is a version {version} plan, this Curie reads version {VERSION}. Compile it again.')
+        self.index = json.loads(self.map[HEADER.size:HEADER.size + length])
+        self.offset = HEADER.size + length
+
+    def payload(self, name:str, verify:bool = True) -> Dict[str, Any]:
+        entry = self.index['nodes'][name]
+        data = self.map[self.offset + entry['offset']:self.offset + entry['offset'] + entry['length']]
+        if verify and digest(data) != entry['sha256']:
+            raise Exception(f'Node {name} in {self.path} does not match its hash, the plan is corrupt.')
+        return json.loads(data)
+
+    def dag(self, verify:bool = True) -> DAG:
+        """
+        Rebuilds the compiled DAG, without reading pipeline files or rendering templates
+        """
+        mode = self.index['mode']
+        dag = DAG.__new__(DAG)
+        dag.nodes = {}
+        for name in self.index['order']:
+            payload = self.payload(name, verify)
+            node = Node.__new__(Node)
+            node.name = name
+            node.schema = payload['schema']
+            node.meta = payload['meta']
+            node.fields = payload['fields']
+            node.manifest = None
+            node.definitions = {}
+            node.modes = {mode: getattr(modes, payload['kind']).from_packed(payload['state'])}
+            dag.nodes[name] = node
+        # Dependencies without this mode are not packed, they stand in as nodes with nothing to run as they do when compiling
+        for name in self.index['order']:
+            for dep in self.index['nodes'][name]['depends_on'] or []:
+                if dep not in dag.nodes:
+                    dag.nodes[dep] = placeholder(dep)
+        return dag
+
+    def close(self):
+        self.map.close()
+
+def execute(path:str, connection:Any, profile:str = None, start:str = None, tables:List = None, workers:int = 1):
+    """
+    Executes a packed plan, recording the run in the history like a compiled pipeline
+
+    Args:
+        path (str): Path to the plan file.
+        connection (Database): Connection to execute against.
+        profile (str, optional): Name of the connection profile. Defaults to the one the plan was compiled against.
+        start (str, optional): Node to start at. Defaults to None.
+        tables (List, optional): Only run these nodes. Defaults to None.
+        workers (int, optional): Nodes run at the same time. Defaults to 1.
+    """
+    plan = Plan(path)
+    try:
+        index = plan.index
+        mode, name = index['mode'], index['pipeline']
+        profile = profile if profile else index['profile']
+        dag = plan.dag()
+        run_id = uuid.uuid4().hex
+        with trace(run_id, pipeline=name, mode=mode, profile=profile if profile else 'default'):
+            run = History(state_path('history.db')).start(name, mode, profile, workers=workers, run_id=run_id)
+            try:
+                with span('execute', workers=workers, plan=path):
+                    dag.execute(mode, start, tables, connection=connection, download_dir=index['download'], history=run, workers=workers)
+            except BaseException as e:
+                run.finish('failed')
+                raise e
+            run.finish('success')
+    finally:
+        plan.close()
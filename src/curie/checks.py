@@ -0,0 +1,226 @@
+from typing import Any, Dict, List
+import re
+
+# Declared field types, by family, and the prefixes of the warehouse types that satisfy them
+TYPE_FAMILIES = {
+    'integer': ['int', 'integer', 'bigint', 'smallint', 'tinyint', 'mediumint', 'int2', 'int4', 'int8', 'serial', 'long'],
+    'number': ['int', 'integer', 'bigint', 'smallint', 'tinyint', 'mediumint', 'int2', 'int4', 'int8', 'serial', 'long',
+               'real', 'float', 'double', 'numeric', 'decimal', 'number', 'num'],
+    'string': ['char', 'varchar', 'character', 'nchar', 'nvarchar', 'bpchar', 'text', 'string', 'clob', 'tinytext', 'mediumtext', 'longtext', 'enum'],
+    'boolean': ['bool', 'boolean', 'tinyint(1)', 'bit'],
+    'date': ['date'],
+    'timestamp': ['timestamp', 'datetime', 'timestamptz'],
+}
+ALIASES = {
+    'int': 'integer', 'bigint': 'integer', 'smallint': 'integer', 'long': 'integer',
+    'float': 'number', 'double': 'number', 'decimal': 'number', 'numeric': 'number', 'real': 'number',
+    'str': 'string', 'text': 'string', 'varchar': 'string', 'char': 'string',
+    'bool': 'boolean',
+    'datetime': 'timestamp', 'timestamptz': 'timestamp',
+}
+
+def type_family(declared:str) -> str:
+    """
+    Returns the family of a declared field type, or None for types that are not checked
+    """
+    if not declared:
+        return None
+    name = re.sub(r'\(.*\)', '', str(declared)).strip().lower()
+    name = ALIASES.get(name, name)
+    return name if name in TYPE_FAMILIES else None
+
+def rules(fields:List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Reduces a node's fields to the checks they declare
+
+    Primary key columns must be unique together and, like fields declared `nullable: false`,
+    must not be null.
+
+    Returns:
+        Dict[str, Any]: not_null columns, the primary key columns and the type family of each typed column
+    """
+    not_null, key, types = [], [], {}
+    for field in fields or []:
+        name = field.get('name')
+        if not name:
+            continue
+        if field.get('primary_key'):
+            key.append(name)
+        if field.get('primary_key') or field.get('nullable') is False:
+            not_null.append(name)
+        family = type_family(field.get('type'))
+        if family is not None:
+            types[name] = family
+    return {'not_null': not_null, 'key': key, 'types': types}
+
+def count(rules:Dict[str, Any]) -> int:
+    """
+    Returns the number of checks a node declares
+    """
+    return len(rules['not_null']) + (1 if rules['key'] else 0) + len(rules['types'])
+
+def aggregate_query(table:str, rules:Dict[str, Any]) -> str:
+    """
+    Builds the single scan that counts nulls in every not_null column and, for a one column
+    primary key, its duplicates. Null keys are not duplicates, they are reported by the not_null
+    check. Composite keys cannot be counted distinct portably and get a grouped query of their
+    own from key_query.
+    """
+    columns = ['COUNT(*) AS curie_rows']
+    for i, name in enumerate(rules['not_null']):
+        columns.append(f'SUM(CASE WHEN {name} IS NULL THEN 1 ELSE 0 END) AS curie_nulls_{i}')
+    if len(rules['key']) == 1:
+        columns.append(f'COUNT({rules["key"][0]}) - COUNT(DISTINCT {rules["key"][0]}) AS curie_duplicates')
+    return 'SELECT ' + ',\n    '.join(columns) + f'\nFROM {table}'
+
+def key_query(table:str, rules:Dict[str, Any]) -> str:
+    """
+    Counts the rows beyond the first of every duplicated composite primary key, None for other keys.
+    Rows with a null in the key are skipped, as COUNT(DISTINCT) does for a one column key.
+    """
+    if len(rules['key']) < 2:
+        return None
+    keys = ', '.join(rules['key'])
+    present = ' AND '.join(f'{k} IS NOT NULL' for k in rules['key'])
+    return f'SELECT COALESCE(SUM(n - 1), 0) AS curie_duplicates\nFROM (SELECT COUNT(*) AS n FROM {table} WHERE {present} GROUP BY {keys} HAVING COUNT(*) > 1) AS curie_keys'
+
+def number(value:Any) -> int:
+    # SUM over no rows is NULL, read back as None or NaN
+    return 0 if value is None or value != value else int(value)
+
+def type_matches(family:str, actual:str) -> bool:
+    actual = str(actual).strip().lower()
+    # SQLite columns built from expressions have no declared type, there is nothing to compare
+    if actual == '':
+        return True
+    if family == 'boolean' and actual.startswith('tinyint') and actual != 'tinyint(1)':
+        return False
+    return any(actual.startswith(prefix) for prefix in TYPE_FAMILIES[family])
+
+def type_failures(rules:Dict[str, Any], actual:Dict[str, str]) -> List[str]:
+    """
+    Compares declared type families with the column types the warehouse or file reports
+    """
+    failures = []
+    actual = dict((k.lower(), v) for k, v in actual.items())
+    for name, family in rules['types'].items():
+        if name.lower() not in actual:
+            failures.append(f'{name}: column missing')
+        elif not type_matches(family, actual[name.lower()]):
+            failures.append(f'{name}: expected {family}, found {actual[name.lower()]}')
+    return failures
+
+def table_failures(table:str, schema:str, name:str, rules:Dict[str, Any], connection:Any) -> List[str]:
+    """
+    Runs a table's checks: one aggregate scan, a grouped scan for a composite key and one
+    catalog lookup for the column types
+
+    Returns:
+        List[str]: One message per failed check, empty when every check passed
+    """
+    failures = []
+    if rules['not_null'] or rules['key']:
+        rez = connection.execute(aggregate_query(table, rules))
+        row = dict((k.lower(), v) for k, v in rez.iloc[0].to_dict().items())
+        for i, column in enumerate(rules['not_null']):
+            nulls = number(row[f'curie_nulls_{i}'])
+            if nulls:
+                failures.append(f'{column}: {nulls} null value(s)')
+        duplicates = row.get('curie_duplicates')
+        composite = key_query(table, rules)
+        if composite is not None:
+            duplicates = connection.execute(composite).iloc[0, 0]
+        if number(duplicates):
+            failures.append(f'{", ".join(rules["key"])}: {number(duplicates)} duplicate key row(s)')
+    if rules['types']:
+        failures += type_failures(rules, connection.column_types(schema, name))
+    return failures
+
+def whole(column:Any) -> bool:
+    # Nullable integers come back as floats from pandas, e.g. 1.0
+    import pyarrow.compute as pc
+    if column.null_count == len(column):
+        return True
+    return bool(pc.all(pc.equal(pc.floor(column), column)).as_py())
+
+def arrow_type(family:str, column:Any) -> bool:
+    import pyarrow as pa
+    dtype = column.type
+    if pa.types.is_null(dtype):
+        return True
+    if family == 'integer' and pa.types.is_floating(dtype):
+        return whole(column)
+    return {
+        'integer': pa.types.is_integer,
+        'number': lambda t: pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_decimal(t),
+        'string': lambda t: pa.types.is_string(t) or pa.types.is_large_string(t) or pa.types.is_dictionary(t),
+        'boolean': pa.types.is_boolean,
+        'date': pa.types.is_date,
+        'timestamp': pa.types.is_timestamp,
+    }[family](dtype)
+
+def parses(family:str, column:Any) -> bool:
+    """
+    Whether every value of a text column, e.g. read from csv, parses as the declared type family
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    targets = {'number': pa.float64(), 'boolean': pa.bool_(), 'date': pa.date32(), 'timestamp': pa.timestamp('us')}
+    try:
+        if family == 'string':
+            return True
+        if family == 'integer':
+            try:
+                column.cast(pa.int64())
+                return True
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                return whole(column.cast(pa.float64()))
+        pc.cast(column, targets[family])
+        return True
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        return False
+
+def frame_failures(table:Any, rules:Dict[str, Any], text:bool = False) -> List[str]:
+    """
+    Runs the checks over an Arrow table of saved output, vectorized over whole columns
+
+    With text, the table was read from an untyped format such as csv with every column as
+    text, and typed fields only fail when a value does not parse as their type.
+
+    Null counts come from the column metadata, duplicates from one hash group by over the rows
+    with no null in the key, matching the SQL checks.
+
+    Returns:
+        List[str]: One message per failed check, empty when every check passed
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    if not isinstance(table, pa.Table):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    failures = []
+    names = dict((n.lower(), n) for n in table.column_names)
+    for column in rules['not_null']:
+        if column.lower() not in names:
+            failures.append(f'{column}: column missing')
+            continue
+        nulls = table.column(names[column.lower()]).null_count
+        if nulls:
+            failures.append(f'{column}: {nulls} null value(s)')
+    keys = [names[k.lower()] for k in rules['key'] if k.lower() in names]
+    if keys and len(keys) == len(rules['key']):
+        present = table.select(keys)
+        for key in keys:
+            present = present.filter(pc.is_valid(present.column(key)))
+        counts = present.group_by(keys).aggregate([([], 'count_all')]).column('count_all')
+        duplicates = pc.sum(pc.subtract(counts, 1)).as_py() if len(counts) else 0
+        if duplicates:
+            failures.append(f'{", ".join(rules["key"])}: {duplicates} duplicate key row(s)')
+    for name, family in rules['types'].items():
+        if name.lower() in names and text and pa.types.is_string(table.schema.field(names[name.lower()]).type):
+            if not parses(family, table.column(names[name.lower()])):
+                failures.append(f'{name}: expected {family}, found values that do not parse as {family}')
+        elif name.lower() in names and not arrow_type(family, table.column(names[name.lower()])):
+            failures.append(f'{name}: expected {family}, found {table.schema.field(names[name.lower()]).type}')
+        elif name.lower() not in names and name not in rules['not_null']:
+            failures.append(f'{name}: column missing')
+    return failures
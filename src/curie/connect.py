@@ -1,17 +1,58 @@
 # Author: Eric DiGioacchino
 import imp
+import json
 import logging as log
 import re
 import os
 import subprocess
+import threading
+import time
+from contextlib import contextmanager, suppress
 import pandas as pd
+import sqlite3
+from .admission import Admission
+from .tracing import CLIENT, span, tag_query
+from .utils.paths import ensure_rooting
 # import display for jupyter notebooks
 try:
     from IPython.display import display
 except:
     pass
 
-    
+
+# Marks the point in a method pattern where a staged table is validated before it is swapped in
+VALIDATE = '/* curie:validate {table} */'
+
+class Session:
+    """
+    A single database connection shared by every statement of a node
+
+    Args:
+        database (Database): The connection profile that opened the session.
+        conn (Any): The open DB-API connection.
+    """
+    def __init__(self, database, conn):
+        self.database_ = database
+        self.conn_ = conn
+        # Rows affected by the last statement, -1 or None when the driver does not know
+        self.rowcount = None
+
+    def execute(self, query, **kwargs):
+        cursor = self.conn_.cursor()
+        try:
+            with self.database_.statement(query):
+                try:
+                    cursor.execute(self.database_.tag(query))
+                except Exception as e:
+                    print(query)
+                    raise e
+            self.rowcount = getattr(cursor, 'rowcount', None)
+            if cursor.description is not None:
+                return self.database_.results(cursor)
+            return None
+        finally:
+            cursor.close()
+
 class Database:
     def __init__(self, host, port:int, user, password, database, **kwargs):
         self.host_ = host
@@ -24,6 +65,16 @@ class Database:
         self.database_ = database
         self.kwargs_ = kwargs
         self.reminder_ = None
+        self.profile_ = kwargs.get('profile')
+        # Idle connections kept open for reuse, 0 closes every connection after use
+        self.pool_size_ = int(kwargs.get('pool_size', 0) or 0)
+        self.pool_recycle_ = float(kwargs.get('pool_recycle', 300) or 300)
+        self.idle_ = []
+        self.pool_lock_ = threading.Lock()
+        # Prefix statements with the run, pipeline and node they belong to
+        self.query_tags_ = str(kwargs.get('query_tags', True)).lower() not in ['false', '0', 'no', 'off']
+        # Caps the connections and statement rate of every executor using this profile
+        self.admission_ = Admission.from_profile(kwargs)
     def __repr__(self) -> str:
         return "Database(host={}, port={}, user={}, password={}, database={}, kwargs={})".format(self.host_, self.port_, self.user_, self.password_, self.database_, self.kwargs_)
     
@@ -32,6 +83,245 @@ class Database:
             log.error(self.kwargs_['reminder'])
         log.error(e)
         return None
+
+    # SQL for the schema unqualified names resolve to
+    current_schema = 'current_schema()'
+    # Methods that add to an existing table rather than rebuilding it
+    incremental_methods = ['append', 'merge', 'upsert']
+    # Methods that match existing rows on the node's unique_key
+    keyed_methods = ['merge', 'upsert']
+    # SQL for a random number in [0, 1) drawn per row
+    random_fraction = 'RANDOM()'
+
+    def table_exists(self, schema:str, name:str) -> bool:
+        """
+        Checks information_schema for a table, used to decide if an incremental method can run
+
+        Args:
+            schema (str): Schema of the table, '' for the connection's current schema.
+            name (str): Name of the table.
+        """
+        schema_sql = f"'{schema.lower()}'" if schema else self.current_schema
+        rez = self.execute(f"SELECT COUNT(*) AS n FROM information_schema.tables WHERE LOWER(table_schema) = {schema_sql} AND LOWER(table_name) = '{name.lower()}'")
+        return rez is not None and int(rez.iloc[0, 0]) > 0
+
+    def column_types(self, schema:str, name:str) -> dict:
+        """
+        Reads a table's column types from information_schema, used by test mode to check declared field types
+
+        Args:
+            schema (str): Schema of the table, '' for the connection's current schema.
+            name (str): Name of the table.
+        """
+        schema_sql = f"'{schema.lower()}'" if schema else self.current_schema
+        rez = self.execute(f"SELECT column_name, data_type FROM information_schema.columns WHERE LOWER(table_schema) = {schema_sql} AND LOWER(table_name) = '{name.lower()}'")
+        return {} if rez is None else dict((str(r[0]), str(r[1])) for r in rez.itertuples(index=False))
+
+    def sample_query(self, query:str, rows:int = None, pct:float = None) -> str:
+        """
+        Wraps a query so it returns a sample, used by --sample and --sample-pct
+
+        Neither Redshift nor MySQL has TABLESAMPLE, so a percentage keeps each row with that
+        probability and rows caps the result with LIMIT.
+
+        Args:
+            query (str): The compiled query.
+            rows (int, optional): Return at most this many rows. Defaults to None.
+            pct (float, optional): Percentage of rows to keep. Defaults to None.
+        """
+        if rows is None and pct is None:
+            return query
+        sampled = f'SELECT * FROM ({query.strip().rstrip(";")}\n) AS _curie_sample'
+        if pct is not None:
+            sampled += f' WHERE {self.random_fraction} < {float(pct) / 100}'
+        if rows is not None:
+            sampled += f' LIMIT {int(rows)}'
+        return sampled
+
+    def sample_schema(self, schema:str) -> str:
+        """
+        Returns the schema a sample run builds the tables of a schema in
+        """
+        return f'{schema}_sample' if schema else 'sample'
+
+    def create_schema(self, schema:str) -> str:
+        return f'CREATE SCHEMA IF NOT EXISTS {schema}'
+
+    def tag(self, query:str) -> str:
+        """
+        Prefixes a statement with the current query tag, unless query_tags is disabled for the profile
+        """
+        return tag_query(query) if self.query_tags_ else query
+
+    def span_attributes(self, query:str) -> dict:
+        return {'db.system': type(self).__name__.lower(), 'db.name': self.database_, 'db.statement': query[:2000]}
+
+    @contextmanager
+    def statement(self, query:str):
+        """
+        Traces a statement, once the profile's rate limit admits it. Time spent waiting is not part of the span.
+        """
+        waited = self.admission_.throttle()
+        with span('query', kind=CLIENT, **self.span_attributes(query), **({'queue_seconds': round(waited, 3)} if waited else {})):
+            yield
+
+    def acquire(self):
+        """
+        Returns an idle pooled connection, or opens a new one, once the profile's admission
+        control has a slot free. Connections idle for longer than pool_recycle seconds are
+        closed rather than reused.
+        """
+        self.admission_.enter()
+        try:
+            conn = self.checkout()
+        except BaseException as e:
+            self.admission_.leave()
+            raise e
+        if conn is None:
+            self.admission_.leave()
+        return conn
+
+    def checkout(self):
+        with self.pool_lock_:
+            while self.idle_:
+                conn, released = self.idle_.pop()
+                if time.monotonic() - released < self.pool_recycle_:
+                    return conn
+                with suppress(Exception):
+                    conn.close()
+        return self.connect()
+
+    def release(self, conn, healthy:bool = True):
+        """
+        Returns a connection to the pool, closing it if the pool is full or the connection failed
+        """
+        if conn is None:
+            return None
+        self.admission_.leave()
+        with self.pool_lock_:
+            if healthy and len(self.idle_) < self.pool_size_:
+                self.idle_.append((conn, time.monotonic()))
+                return None
+        with suppress(Exception):
+            conn.close()
+
+    def close_pool(self):
+        """
+        Closes every idle pooled connection
+        """
+        with self.pool_lock_:
+            idle, self.idle_ = self.idle_, []
+        for conn, _ in idle:
+            with suppress(Exception):
+                conn.close()
+
+    def results(self, cursor):
+        """
+        Reads the rows of an executed cursor into a DataFrame
+        """
+        rows = cursor.fetchall()
+        columns = [i[0] for i in cursor.description]
+        return pd.DataFrame(rows, columns=columns)
+
+    def execute(self, query, **kwargs):
+        # Connections and results stay local so one profile can serve concurrent queries
+        results = None
+        conn = self.acquire()
+        if conn is None:
+            return None
+        healthy = False
+        cursor = None
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            with self.statement(query):
+                try:
+                    cursor.execute(self.tag(query))
+                except Exception as e:
+                    print(query)
+                    raise e
+            if cursor.description is not None:
+                results = self.results(cursor)
+            healthy = True
+        finally:
+            if cursor is not None:
+                with suppress(Exception):
+                    cursor.close()
+            self.release(conn, healthy)
+        self.results_ = results
+        return results
+
+    def execute_batches(self, query, batch_size:int = 100000, **kwargs):
+        """
+        Executes a query and yields the results as DataFrames of at most batch_size rows
+        """
+        conn = self.acquire()
+        if conn is None:
+            return None
+        healthy = False
+        cursor = None
+        try:
+            conn.autocommit = True
+            cursor = conn.cursor()
+            with self.statement(query):
+                try:
+                    cursor.execute(self.tag(query))
+                except Exception as e:
+                    print(query)
+                    raise e
+            if cursor.description is None:
+                healthy = True
+                return None
+            columns = [i[0] for i in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield pd.DataFrame(rows, columns=columns)
+            healthy = True
+        finally:
+            if cursor is not None:
+                with suppress(Exception):
+                    cursor.close()
+            self.release(conn, healthy)
+
+    @contextmanager
+    def session(self, transaction:bool = True):
+        """
+        Opens one connection for a sequence of statements.
+        With transaction the statements share one commit and are rolled back together on error,
+        except on MySQL, which commits implicitly after every DDL statement.
+
+        Args:
+            transaction (bool, optional): Run the statements in one transaction. Defaults to True.
+        """
+        conn = self.acquire()
+        if conn is None:
+            raise Exception(f'Could not connect to {self.profile_ if self.profile_ else self.host_}.')
+        healthy = False
+        try:
+            conn.autocommit = not transaction
+            yield Session(self, conn)
+            if transaction:
+                conn.commit()
+            healthy = True
+        except Exception as e:
+            if transaction:
+                with suppress(Exception):
+                    conn.rollback()
+            raise e
+        finally:
+            self.release(conn, healthy)
+
+    @staticmethod
+    def key_condition(unique_key, left:str, right:str) -> str:
+        """
+        Joins two relations on every column of the unique key
+        """
+        if not unique_key:
+            raise Exception('merge requires a unique_key.')
+        keys = [unique_key] if isinstance(unique_key, str) else unique_key
+        return ' AND '.join([f'{left}.{k} = {right}.{k}' for k in keys])
     
 class Redshift(Database):
     def __init__(self, host, port, user, password, database, **kwargs):
@@ -53,7 +343,7 @@ class Redshift(Database):
         if 'reminder' in kwargs:
             self.reminder_ = kwargs['reminder']
 
-        delfrom = ['secrets', 'reminder', 'defer_import']
+        delfrom = ['secrets', 'reminder', 'defer_import', 'profile', 'pool_size', 'pool_recycle', 'query_tags', 'max_concurrency', 'queries_per_second', 'burst', 'priorities']
         for key in delfrom:
             if key in self.kwargs_:
                 del self.kwargs_[key]
@@ -72,11 +362,12 @@ class Redshift(Database):
     def connect(self, help=False):
         # use global variables to connect to redshift
         try:
-            self.conn_ = redshift_connector.connect(host=self.host_, port=self.port_, user=self.user_, password=self.password_, database=self.database_, **self.kwargs_)
+            conn = redshift_connector.connect(host=self.host_, port=self.port_, user=self.user_, password=self.password_, database=self.database_, **self.kwargs_)
+            self.conn_ = conn
             log.info("Connected to Redshift...")
             if help:
                 print("\n\nExample Usage:\n\nconn = Curie(*args).this_connection.connect()\ncursor = conn.cursor()\ncursor.execute('SELECT * FROM table')\nresults = cursor.fetchall()\n\n")
-            return self.conn_
+            return conn
         except Exception as e:
             if self.reminder_:
                 log.error("REMINDER: " + self.reminder_)
@@ -86,33 +377,57 @@ class Redshift(Database):
 
     def __repr__(self):
         return "Redshift(host={}, port={}, user={}, database={}, kwargs={})".format(self.host_, self.port_, self.user_, self.database_, self.kwargs_)
+
+    def results(self, cursor):
+        return cursor.fetch_dataframe()
     
     def method_patterns(self):
+        merge = lambda q, unique_key=None, **kw: [
+            'DROP TABLE IF EXISTS {{this}}__curie_stage',
+            'CREATE TABLE {{this}}__curie_stage AS (' + q + ')',
+            'DELETE FROM {{this}} USING {{this}}__curie_stage WHERE ' + self.key_condition(unique_key, '{{this}}', '{{this}}__curie_stage'),
+            'INSERT INTO {{this}} (SELECT * FROM {{this}}__curie_stage)',
+            'DROP TABLE {{this}}__curie_stage',
+        ]
+        # Build beside the live table and swap it in, readers never see a missing or partial table
+        replace = lambda q, table=None, **kw: [
+            'DROP TABLE IF EXISTS {{this}}__curie_stage',
+            'CREATE TABLE {{this}}__curie_stage AS (' + q + ')',
+            VALIDATE.format(table='{{this}}__curie_stage'),
+            'CREATE TABLE IF NOT EXISTS {{this}} (LIKE {{this}}__curie_stage)',
+            'DROP TABLE IF EXISTS {{this}}__curie_old',
+            'ALTER TABLE {{this}} RENAME TO ' + table + '__curie_old',
+            'ALTER TABLE {{this}}__curie_stage RENAME TO ' + table,
+            'DROP TABLE {{this}}__curie_old',
+        ]
         return {
-            'seed': lambda q: [q],
-            'replace': lambda q: ['DROP TABLE IF EXISTS {{this}}', 'CREATE TABLE {{this}} AS (' + q + ')'],
-            'truncate': lambda q: ['TRUNCATE TABLE {{this}}', 'INSERT INTO {{this}} (' + q + ')'],
+            'seed': lambda q, **kw: [q],
+            'replace': replace,
+            'truncate': lambda q, **kw: ['TRUNCATE TABLE {{this}}', 'INSERT INTO {{this}} (' + q + ')'],
+            'append': lambda q, **kw: ['INSERT INTO {{this}} (' + q + ')'],
+            'merge': merge,
+            'upsert': merge,
         }
     
-    def execute(self, query, **kwargs):
-        self.results_ = None
-        self.conn_ = self.connect()
-        self.conn_.autocommit = True
-        if self.conn_ is None:
-            return None
-        cursor = self.conn_.cursor()
-        try:
-            cursor.execute(query)
-        except Exception as e:
-            print(query)
-            raise e
-        # if 'store_results' in kwargs and kwargs['store_results']:
-        if cursor.description is not None:
-            results = cursor.fetch_dataframe()
-            self.results_ = results
-        cursor.close()
-        self.conn_.close()
-        return self.results_
+    def explain(self, query):
+        """
+        Estimates the cost and rows of a statement from its EXPLAIN plan
+
+        Returns:
+            Dict[str, Any]: cost, rows, the plan lines and flags for risky operators
+        """
+        rez = self.execute('EXPLAIN ' + query)
+        plan = rez.iloc[:, 0].astype(str).tolist() if rez is not None else []
+        top = re.search(r'cost=[\d.]+\.\.([\d.]+) rows=(\d+)', plan[0]) if plan else None
+        flags = []
+        # Columnar scans are the norm here, joins that loop or move whole tables are what hurt
+        if any('Nested Loop' in line for line in plan):
+            flags.append('nested loop')
+        if any('DS_BCAST_INNER' in line for line in plan):
+            flags.append('broadcast')
+        if any('DS_DIST_BOTH' in line or 'DS_DIST_ALL_INNER' in line for line in plan):
+            flags.append('redistribute')
+        return {'cost': float(top[1]) if top else None, 'rows': float(top[2]) if top else None, 'plan': plan, 'flags': flags}
 
     def test(self):
         try:
@@ -154,7 +469,7 @@ class MySQL(Database):
         if 'reminder' in kwargs:
             self.reminder_ = kwargs['reminder']
 
-        delfrom = ['secrets', 'reminder', 'defer_import']
+        delfrom = ['secrets', 'reminder', 'defer_import', 'profile', 'pool_size', 'pool_recycle', 'query_tags', 'max_concurrency', 'queries_per_second', 'burst', 'priorities']
         for key in delfrom:
             if key in self.kwargs_:
                 del self.kwargs_[key]
@@ -163,9 +478,10 @@ class MySQL(Database):
         # use global variables to connect to redshift
         try:
             # print(self.__repr__())
-            self.conn_ = mysql_connector.connect(host=self.host_, port=self.port_, user=self.user_, password=self.password_, database=self.database_, **self.kwargs_)
+            conn = mysql_connector.connect(host=self.host_, port=self.port_, user=self.user_, password=self.password_, database=self.database_, **self.kwargs_)
+            self.conn_ = conn
             log.info("Connected to MySQL...")
-            return self.conn_
+            return conn
         except Exception as e:
             if self.reminder_:
                 log.error("REMINDER: " + self.reminder_)
@@ -176,34 +492,199 @@ class MySQL(Database):
     def __repr__(self):
         return "MySQL(host={}, port={}, user={}, database={}, password={}, kwargs={})".format(self.host_, self.port_, self.user_, self.database_,self.password_, self.kwargs_)
     
+    current_schema = 'DATABASE()'
+    random_fraction = 'RAND()'
+
     def method_patterns(self):
+        merge = lambda q, unique_key=None, **kw: [
+            'DROP TABLE IF EXISTS {{this}}__curie_stage',
+            'CREATE TABLE {{this}}__curie_stage AS (' + q + ')',
+            'DELETE _curie_target FROM {{this}} AS _curie_target JOIN {{this}}__curie_stage AS _curie_stage ON ' + self.key_condition(unique_key, '_curie_target', '_curie_stage'),
+            'INSERT INTO {{this}} SELECT * FROM {{this}}__curie_stage',
+            'DROP TABLE {{this}}__curie_stage',
+        ]
         return {
-            'seed': lambda q: [q],
-            'replace': lambda q: ['DROP TABLE IF EXISTS {{this}}', 'CREATE TABLE {{this}} AS (' + q + ')'],
-            'truncate': lambda q: ['TRUNCATE TABLE {{this}}', 'INSERT INTO {{this}} (' + q + ')'],
+            'seed': lambda q, **kw: [q],
+            # RENAME TABLE swaps both names in one atomic statement
+            'replace': lambda q, **kw: [
+                'DROP TABLE IF EXISTS {{this}}__curie_stage',
+                'CREATE TABLE {{this}}__curie_stage AS (' + q + ')',
+                VALIDATE.format(table='{{this}}__curie_stage'),
+                'CREATE TABLE IF NOT EXISTS {{this}} LIKE {{this}}__curie_stage',
+                'DROP TABLE IF EXISTS {{this}}__curie_old',
+                'RENAME TABLE {{this}} TO {{this}}__curie_old, {{this}}__curie_stage TO {{this}}',
+                'DROP TABLE {{this}}__curie_old',
+            ],
+            'truncate': lambda q, **kw: ['TRUNCATE TABLE {{this}}', 'INSERT INTO {{this}} (' + q + ')'],
+            'append': lambda q, **kw: ['INSERT INTO {{this}} (' + q + ')'],
+            'merge': merge,
+            # Matches on unique_key like merge, the tables Curie builds have no index REPLACE INTO could rely on
+            'upsert': merge,
         }
     
-    def execute(self, query, **kwargs):
-        self.results_ = None
-        self.conn_ = self.connect()
-        self.conn_.autocommit = True
-        if self.conn_ is None:
-            return None
-        cursor = self.conn_.cursor()
+    def explain(self, query):
+        """
+        Estimates the cost and rows of a statement from its EXPLAIN FORMAT=JSON plan
+
+        Returns:
+            Dict[str, Any]: cost, rows, the plan and flags for risky operators
+        """
+        rez = self.execute('EXPLAIN FORMAT=JSON ' + query)
+        document = json.loads(rez.iloc[0, 0]) if rez is not None else {}
+        block = document.get('query_block', {})
+        tables = []
+        def walk(value):
+            if isinstance(value, dict):
+                if 'table_name' in value:
+                    tables.append(value)
+                for v in value.values():
+                    walk(v)
+            elif isinstance(value, list):
+                for v in value:
+                    walk(v)
+        walk(block)
+        flags = []
+        if any(t.get('access_type') == 'ALL' for t in tables):
+            flags.append('full scan')
+        if any('Nested Loop' in str(t.get('using_join_buffer', '')) for t in tables):
+            flags.append('nested loop')
+        cost = block.get('cost_info', {}).get('query_cost')
+        rows = tables[-1].get('rows_produced_per_join') if tables else None
+        plan = [f'{t["table_name"]}: {t.get("access_type")} rows={t.get("rows_examined_per_scan")}' for t in tables]
+        return {'cost': float(cost) if cost is not None else None, 'rows': float(rows) if rows is not None else None, 'plan': plan, 'flags': flags}
+
+    def test(self):
         try:
-            cursor.execute(query)
+            self.conn_ = self.connect()
+            self.conn_.close()
+            return True
         except Exception as e:
-            print(query)
-            raise e
-        # if 'store_results' in kwargs and kwargs['store_results']:
-        if cursor.description is not None:
-            rows = cursor.fetchall()
-            columns = [i[0] for i in cursor.description]
-            self.results_ = pd.DataFrame(rows, columns=columns)
-        cursor.close()
+            log.error(e)
+            return False  
+class SQLiteConnection:
+    """
+    Gives a sqlite3 connection the autocommit switch the warehouse drivers have
+    """
+    def __init__(self, conn):
+        self.conn_ = conn
+        self.autocommit = True
+
+    def cursor(self):
+        if not self.autocommit and not self.conn_.in_transaction:
+            # Take the write lock up front, concurrent nodes then wait for it instead of failing as busy
+            self.conn_.execute('BEGIN IMMEDIATE')
+        return self.conn_.cursor()
+
+    def commit(self):
+        self.conn_.commit()
+
+    def rollback(self):
+        self.conn_.rollback()
+
+    def close(self):
         self.conn_.close()
-        return self.results_
-    
+
+class SQLite(Database):
+    """
+    A local SQLite file, a stand-in for the warehouse when developing or testing a pipeline
+
+    Args:
+        database (str): Path to the database file, relative to the project root.
+    """
+    def __init__(self, database, host=None, port=None, user=None, password=None, **kwargs):
+        super().__init__(host, port, user, password, database, **kwargs)
+        if 'reminder' in kwargs:
+            self.reminder_ = kwargs['reminder']
+        delfrom = ['secrets', 'reminder', 'defer_import', 'profile', 'pool_size', 'pool_recycle', 'query_tags', 'max_concurrency', 'queries_per_second', 'burst', 'priorities']
+        for key in delfrom:
+            if key in self.kwargs_:
+                del self.kwargs_[key]
+        # Sample schemas, each a database file beside this one attached to every connection
+        self.attached_ = set()
+
+    def connect(self):
+        try:
+            conn = sqlite3.connect(ensure_rooting(self.database_), check_same_thread=False, isolation_level=None, **self.kwargs_)
+            for name in sorted(self.attached_):
+                conn.execute(f"ATTACH DATABASE '{os.path.splitext(ensure_rooting(self.database_))[0]}.{name}.sqlite' AS {name}")
+            self.conn_ = SQLiteConnection(conn)
+            return self.conn_
+        except Exception as e:
+            log.error("Error: Could not open SQLite database {}.".format(self.database_))
+            log.error(e)
+            return None
+
+    def __repr__(self):
+        return "SQLite(database={}, kwargs={})".format(self.database_, self.kwargs_)
+
+    current_schema = "'main'"
+    random_fraction = '((ABS(RANDOM()) % 1000000) / 1000000.0)'
+
+    def sample_schema(self, schema:str) -> str:
+        name = super().sample_schema(schema if schema else 'main')
+        if name not in self.attached_:
+            self.attached_.add(name)
+            # Pooled connections were opened without it
+            self.close_pool()
+        return name
+
+    def create_schema(self, schema:str) -> str:
+        # Attached on connect
+        return None
+
+    def table_exists(self, schema:str, name:str) -> bool:
+        master = f'{schema}.sqlite_master' if schema else 'sqlite_master'
+        rez = self.execute(f"SELECT COUNT(*) AS n FROM {master} WHERE type = 'table' AND LOWER(name) = '{name.lower()}'")
+        return rez is not None and int(rez.iloc[0, 0]) > 0
+
+    def column_types(self, schema:str, name:str) -> dict:
+        rez = self.execute(f"PRAGMA {schema + '.' if schema else ''}table_info('{name}')")
+        return {} if rez is None else dict((str(r['name']), str(r['type'])) for _, r in rez.iterrows())
+
+    def method_patterns(self):
+        merge = lambda q, unique_key=None, **kw: [
+            'DROP TABLE IF EXISTS {{this}}__curie_stage',
+            'CREATE TABLE {{this}}__curie_stage AS ' + q,
+            'DELETE FROM {{this}} WHERE EXISTS (SELECT 1 FROM {{this}}__curie_stage WHERE ' + self.key_condition(unique_key, '{{this}}', '{{this}}__curie_stage') + ')',
+            'INSERT INTO {{this}} SELECT * FROM {{this}}__curie_stage',
+            'DROP TABLE {{this}}__curie_stage',
+        ]
+        return {
+            'seed': lambda q, **kw: [q],
+            'replace': lambda q, table=None, **kw: [
+                'DROP TABLE IF EXISTS {{this}}__curie_stage',
+                'CREATE TABLE {{this}}__curie_stage AS ' + q,
+                VALIDATE.format(table='{{this}}__curie_stage'),
+                'DROP TABLE IF EXISTS {{this}}',
+                'ALTER TABLE {{this}}__curie_stage RENAME TO ' + table,
+            ],
+            'truncate': lambda q, **kw: ['DELETE FROM {{this}}', 'INSERT INTO {{this}} ' + q],
+            'append': lambda q, **kw: ['INSERT INTO {{this}} ' + q],
+            'merge': merge,
+            # Matches on unique_key like merge, the tables Curie builds have no index INSERT OR REPLACE could rely on
+            'upsert': merge,
+        }
+
+    def explain(self, query):
+        """
+        Reads a statement's EXPLAIN QUERY PLAN. SQLite does not estimate cost or rows, only the access paths are flagged.
+
+        Returns:
+            Dict[str, Any]: cost and rows (None), the plan lines and flags for risky operators
+        """
+        rez = self.execute('EXPLAIN QUERY PLAN ' + query)
+        plan = rez['detail'].astype(str).tolist() if rez is not None else []
+        scans = [line for line in plan if re.match(r'^SCAN (?!CONSTANT)', line) and 'INDEX' not in line]
+        flags = []
+        if scans:
+            flags.append('full scan')
+        # Joins are always loops here, a second full scan means it runs once per row of the first
+        if len(scans) > 1:
+            flags.append('nested loop')
+        if any('TEMP B-TREE' in line for line in plan):
+            flags.append('temp sort')
+        return {'cost': None, 'rows': None, 'plan': plan, 'flags': flags}
+
     def test(self):
         try:
             self.conn_ = self.connect()
@@ -211,4 +692,4 @@ class MySQL(Database):
             return True
         except Exception as e:
             log.error(e)
-            return False  
\ No newline at end of file
+            return False
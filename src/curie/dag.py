@@ -1,18 +1,38 @@
 from typing import List, Dict, Any
 import os
 from contextlib import suppress
+import hashlib
 import re
+import sys
+import threading
+import time
 from . import utils
-from .modes import Mode, save, run
+from .admission import waiting
+from .explain import describe_explain, explain
+from .graph import Graph
+from .lineage import analyze
+from .scheduler import DEFAULT_COST, Scheduler, describe_plan
+from .tracing import span, tags
+from .utils.paths import forget_dirs
+from .modes import Mode, save, run, python, test
 
 class Node:
+    # Projects hold thousands of nodes, slots keep each one to its definition
+    __slots__ = ('name', 'manifest', 'schema', 'fields', 'meta', 'definitions', 'modes')
+
     def __init__(self, name:str, manifest:str = None, schema:str = 'public', fields: List[Dict[str, Any]] = None, meta: Dict[str, Any] = None, mode_globals: Dict[str, Any] = None, defaults: Dict[str, Any] = None, **modes):
         self.fields = fields
         self.meta = meta
         self.manifest = manifest
-        self.schema = schema
-        self.modes = dict([(mode, globals()[mode](mode, **modes[mode], globs=mode_globals, defaults=defaults)) for mode in modes.keys()])
-        self.name = name
+        # Names and schemas repeat across nodes and dependency lists, one copy of each is kept
+        self.schema = sys.intern(schema) if isinstance(schema, str) else schema
+        self.definitions = modes
+        # Definitions with a callable are Python transforms, whichever mode they belong to
+        self.modes = dict([(mode, (python if 'callable' in modes[mode] else globals()[mode])(mode, **modes[mode], globs=mode_globals, defaults=defaults)) for mode in modes.keys()])
+        # Declared fields are checked in test mode, on the table the node builds and the files it saves
+        if fields and 'test' not in self.modes:
+            self.modes['test'] = test('test', fields=fields, table='run' in self.modes, files='save' in self.modes, globs=mode_globals, defaults=defaults)
+        self.name = sys.intern(name)
         
     def get_mode(self, name: str) -> Mode:
         """
@@ -112,9 +132,9 @@ class DAG:
                             queue.append(node)
 
         # A dependency is required if the node has a script or query
-        # Only keep nodes that have a script or query
+        # Only keep nodes that have a script or query, or fields to test
         # Validate all necessary dependencies are met for each node
-        queue = [node for node in queue if hasattr(self.nodes[node].get_mode(mode),'script') or hasattr(self.nodes[node].get_mode(mode),'query')]
+        queue = [node for node in queue if hasattr(self.nodes[node].get_mode(mode),'script') or hasattr(self.nodes[node].get_mode(mode),'query') or hasattr(self.nodes[node].get_mode(mode),'callable') or hasattr(self.nodes[node].get_mode(mode),'rules')]
         return queue
 
     def get_node(self, name: str) -> Node:
@@ -130,35 +150,149 @@ class DAG:
             compile_path (str): Path to the compiled DAG
             overrides (Dict[str, Any], optional): Arguments to override the defaults. Defaults to None.
             connection (Any, optional): Connection to use for the pipeline. Defaults to None.
+            full_refresh (bool, optional): Ignore incremental state and rebuild from scratch. Defaults to False.
+            sample (Dict[str, Any], optional): Compile a sample run, see Pipeline.sample. Defaults to None.
         """
+        full_refresh = kwargs.get('full_refresh', False)
+        sample = kwargs.get('sample')
+        # A sample run builds tables in sample schemas, and reads what it built there rather than the live tables
+        relocated = {}
+        if sample:
+            for name, n in self.nodes.items():
+                if getattr(n.get_mode(mode), 'materializes', False):
+                    relocated[f'{n.schema}.{name}'] = f'{connection.sample_schema(n.schema)}.{name}'
+
+        # Output directories may have been cleaned since the last compile
+        forget_dirs()
         # print(f'Compiling DAG in {mode} mode...')
         outputs = {}
         for node in self.infer_dag(mode):
             if mode in self.nodes[node].modes.keys():
                 schema = "public" if not hasattr(self.nodes[node],'schema') else self.nodes[node].schema
+                if sample and self.nodes[node].modes[mode].materializes:
+                    schema = connection.sample_schema(schema)
                 context = self.as_dict()
                 context.update(outputs)
-                self.nodes[node].modes[mode].compile(node, compile_path, overrides,schema=schema, context=context,connection=connection)
+                with tags(node=node), span('compile'):
+                    self.nodes[node].modes[mode].compile(node, compile_path, overrides,schema=schema, context=context,connection=connection, download_dir=download_dir, full_refresh=full_refresh, sample=sample, relocate=relocated)
                 if 'outputs' in self.nodes[node].modes[mode].__dict__ and self.nodes[node].modes[mode].outputs is not None:
                     # Run the script or query
                     try:
                          connection.test()
                     except:
                         raise Exception(f'Connection failed for node {node}. Active connection is required for compilation.')
-                    rez = self.nodes[node].modes[mode].execute(node=node, connection=connection, context=context, download_dir=download_dir)
+                    with tags(node=node), span('execute'):
+                        rez = self.nodes[node].modes[mode].execute(node=node, connection=connection, context=context, download_dir=download_dir)
                     for output in self.nodes[node].modes[mode].outputs:
                         if 'store_results' in self.nodes[node].modes[mode].__dict__ and self.nodes[node].modes[mode].store_results:
                             outputs[output] = rez[output].to_list()
                             
-    def execute(self, mode:str,start:str = None,tables:List=None, args: List[str] = None, connection:Any = None, download_dir:str='./data/Unknown/', kwargs: Dict[str, Any] = None):
+    def select(self, mode:str, start:str = None, tables:List = None) -> List[str]:
+        """
+        Returns the nodes an execution covers, in dependency order
+
+        Args:
+            mode (str): Mode to execute the DAG in
+            start (str, optional): Node to start at, '.' or 'all' for every node. Defaults to None.
+            tables (List, optional): Only run these nodes. Defaults to None.
+        """
+        if start is not None and start not in ['.','all']:
+            if start not in self.nodes:
+                raise Exception(f'Node {start} not found in DAG')
+            queue = self.infer_dag(mode)
+            queue = queue[queue.index(start):]
+        else:
+            queue = self.infer_dag(mode)
+        if tables is not None:
+            queue = [node for node in queue if node in tables]
+        return queue
+
+    def estimate_costs(self, mode:str, nodes:List[str], history:Any = None):
+        """
+        Estimates how long each node takes, from its run history, then its `cost` hint in meta
+
+        Nodes with neither are assumed to take the median of the known estimates.
+
+        Args:
+            mode (str): Mode to estimate in
+            nodes (List[str]): Nodes to estimate
+            history (RunRecorder, optional): Run history. Defaults to None.
+
+        Returns:
+            Tuple[Dict[str, float], Dict[str, str]]: Seconds per node and where each estimate came from
+        """
+        costs, sources = {}, {}
+        for node in nodes:
+            node_mode = self.nodes[node].get_mode(mode)
+            estimate = history.estimate(node) if history is not None else None
+            hint = None
+            for meta in [getattr(node_mode, 'meta', None), self.nodes[node].meta]:
+                if isinstance(meta, dict) and meta.get('cost') is not None:
+                    hint = float(meta['cost'])
+                    break
+            if estimate is not None:
+                costs[node], sources[node] = float(estimate), 'history'
+            elif hint is not None:
+                costs[node], sources[node] = hint, 'hint'
+        known = sorted(costs.values())
+        default = known[len(known) // 2] if known else DEFAULT_COST
+        for node in nodes:
+            if node not in costs:
+                costs[node], sources[node] = default, 'default'
+        return costs, sources
+
+    def scheduler(self, mode:str, nodes:List[str], history:Any = None, workers:int = 1) -> Scheduler:
+        dependencies = dict((node, list(getattr(self.nodes[node].get_mode(mode), 'depends_on', None) or [])) for node in nodes)
+        costs, _ = self.estimate_costs(mode, nodes, history)
+        return Scheduler(dependencies, costs, workers=workers)
+
+    def plan(self, mode:str, start:str = None, tables:List = None, history:Any = None, workers:int = 1) -> str:
+        """
+        Describes the order nodes would start in and the expected makespan, without executing anything
+
+        Args:
+            mode (str): Mode to plan
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only plan these nodes. Defaults to None.
+            history (RunRecorder, optional): Run history used for estimates. Defaults to None.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+        """
+        nodes = self.select(mode, start, tables)
+        _, sources = self.estimate_costs(mode, nodes, history)
+        return describe_plan(self.scheduler(mode, nodes, history, workers).plan(), sources)
+
+    def explain(self, mode:str, connection:Any, start:str = None, tables:List = None, workers:int = 4, threshold:float = None) -> str:
+        """
+        EXPLAINs the compiled statements of the selected nodes and ranks them by estimated cost
+
+        Args:
+            mode (str): Mode the DAG was compiled in
+            connection (Any): Connection whose dialect plans the statements
+            start (str, optional): Node to start at. Defaults to None.
+            tables (List, optional): Only explain these nodes. Defaults to None.
+            workers (int, optional): EXPLAINs in flight at once. Defaults to 4.
+            threshold (float, optional): Estimated cost that flags a statement. Defaults to None.
+        """
+        nodes = self.select(mode, start, tables)
+        return describe_explain(explain(self, mode, nodes, connection, workers=workers, threshold=threshold), threshold)
+
+    def execute(self, mode:str,start:str = None,tables:List=None, args: List[str] = None, connection:Any = None, download_dir:str='./data/Unknown/', kwargs: Dict[str, Any] = None, manifest:Any = None, history:Any = None, workers:int = 1, budget:Any = None):
         """
         Executes the DAG in the specified mode
 
+        Ready nodes start in order of their longest remaining downstream path, estimated from
+        the run history, so long chains are not held back behind short branches. A failed
+        node is run again up to its `retries` times.
+
         Args:
             mode (str): Mode to execute the DAG in
             args (List[str], optional): Arguments to override the defaults. Defaults to None.
             connection (Any, optional): Connection to use for the pipeline. Defaults to None.
             download_dir (str, optional): Path to download data to. Defaults to './data/Unknown/'.
+            manifest (Manifest, optional): Records each node that runs successfully. Defaults to None.
+            history (RunRecorder, optional): Run history, estimates are read from it and each node's metrics appended to it. Defaults to None.
+            workers (int, optional): Nodes run at the same time. Defaults to 1.
+            budget (threading.BoundedSemaphore, optional): Slots shared with the other runs of an invocation, see shared_budget. Defaults to None.
 
         Raises:
             Exception: If connection is not specified during execution
@@ -166,31 +300,78 @@ class DAG:
         """
         if not connection:
             raise Exception('Connection not specified during execution')
-        if start is not None and start not in ['.','all']:
-            if start not in self.nodes:
-                raise Exception(f'Node {start} not found in DAG')
-            if start == '.':
-                start = None
-            queue = self.infer_dag(mode)
-            queue = queue[queue.index(start):]
-        else:
-            queue = self.infer_dag(mode)
+        queue = self.select(mode, start, tables)
         outputs = {}
-        print(f'Executing DAG in {mode} mode')
-        if tables is not None:
-            queue = [node for node in queue if node in tables]
-        for node in queue:
+        lock = threading.Lock()
+        print(f'Executing DAG in {mode} mode' + (f' with {workers} workers' if workers > 1 else ''))
+
+        def run_node(node):
             print(f'\tWorking on {node}...')
             if mode in self.nodes[node].modes.keys():
-                rez = self.nodes[node].modes[mode].execute(node=node, connection=connection, context=outputs, download_dir=download_dir)
+                node_mode = self.nodes[node].modes[mode]
+                attempt = 0
+                with waiting() as queued:
+                    try:
+                        while True:
+                            node_mode.metrics = {'retries': attempt}
+                            try:
+                                with tags(node=node), span('execute', attempt=attempt):
+                                    rez = node_mode.execute(node=node, connection=connection, context=outputs, download_dir=download_dir)
+                                break
+                            except Exception as e:
+                                if attempt >= node_mode.retries:
+                                    raise e
+                                attempt += 1
+                                print(f'\t\t{node} failed ({e}), retry {attempt} of {node_mode.retries}...')
+                                time.sleep(node_mode.retry_delay)
+                    finally:
+                        # Time spent waiting for the connection profile's admission control, apart from query time
+                        node_mode.metrics['queue_seconds'] = queued[0]
+                if queued[0] >= 0.1:
+                    print(f'\t\t{node} queued {queued[0]:.1f}s for {connection.profile_ if getattr(connection, "profile_", None) else "the connection"}')
                 if 'outputs' in self.nodes[node].modes[mode].__dict__ and self.nodes[node].modes[mode].outputs is not None:
-                    for output in self.nodes[node].modes[mode].outputs:
-                        if output in outputs:
-                            raise Exception(f'Output {output} already exists in DAG. Please rename output.')
-                        if 'store_results' in self.nodes[node].modes[mode].__dict__ and self.nodes[node].modes[mode].store_results:
-                            outputs[node] = {output: rez[output].to_list()}
+                    with lock:
+                        for output in self.nodes[node].modes[mode].outputs:
+                            if output in outputs:
+                                raise Exception(f'Output {output} already exists in DAG. Please rename output.')
+                            if 'store_results' in self.nodes[node].modes[mode].__dict__ and self.nodes[node].modes[mode].store_results:
+                                outputs[node] = {output: rez[output].to_list()}
+                if manifest is not None:
+                    manifest.record(node)
+
+        def finished(node, seconds, status, error):
+            if history is None:
+                return None
+            node_mode = self.nodes[node].get_mode(mode)
+            metrics = getattr(node_mode, 'metrics', {}) if node_mode is not None else {}
+            sql = node_mode.compiled_sql() if node_mode is not None else []
+            sql_hash = hashlib.sha256('\n;\n'.join(sql).encode()).hexdigest()[:16] if sql else None
+            history.record(node, seconds, status, rows=metrics.get('rows'), bytes=metrics.get('bytes'), retries=metrics.get('retries', 0), queue_seconds=metrics.get('queue_seconds'), sql_hash=sql_hash, error=str(error) if error else None)
+
+        keep_going = any(getattr(self.nodes[node].get_mode(mode), 'keep_going', False) for node in queue)
+        self.scheduler(mode, queue, history, workers).run(run_node, finished, keep_going=keep_going, budget=budget)
         return None
 
+    def lint_dependencies(self, mode:str, apply:bool = False) -> Dict[str, Dict[str, List[str]]]:
+        """
+        Checks declared depends_on against the tables each node's compiled SQL reads
+
+        Args:
+            mode (str): Mode to check. The DAG must be compiled in this mode.
+            apply (bool, optional): Add missing dependencies to the DAG. Defaults to False.
+
+        Returns:
+            Dict[str, Dict[str, List[str]]]: Per node, its declared, inferred, missing and unnecessary dependencies
+        """
+        report = analyze(self, mode)
+        if apply:
+            for node in report:
+                if report[node]['missing']:
+                    node_mode = self.nodes[node].get_mode(mode)
+                    node_mode.depends_on = list(getattr(node_mode, 'depends_on', None) or []) + report[node]['missing']
+            self.detect_cycles(mode)
+        return report
+
     def extract_tree_structure(self, mode:str):
         """
         Extracts the tree structure of the DAG in the specified mode
@@ -198,22 +379,37 @@ class DAG:
         Args:
             mode (str): Mode to extract the tree structure in
         """
-        # Return a dictionary of nodes and their dependencies
+        # Return a dictionary of nodes and their dependencies, nodes without any are roots
         dependencies = {}
         for node in self.nodes:
-            with suppress(AttributeError):
-                dependencies[node] = self.nodes[node].get_mode(mode).depends_on
+            node_mode = self.nodes[node].get_mode(mode)
+            if node_mode is not None:
+                dependencies[node] = list(getattr(node_mode, 'depends_on', None) or [])
         return dependencies
 
-    def describe(self, mode:str):
+    def graph(self, mode:str, collapse:int = None) -> Graph:
+        """
+        Returns the DAG in the specified mode as a Graph for rendering
+
+        Args:
+            mode (str): Mode to graph
+            collapse (int, optional): Collapse fan in and fan out wider than this into summary nodes. Defaults to None.
+        """
+        graph = Graph(self.extract_tree_structure(mode))
+        return graph.collapse(collapse) if collapse else graph
+
+    def describe(self, mode:str, format:str = 'mermaid', collapse:int = None):
         """
-        Describes the DAG in the specified mode using mermaid syntax
+        Describes the DAG in the specified mode using mermaid syntax, or as DOT or JSON
 
         Args:
             mode (str): Mode to describe the DAG in
+            format (str, optional): mermaid, dot or json. Defaults to 'mermaid'.
+            collapse (int, optional): Collapse fan in and fan out wider than this into summary nodes. Defaults to None.
         """
-        # Print DAG in a human-readable format (mermaid syntax?)
-        return Mermaid(self, mode)
+        if format != 'mermaid':
+            return self.graph(mode, collapse).render(format, name=mode)
+        return Mermaid(self, mode, collapse)
     
     def document(self, mode:str):
         dargs = {
@@ -243,29 +439,15 @@ class Mermaid:
             B --> C
             C --> [*]
     """
-    def __init__(self, dag:DAG, mode:str):
-        self.tree = dag.extract_tree_structure(mode)   
+    def __init__(self, dag:DAG, mode:str, collapse:int = None):
+        self.tree = dag.extract_tree_structure(mode)
+        self.collapse = collapse
         self.mermaid = None
         self.write()
 
     def write(self):
-        self.mermaid = 'stateDiagram-v2\n'
-        # Dependencies are parents, nodes are children
-        for node in self.tree:
-            for dependency in self.tree[node]:
-                self.mermaid += f'{dependency} --> {node}\n'
-        self.mermaid += '\n'
-        # Add nodes that have no dependencies (root nodes)
-        for node in self.tree:
-            if self.tree[node] == []:
-                self.mermaid += f'[*] --> {node}\n'
-        # Add nodes that have no children (leaf nodes)
-        for node in self.tree:
-            if node not in [child for parent in self.tree for child in self.tree[parent]]:
-                self.mermaid += f'{node} --> [*]\n'
-        self.mermaid += '\n'
-        # Remove unnecessary whitespace
-        self.mermaid = re.sub(r'\n\s*\n', '\n', self.mermaid)
+        graph = Graph(self.tree)
+        self.mermaid = (graph.collapse(self.collapse) if self.collapse else graph).mermaid()
 
     def __repr__(self):
         return self.mermaid
@@ -7,8 +7,13 @@ from .utils.docs import Documentation
 def generate_docs(args):
     print("Generating docs")
     try:
-        subprocess.run(["mkdocs", "build", "--config-file", "docs-settings.yaml"])
-        docs = Documentation()
+        full = getattr(args, 'full', False)
+        docs = Documentation(full=full, workers=getattr(args, 'workers', None))
+        # Pages are rendered first so mkdocs builds what changed; --dirty only rebuilds changed markdown
+        build = ["mkdocs", "build", "--config-file", "docs-settings.yaml"]
+        if not full:
+            build.append("--dirty")
+        subprocess.run(build)
     except Exception as e:
         log.error("Error building docs: ", e.with_traceback())
 
@@ -0,0 +1,99 @@
+from typing import Any, Dict, List
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlparse
+
+from .tracing import wrap
+from .utils.sql import split_statements
+
+# Statements EXPLAIN accepts in every supported dialect
+EXPLAINABLE = re.compile(r'^(select|with|insert|update|delete|replace)\b', re.IGNORECASE)
+# CREATE TABLE ... AS <query>, the query is what gets explained
+CTAS = re.compile(r'^create\s+(?:temp(?:orary)?\s+)?table\s+(?:if\s+not\s+exists\s+)?\S+\s+as\s+(.*)$', re.IGNORECASE | re.DOTALL)
+
+def explainable(statement:str) -> str:
+    """
+    Returns the part of a statement to EXPLAIN, or None when it reads no data
+
+    DDL around a build (drops, renames) is skipped, as are statements reading a node's own
+    staging tables, which only exist while the node runs.
+    """
+    statement = sqlparse.format(statement, strip_comments=True).strip()
+    ctas = CTAS.match(statement)
+    if ctas:
+        statement = ctas[1].strip()
+        if statement.startswith('(') and statement.endswith(')'):
+            statement = statement[1:-1].strip()
+    if not EXPLAINABLE.match(statement) or '__curie_' in statement:
+        return None
+    return statement
+
+def statements(dag:Any, mode:str, nodes:List[str]) -> List[Dict[str, Any]]:
+    """
+    Lists the explainable statements of each compiled node
+    """
+    found = []
+    for node in nodes:
+        node_mode = dag.nodes[node].get_mode(mode)
+        if node_mode is None:
+            continue
+        for script in node_mode.compiled_sql():
+            for statement in split_statements(script):
+                query = explainable(statement)
+                if query is not None:
+                    found.append({'node': node, 'query': query})
+    return found
+
+def explain(dag:Any, mode:str, nodes:List[str], connection:Any, workers:int = 4, threshold:float = None) -> List[Dict[str, Any]]:
+    """
+    EXPLAINs every compiled statement concurrently and ranks them by estimated cost
+
+    A statement is flagged when its plan has a risky operator (nested loop, full scan,
+    broadcast, ...) or its estimated cost reaches the threshold. Statements that cannot be
+    explained yet, e.g. because they read a table an upstream node has not built, are
+    reported with their error.
+
+    Args:
+        dag (DAG): A compiled DAG.
+        mode (str): Mode the DAG was compiled in.
+        nodes (List[str]): Nodes to explain.
+        connection (Database): Connection whose dialect plans the statements.
+        workers (int, optional): EXPLAINs in flight at once. Defaults to 4.
+        threshold (float, optional): Estimated cost that flags a statement. Defaults to None.
+
+    Returns:
+        List[Dict[str, Any]]: One entry per statement, most expensive first
+    """
+    def plan(entry):
+        try:
+            entry.update(connection.explain(entry['query']))
+        except Exception as e:
+            entry.update({'cost': None, 'rows': None, 'plan': [], 'flags': [], 'error': str(e).splitlines()[0] if str(e) else type(e).__name__})
+        entry['flagged'] = bool(entry['flags']) or (threshold is not None and entry['cost'] is not None and entry['cost'] >= threshold)
+        return entry
+
+    entries = statements(dag, mode, nodes)
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        report = list(pool.map(wrap(plan), entries))
+    return sorted(report, key=lambda e: (e['cost'] is None, -(e['cost'] or 0), not e['flagged'], e['node']))
+
+def describe_explain(report:List[Dict[str, Any]], threshold:float = None) -> str:
+    """
+    Renders an explain report as a table
+    """
+    if not report:
+        return 'No statements to explain.'
+    number = lambda v: '-' if v is None else f'{v:,.0f}'
+    lines = [f'{"cost":>14} {"rows":>14}  {"node":<30} flags']
+    for entry in report:
+        note = ', '.join(entry['flags']) if entry['flags'] else ''
+        if entry['flagged'] and not entry['flags']:
+            note = f'cost above {threshold:,.0f}'
+        if entry.get('error'):
+            note = f'not explained: {entry["error"]}'
+        lines.append(f'{number(entry["cost"]):>14} {number(entry["rows"]):>14}  {entry["node"]:<30} {("! " if entry["flagged"] else "") + note}')
+    flagged = sorted(set(e['node'] for e in report if e['flagged']))
+    lines.append('')
+    lines.append(f'{len(flagged)} node(s) flagged: {", ".join(flagged)}' if flagged else 'No node flagged.')
+    return '\n'.join(lines)
@@ -0,0 +1,139 @@
+from typing import Any, Dict, List
+import json
+import re
+
+# Formats Graph.render writes
+FORMATS = ['mermaid', 'dot', 'json']
+
+class Graph:
+    """
+    A DAG as nodes and edges, rendered to Mermaid, DOT or JSON in time linear in its size
+
+    Args:
+        tree (Dict[str, List[str]]): Each node's dependencies, as DAG.extract_tree_structure returns them.
+        labels (Dict[str, str], optional): Display names, e.g. of summary nodes. Defaults to None.
+    """
+    def __init__(self, tree:Dict[str, List[str]], labels:Dict[str, str] = None):
+        self.tree = tree
+        self.labels = labels if labels else {}
+        nodes = dict((node, None) for node in tree)
+        self.edges = []
+        for node, dependencies in tree.items():
+            for dependency in dependencies or []:
+                nodes.setdefault(dependency, None)
+                self.edges.append((dependency, node))
+        self.nodes = list(nodes)
+
+    def roots(self) -> List[str]:
+        children = set(child for _, child in self.edges)
+        return [node for node in self.nodes if node not in children]
+
+    def leaves(self) -> List[str]:
+        parents = set(parent for parent, _ in self.edges)
+        return [node for node in self.nodes if node not in parents]
+
+    def collapse(self, limit:int) -> 'Graph':
+        """
+        Returns a copy where a node with more than `limit` dependencies or dependents keeps
+        `limit - 1` of them and one summary node stands in for the rest. Nodes left without
+        any edge are represented by the summaries and left out.
+        """
+        limit = max(2, int(limit))
+        labels = dict(self.labels)
+        incoming = {}
+        for parent, child in self.edges:
+            incoming.setdefault(child, []).append(parent)
+        edges = []
+        for child, parents in incoming.items():
+            if len(parents) > limit:
+                summary = f'{child}__more_in'
+                labels[summary] = f'{len(parents) - limit + 1} more'
+                parents = parents[:limit - 1] + [summary]
+            edges += [(parent, child) for parent in parents]
+        outgoing = {}
+        for parent, child in edges:
+            outgoing.setdefault(parent, []).append(child)
+        edges = []
+        for parent, children in outgoing.items():
+            if len(children) > limit:
+                summary = f'{parent}__more_out'
+                labels[summary] = f'{len(children) - limit + 1} more'
+                children = children[:limit - 1] + [summary]
+            edges += [(parent, child) for child in children]
+        connected = set(node for edge in edges for node in edge)
+        had_edges = set(node for edge in self.edges for node in edge)
+        tree = dict((node, []) for node in self.nodes if node in connected or node not in had_edges)
+        for parent, child in edges:
+            tree.setdefault(parent, [])
+            tree.setdefault(child, []).append(parent)
+        return Graph(tree, labels)
+
+    def label(self, node:str) -> str:
+        return self.labels.get(node, node)
+
+    def mermaid(self) -> str:
+        """
+        Mermaid state diagram, roots start at [*] and leaves end there
+        """
+        lines = ['stateDiagram-v2']
+        lines += [f'{mermaid_id(parent)} --> {mermaid_id(child)}' for parent, child in self.edges]
+        lines += [f'state "{self.label(node)}" as {mermaid_id(node)}' for node in self.labels if node in self.tree]
+        lines += [f'[*] --> {mermaid_id(node)}' for node in self.roots()]
+        lines += [f'{mermaid_id(node)} --> [*]' for node in self.leaves()]
+        return '\n'.join(lines) + '\n'
+
+    def dot(self, name:str = 'curie') -> str:
+        """
+        Graphviz digraph, dependencies point at their dependents
+        """
+        lines = [f'digraph {dot_id(name)} {{', '    rankdir=LR;', '    node [shape=box];']
+        lines += [f'    {dot_id(node)} [label={dot_id(self.label(node))}{", style=dashed" if node in self.labels else ""}];' for node in self.nodes]
+        lines += [f'    {dot_id(parent)} -> {dot_id(child)};' for parent, child in self.edges]
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def json(self) -> str:
+        """
+        Nodes and edges as JSON, summary nodes carry their label
+        """
+        return json.dumps({
+            'nodes': [dict([('id', node)] + ([('label', self.labels[node])] if node in self.labels else [])) for node in self.nodes],
+            'edges': [{'from': parent, 'to': child} for parent, child in self.edges],
+        }, indent=1)
+
+    def render(self, format:str = 'mermaid', name:str = 'curie') -> str:
+        if format not in FORMATS:
+            raise ValueError(f'Unknown graph format {format}. Use one of: {", ".join(FORMATS)}.')
+        return self.dot(name) if format == 'dot' else self.json() if format == 'json' else self.mermaid()
+
+def mermaid_id(node:str) -> str:
+    return re.sub(r'[^\w]', '_', node)
+
+def dot_id(node:str) -> str:
+    return '"' + str(node).replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def flowchart(etl:Dict[str, Any], mode:str, collapse:int = None) -> str:
+    """
+    Body of the Mermaid flowchart a pipeline's documentation page shows for a mode
+
+    Reads the blueprint's etl section: an edge per dependency, roots drawn with their name
+    (and an atom when they have variants), and dotted links keeping nodes in file order
+    unless the pipeline has more nodes than `collapse`, which then also collapses fan in and out.
+    """
+    definitions = dict((node, etl[node][mode]) for node in etl if isinstance(etl[node], dict) and isinstance(etl[node].get(mode), dict))
+    tree = dict((node, list(definition.get('depends_on') or [])) for node, definition in definitions.items())
+    large = collapse is not None and len(tree) > int(collapse)
+    graph = Graph(tree).collapse(collapse) if large else Graph(tree)
+    lines = []
+    for node, dependencies in graph.tree.items():
+        lines += [f'    {mermaid_id(d)} --> {mermaid_id(node)}' for d in dependencies]
+        if not dependencies:
+            atom = ' fa:fa-atom' if 'variants' in definitions.get(node, {}) else ''
+            lines.append(f'{mermaid_id(node)}({graph.label(node)}{atom})')
+    for node, label in graph.labels.items():
+        if node in graph.tree and graph.tree[node]:
+            lines.append(f'{mermaid_id(node)}[{label}]')
+    if not large:
+        nodes = list(graph.tree)
+        lines += [f'{prior} .-> {node}' for prior, node in zip(nodes[:-1], nodes[1:])]
+    return '\n'.join(lines)
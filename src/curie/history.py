@@ -0,0 +1,231 @@
+from typing import Any, Dict, List
+import datetime
+import os
+import sqlite3
+import statistics
+import threading
+import uuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,
+    pipeline TEXT,
+    mode TEXT,
+    profile TEXT,
+    workers INTEGER,
+    started_at TEXT,
+    finished_at TEXT,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS node_runs (
+    run_id TEXT,
+    pipeline TEXT,
+    mode TEXT,
+    profile TEXT,
+    node TEXT,
+    finished_at TEXT,
+    seconds REAL,
+    status TEXT,
+    rows INTEGER,
+    bytes INTEGER,
+    retries INTEGER,
+    sql_hash TEXT,
+    error TEXT,
+    queue_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS node_runs_lookup ON node_runs (pipeline, mode, profile, node, finished_at);
+"""
+
+# Successful runs an estimate is the median of
+ESTIMATE_WINDOW = 5
+# Columns added since the first release, added to older history databases when they are opened
+MIGRATIONS = {'node_runs': [('queue_seconds', 'REAL')]}
+
+class History:
+    """
+    A local SQLite store of every run and the metrics of each node it ran
+
+    Args:
+        path (str): Path to the database, created on first use.
+    """
+    def __init__(self, path:str):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        for table, columns in MIGRATIONS.items():
+            existing = [row[1] for row in self.conn.execute(f'PRAGMA table_info({table})').fetchall()]
+            for column, kind in columns:
+                if column not in existing:
+                    self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {kind}')
+        self.lock = threading.Lock()
+
+    def write(self, query:str, params:tuple):
+        with self.lock:
+            self.conn.execute(query, params)
+            self.conn.commit()
+
+    def read(self, query:str, params:tuple) -> List[Any]:
+        with self.lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def start(self, pipeline:str, mode:str, profile:str, workers:int = 1, run_id:str = None) -> 'RunRecorder':
+        """
+        Opens a run and returns the recorder its nodes report to
+        """
+        run = RunRecorder(self, run_id if run_id else uuid.uuid4().hex, pipeline, mode, profile if profile else 'default')
+        self.write('INSERT INTO runs (run_id, pipeline, mode, profile, workers, started_at, status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (run.run_id, pipeline, mode, run.profile, workers, now(), 'running'))
+        return run
+
+    def node_runs(self, pipeline:str, mode:str = None, node:str = None, since:str = None) -> List[Dict[str, Any]]:
+        """
+        Returns node runs oldest first, optionally for one mode, node or since an ISO timestamp
+        """
+        query = 'SELECT * FROM node_runs WHERE pipeline = ?'
+        params = [pipeline]
+        for column, value in [('mode', mode), ('node', node)]:
+            if value is not None:
+                query += f' AND {column} = ?'
+                params.append(value)
+        if since is not None:
+            query += ' AND finished_at >= ?'
+            params.append(since)
+        with self.lock:
+            cursor = self.conn.execute(query + ' ORDER BY finished_at, rowid', tuple(params))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class RunRecorder:
+    """
+    Records the nodes of one run and estimates their durations from earlier runs
+
+    Estimates are the median of the last few successful runs of the node with the same mode
+    and connection profile, so one slow night does not reorder the next build.
+    """
+    def __init__(self, history:History, run_id:str, pipeline:str, mode:str, profile:str):
+        self.history = history
+        self.run_id = run_id
+        self.pipeline = pipeline
+        self.mode = mode
+        self.profile = profile
+        self.estimates = {}
+
+    def estimate(self, node:str) -> float:
+        """
+        Returns the expected duration of a node in seconds, or None without history
+        """
+        if node not in self.estimates:
+            # Time queued for admission depends on what else ran, it is left out of the estimate
+            rows = self.history.read('SELECT seconds - COALESCE(queue_seconds, 0) FROM node_runs WHERE pipeline = ? AND mode = ? AND profile = ? AND node = ? AND status = ? ORDER BY finished_at DESC, rowid DESC LIMIT ?',
+                                     (self.pipeline, self.mode, self.profile, node, 'success', ESTIMATE_WINDOW))
+            self.estimates[node] = statistics.median([r[0] for r in rows]) if rows else None
+        return self.estimates[node]
+
+    def record(self, node:str, seconds:float, status:str = 'success', rows:int = None, bytes:int = None, retries:int = 0, sql_hash:str = None, error:str = None, queue_seconds:float = None):
+        """
+        Appends a node's metrics to the history. seconds is the node's wall time, queue_seconds the part of it spent waiting for admission.
+        """
+        self.history.write('INSERT INTO node_runs (run_id, pipeline, mode, profile, node, finished_at, seconds, status, rows, bytes, retries, sql_hash, error, queue_seconds) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (self.run_id, self.pipeline, self.mode, self.profile, node, now(), round(seconds, 3), status, rows, bytes, retries, sql_hash, error[:2000] if error else None, round(queue_seconds, 3) if queue_seconds is not None else None))
+
+    def finish(self, status:str):
+        self.history.write('UPDATE runs SET finished_at = ?, status = ? WHERE run_id = ?', (now(), status, self.run_id))
+
+def now() -> str:
+    return datetime.datetime.now().isoformat(timespec='microseconds')
+
+def percentile(values:List[float], q:float) -> float:
+    """
+    Linear-interpolated percentile, q in [0, 100]
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q / 100
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def sparkline(values:List[float]) -> str:
+    bars = '▁▂▃▄▅▆▇█'
+    if not values:
+        return ''
+    lo, hi = min(values), max(values)
+    return ''.join(bars[0 if hi == lo else int((v - lo) / (hi - lo) * (len(bars) - 1))] for v in values)
+
+def stats(history:History, pipeline:str, mode:str = None, node:str = None, days:int = 30, baseline:int = 10, threshold:float = 2.0) -> List[Dict[str, Any]]:
+    """
+    Summarizes each node's recent successful runs and compares the latest with its baseline
+
+    The baseline is the median duration of up to `baseline` successful runs before the latest.
+    A node regressed when its latest run took at least `threshold` times the baseline.
+
+    Args:
+        history (History): The run history.
+        pipeline (str): Pipeline to report on.
+        mode (str, optional): Only this mode. Defaults to every mode.
+        node (str, optional): Only this node. Defaults to every node.
+        days (int, optional): Runs older than this many days are ignored. Defaults to 30.
+        baseline (int, optional): Runs the baseline is taken over. Defaults to 10.
+        threshold (float, optional): Slowdown that counts as a regression. Defaults to 2.0.
+
+    Returns:
+        List[Dict[str, Any]]: One summary per node and mode, regressions first
+    """
+    since = (datetime.datetime.now() - datetime.timedelta(days=days)).isoformat(timespec='seconds')
+    groups = {}
+    for run in history.node_runs(pipeline, mode=mode, node=node, since=since):
+        groups.setdefault((run['mode'], run['node']), []).append(run)
+    report = []
+    # Durations leave out time queued for admission, a busy warehouse is not a slower node
+    work = lambda r: max(0.0, r['seconds'] - (r.get('queue_seconds') or 0))
+    for (run_mode, run_node), runs in groups.items():
+        succeeded = [r for r in runs if r['status'] == 'success']
+        durations = [work(r) for r in succeeded]
+        latest = succeeded[-1] if succeeded else None
+        prior = succeeded[:-1][-baseline:]
+        reference = statistics.median([work(r) for r in prior]) if prior else None
+        ratio = work(latest) / reference if latest and reference else None
+        report.append({
+            'mode': run_mode,
+            'node': run_node,
+            'runs': len(runs),
+            'failures': len(runs) - len(succeeded),
+            'p50': percentile(durations, 50),
+            'p90': percentile(durations, 90),
+            'p95': percentile(durations, 95),
+            'latest': work(latest) if latest else None,
+            'baseline': reference,
+            'ratio': ratio,
+            'regressed': ratio is not None and ratio >= threshold,
+            'sql_changed': bool(latest and prior and latest['sql_hash'] != prior[-1]['sql_hash']),
+            'rows': latest['rows'] if latest else None,
+            'bytes': latest['bytes'] if latest else None,
+            'retries': sum(r['retries'] or 0 for r in runs),
+            'queue': latest.get('queue_seconds') if latest else None,
+            'trend': sparkline(durations[-20:]),
+        })
+    return sorted(report, key=lambda r: (not r['regressed'], -(r['ratio'] or 0), r['mode'], r['node']))
+
+def describe_stats(report:List[Dict[str, Any]], threshold:float = 2.0) -> str:
+    """
+    Renders a stats report as a table
+    """
+    if not report:
+        return 'No runs recorded.'
+    seconds = lambda v: '-' if v is None else f'{v:.1f}s'
+    lines = [f'{"node":<30} {"mode":<6} {"runs":>5} {"fail":>5} {"p50":>8} {"p90":>8} {"p95":>8} {"latest":>8} {"queued":>8} {"base":>8} {"x":>6}  trend']
+    for r in report:
+        flag = ' REGRESSED' if r['regressed'] else ''
+        flag += ' (sql changed)' if r['regressed'] and r['sql_changed'] else ''
+        ratio = '-' if r['ratio'] is None else f'{r["ratio"]:.1f}'
+        lines.append(f'{r["node"]:<30} {r["mode"]:<6} {r["runs"]:>5} {r["failures"]:>5} {seconds(r["p50"]):>8} {seconds(r["p90"]):>8} {seconds(r["p95"]):>8} {seconds(r["latest"]):>8} {seconds(r["queue"]):>8} {seconds(r["baseline"]):>8} {ratio:>6}  {r["trend"]}{flag}')
+    regressed = sum(1 for r in report if r['regressed'])
+    lines.append('')
+    lines.append(f'{regressed} node(s) at least {threshold:g}x slower than their baseline.' if regressed else f'No node is {threshold:g}x slower than its baseline.')
+    return '\n'.join(lines)
@@ -0,0 +1,134 @@
+from typing import Any, Dict, List, Set
+import re
+
+import sqlparse
+from sqlparse import tokens as T
+
+# Keywords after which a list of tables is read
+READS = ['FROM', 'USING']
+# Keywords that may sit between FROM and the table name
+SKIP = ['ONLY', 'LATERAL']
+# Suffixes Curie adds to a node's own staging tables
+INTERNAL = re.compile(r'(__curie_stage|__curie_old)$')
+
+def _name(token) -> str:
+    return token.value.strip('"`[]').lower()
+
+def references(sql:str) -> Set[str]:
+    """
+    Finds the tables a SQL script reads from
+
+    Tables created inside the script itself (CTEs, CREATE TABLE) are not references.
+    Names are lowercased and keep their schema qualifier when one was written.
+
+    Args:
+        sql (str): Rendered SQL, one or more statements.
+
+    Returns:
+        Set[str]: Referenced table names, e.g. {'public.orders', 'items'}
+    """
+    reads, defined = set(), set()
+    for statement in sqlparse.parse(sql):
+        tokens = [t for t in statement.flatten() if not t.is_whitespace and t.ttype not in T.Comment]
+        state, parts = None, []
+        for i, token in enumerate(tokens):
+            value = token.normalized.upper() if token.ttype in T.Keyword else token.value
+            # Names defined locally: WITH name AS (...), CREATE [TEMP] TABLE [IF NOT EXISTS] name
+            if token.ttype in (T.Name, T.Literal.String.Symbol) and i + 2 < len(tokens) and tokens[i + 1].normalized.upper() == 'AS' and tokens[i + 2].value == '(':
+                defined.add(_name(token))
+            if value == 'TABLE' and i > 0 and tokens[i - 1].ttype in T.Keyword and tokens[i - 1].normalized.upper() in ['CREATE', 'TEMP', 'TEMPORARY']:
+                j = i + 1
+                while j < len(tokens) and tokens[j].normalized.upper() in ['IF', 'NOT', 'EXISTS']:
+                    j += 1
+                k, name = j, []
+                while k < len(tokens) and (tokens[k].ttype in (T.Name, T.Literal.String.Symbol, T.Keyword) or tokens[k].value == '.'):
+                    if tokens[k].value != '.':
+                        name.append(_name(tokens[k]))
+                    if k + 1 < len(tokens) and tokens[k + 1].value == '.':
+                        k += 2
+                        continue
+                    break
+                if name:
+                    defined.add('.'.join(name))
+
+            if state == 'table':
+                after_dot = i > 0 and tokens[i - 1].value == '.'
+                if token.value == '.' and parts:
+                    continue
+                if not parts and token.ttype in T.Keyword and value in SKIP:
+                    continue
+                # Table names may collide with keywords (e.g. data), so a bare keyword is accepted as a name
+                if (token.ttype in (T.Name, T.Literal.String.Symbol) or token.ttype == T.Keyword) and (not parts or after_dot):
+                    parts.append(_name(token))
+                    continue
+                if parts:
+                    reads.add('.'.join(parts))
+                    if token.ttype in (T.Name, T.Literal.String.Symbol) or value == 'AS':
+                        state, parts = 'alias', []
+                        continue
+                    if token.value == ',':
+                        state, parts = 'table', []
+                        continue
+                state, parts = None, []
+            elif state == 'alias':
+                if token.value == ',':
+                    state = 'table'
+                    continue
+                if token.ttype in (T.Name, T.Literal.String.Symbol):
+                    continue
+                state = None
+            if token.ttype in T.Keyword and (value in READS or value.endswith('JOIN')):
+                state, parts = 'table', []
+        if state == 'table' and parts:
+            reads.add('.'.join(parts))
+    return set(r for r in reads if r not in defined and r.split('.')[-1] not in defined)
+
+def analyze(dag:Any, mode:str) -> Dict[str, Dict[str, List[str]]]:
+    """
+    Compares each node's declared depends_on with the tables its compiled SQL reads
+
+    A reference becomes an edge when it names a node that materializes a table in this mode,
+    either as schema.node or as a bare node name. Declared dependencies that provide outputs
+    to the template context are never reported as unnecessary.
+
+    Args:
+        dag (DAG): A compiled DAG.
+        mode (str): Mode to analyze.
+
+    Returns:
+        Dict[str, Dict[str, List[str]]]: Per node, its declared, inferred, missing and unnecessary dependencies
+    """
+    qualified, bare = {}, {}
+    for name, node in dag.nodes.items():
+        node_mode = node.get_mode(mode)
+        if node_mode is None or not node_mode.materializes:
+            continue
+        schema = node.schema if node.schema else ''
+        qualified[f'{schema}.{name}'.lower() if schema else name.lower()] = name
+        bare.setdefault(name.lower(), []).append(name)
+
+    report = {}
+    for name, node in dag.nodes.items():
+        node_mode = node.get_mode(mode)
+        if node_mode is None or not node_mode.materializes:
+            continue
+        inferred = set()
+        for sql in node_mode.compiled_sql():
+            for ref in references(sql):
+                ref = INTERNAL.sub('', ref)
+                if ref.split('.')[-1].startswith('_curie'):
+                    continue
+                if ref in qualified:
+                    inferred.add(qualified[ref])
+                elif '.' not in ref and len(bare.get(ref, [])) == 1:
+                    inferred.add(bare[ref][0])
+        inferred.discard(name)
+        declared = list(getattr(node_mode, 'depends_on', None) or [])
+        providers = [d for d in declared if d in dag.nodes and dag.nodes[d].get_mode(mode) is not None and getattr(dag.nodes[d].get_mode(mode), 'outputs', None)]
+        report[name] = {
+            'declared': declared,
+            'inferred': sorted(inferred),
+            'missing': sorted(inferred - set(declared)),
+            'unnecessary': sorted(set(declared) - inferred - set(providers)),
+        }
+    return report
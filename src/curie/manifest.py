@@ -0,0 +1,125 @@
+from typing import Any, Dict, List, Set
+import datetime
+import hashlib
+import json
+import os
+import threading
+
+import jinja2
+from jinja2 import meta
+
+from .utils.datasets import callable_path
+from .utils.paths import ensure_rooting
+from .utils.state import read_json, write_json
+
+def _strings(value:Any) -> List[str]:
+    """
+    Collects every string inside a node definition, these are the templates it may render
+    """
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict):
+        return [s for v in value.values() for s in _strings(v)]
+    if isinstance(value, (list, tuple)):
+        return [s for v in value for s in _strings(v)]
+    return []
+
+def _referenced(templates:List[str], arguments:Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Returns the pipeline arguments the templates use, or all of them if a template cannot be parsed
+    """
+    env = jinja2.Environment()
+    names = set()
+    for template in templates:
+        try:
+            names |= meta.find_undeclared_variables(env.parse(template))
+        except jinja2.TemplateError:
+            return dict(arguments)
+    return dict((k, arguments[k]) for k in sorted(names) if k in arguments)
+
+def fingerprints(dag:Any, mode:str, arguments:Dict[str, Any] = None) -> Dict[str, str]:
+    """
+    Fingerprints each node's definition in the specified mode
+
+    A fingerprint covers the mode's definition (script text or transform source, query, method and options),
+    the node's schema, the pipeline arguments its templates use and the fingerprints of
+    its dependencies, so a change to a node also changes every node downstream of it.
+
+    Args:
+        dag (DAG): The pipeline's DAG.
+        mode (str): Mode to fingerprint.
+        arguments (Dict[str, Any], optional): Pipeline arguments, including overrides. Defaults to None.
+
+    Returns:
+        Dict[str, str]: Node name to sha256 hex digest
+    """
+    arguments = arguments if arguments else {}
+    prints = {}
+    for node in dag.infer_dag(mode):
+        definition = dag.nodes[node].definitions.get(mode)
+        if definition is None:
+            continue
+        templates = _strings(definition)
+        script = None
+        if definition.get('script'):
+            try:
+                with open(ensure_rooting(definition['script']), 'r') as f:
+                    script = f.read()
+                templates.append(script)
+            except FileNotFoundError:
+                pass
+        # A Python transform changes with the source of the module defining it
+        source = callable_path(definition['callable'], ensure_rooting('.')) if definition.get('callable') else None
+        if source and os.path.isfile(source):
+            with open(source, 'r') as f:
+                script = f.read()
+        payload = {
+            'schema': dag.nodes[node].schema,
+            'definition': definition,
+            'script': script,
+            'arguments': _referenced(templates, arguments),
+            'upstream': dict((dep, prints.get(dep)) for dep in sorted(definition.get('depends_on') or [])),
+        }
+        prints[node] = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+    return prints
+
+class Manifest:
+    """
+    Fingerprints of the nodes that last ran successfully, per mode and connection profile
+
+    Args:
+        path (str): Path to the manifest file.
+        mode (str): Mode being executed.
+        profile (str): Connection profile being executed against.
+        fingerprints (Dict[str, str]): Current fingerprints of the nodes.
+    """
+    def __init__(self, path:str, mode:str, profile:str, fingerprints:Dict[str, str]):
+        self.path = path
+        self.mode = mode
+        self.profile = profile if profile else 'default'
+        self.fingerprints = fingerprints
+        self.data = read_json(path, {})
+        self.lock = threading.Lock()
+
+    def recorded(self) -> Dict[str, Any]:
+        return self.data.get(self.mode, {}).get(self.profile, {})
+
+    def modified(self) -> Set[str]:
+        """
+        Returns the nodes whose definition, or an upstream definition, changed since their last successful run
+        """
+        recorded = self.recorded()
+        return set(node for node, fingerprint in self.fingerprints.items() if recorded.get(node, {}).get('fingerprint') != fingerprint)
+
+    def record(self, node:str):
+        """
+        Stores a node's current fingerprint after it ran successfully
+        """
+        if node not in self.fingerprints:
+            return
+        with self.lock:
+            self.data.setdefault(self.mode, {}).setdefault(self.profile, {})[node] = {
+                'fingerprint': self.fingerprints[node],
+                'updated_at': datetime.datetime.now().isoformat(),
+            }
+            write_json(self.path, self.data)
@@ -1,10 +1,25 @@
 from typing import List, Dict, Any
 import os
+import shutil
+import sys
+import datetime
+import logging as log
+import numbers
+import threading
+import time
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from jinja2 import Template
 from contextlib import suppress
-from .utils.paths import ensure_rooting
-from .utils.jinja import Environment
+from .utils.paths import ensure_dir, ensure_rooting
+from .utils.jinja import shared_environment
+from .utils.state import read_json, write_json
+from .utils.sql import split_statements
+from .tracing import record_span, span, tags, wrap
+from . import checks
 import json
+import re
 from IPython.display import display
 
 class SaveMode:
@@ -12,21 +27,194 @@ class SaveMode:
     json = lambda d, p: d.to_json(p, orient='records')
     parquet = lambda d, p: d.to_parquet(p, index=False, compression='snappy')
 
+    @staticmethod
+    def resolve(filetype:str = None) -> str:
+        """
+        Returns the writer name for the filetype, falling back to csv for unknown types
+        """
+        return filetype if filetype in ['csv', 'json', 'parquet'] else 'csv'
+
+def subquery(query:str, alias:str) -> str:
+    """
+    Wraps a compiled query so it can be selected from
+    """
+    # The closing parenthesis goes on its own line so a trailing -- comment cannot swallow it
+    return f'({query.strip().rstrip(";")}\n) AS {alias}'
+
+def relocate(query:str, tables:Dict[str, str]) -> str:
+    """
+    Rewrites qualified table names, e.g. to read the tables a sample run built instead of the live ones
+    """
+    for table, target in (tables or {}).items():
+        query = re.sub(rf'(?<![\w.]){re.escape(table)}(?!\w)', target, query, flags=re.IGNORECASE)
+    return query
+
+def sql_literal(value:Any) -> str:
+    """
+    Renders a probed value back into SQL
+    """
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, numbers.Number):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+def write_output(filetype:str, data:Any, path:str):
+    """
+    Writes a result to disk with the SaveMode writer for the filetype
+    """
+    getattr(SaveMode, SaveMode.resolve(filetype))(data, path)
+    return path
+
+def timed_write(filetype:str, data:Any, path:str):
+    """
+    Writes a result like write_output, also returning when the write started and ended for its trace span
+    """
+    began = time.time_ns()
+    write_output(filetype, data, path)
+    return path, began, time.time_ns()
+
+class SavePipeline:
+    """
+    Overlaps fetching with serialization in save mode
+
+    Results are handed to a writer thread as soon as they are fetched, so the next variant or
+    batch is already fetching while the previous one is being encoded. Fetching waits on the
+    network with the GIL released, so the two overlap without shipping results to another
+    process. The number of results waiting on a writer is bounded by max_pending to cap memory.
+
+    Args:
+        max_pending (int, optional): Results allowed to wait on a writer. Defaults to 2.
+        encoder (str, optional): 'thread' or 'inline'. Defaults to thread.
+    """
+
+    def __init__(self, max_pending:int = 2, encoder:str = None):
+        self.max_pending = max(1, int(max_pending))
+        self.encoder = encoder
+        self.pending = deque()
+        self.threads = None
+        self.lock = threading.Lock()
+        self.written = []
+
+    def pool(self):
+        if self.threads is None:
+            self.threads = ThreadPoolExecutor(max_workers=self.max_pending)
+        return self.threads
+
+    def submit(self, data:Any, path:str, filetype:str = None):
+        """
+        Queues a result to be written, blocking while max_pending results are in flight
+
+        Args:
+            data (Any): The result to write.
+            path (str): Path to write the result to.
+            filetype (str, optional): Filetype to encode the result as. Defaults to csv.
+        """
+        if data is None:
+            return None
+        if self.encoder == 'inline':
+            with span('write', **{'file.path': path}):
+                self.written.append(write_output(filetype, data, path))
+            return path
+        # Partitions submit from several threads, the lock keeps the backpressure shared
+        with self.lock:
+            while len(self.pending) >= self.max_pending:
+                self.collect(*self.pending.popleft())
+            # The write span is recorded under the span that submitted it once the write finishes
+            self.pending.append((self.pool().submit(timed_write, filetype, data, path), wrap(record_span)))
+
+    def collect(self, future, report):
+        path, began, ended = future.result()
+        report('write', began, ended, **{'file.path': path})
+        self.written.append(path)
+
+    def drain(self):
+        """
+        Waits for every queued write to finish, raising the first error encountered
+        """
+        with self.lock:
+            while self.pending:
+                self.collect(*self.pending.popleft())
+
+    def bytes_written(self) -> int:
+        return sum(os.path.getsize(path) for path in self.written if path and os.path.exists(path))
+
+    def close(self):
+        try:
+            self.drain()
+        finally:
+            if self.threads is not None:
+                self.threads.shutdown(wait=True)
+                self.threads = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for future, _ in self.pending:
+                future.cancel()
+            self.pending.clear()
+        self.close()
+        return False
+
 class Mode:
-    def __init__(self, name:str, script: str = None, query: str = None, depends_on: List[str] = None, method: str = None, globs: Dict[str, Any] = None, defaults: Dict[str, Any] = None, meta: Dict[str, Any] = None):
+    # Whether nodes in this mode build tables that other nodes can read
+    materializes = False
+
+    def __init__(self, name:str, script: str = None, query: str = None, depends_on: List[str] = None, method: str = None, globs: Dict[str, Any] = None, defaults: Dict[str, Any] = None, meta: Dict[str, Any] = None, retries: int = 0, retry_delay: float = 0):
         if script:
             self.script = script
         if query:
             self.query = query
         if depends_on:
-            self.depends_on = depends_on
-        self.method = method
-        self.name = name
+            self.depends_on = [sys.intern(str(d)) for d in depends_on]
+        self.method = sys.intern(method) if isinstance(method, str) else method
+        self.name = sys.intern(name)
         self.meta = meta
         self.defaults = defaults if defaults else {}
+        # Times a failed node is run again, opt-in because appends are not idempotent without a transaction
+        self.retries = int(retries) if retries else 0
+        self.retry_delay = float(retry_delay) if retry_delay else 0
+        # Rows and bytes produced by the latest execution, reported to the run history
+        self.metrics = {}
+        self.metrics_lock = threading.Lock()
         if globs:
             self.dict2Attr(globs)
-        self.jinjaEnv = Environment()
+
+    # Every mode renders through the one project-wide environment
+    jinjaEnv = property(lambda self: shared_environment())
+    j2 = property(lambda self: shared_environment())
+
+    # Rebuilt when a packed plan is loaded rather than packed: template arguments, locks and per-run state
+    transient = ['defaults', 'metrics', 'metrics_lock', 'mark_lock', 'execution_context']
+
+    def packed_state(self) -> Dict[str, Any]:
+        """
+        Returns the compiled state that execution needs, as plain values
+        """
+        return dict((k, v) for k, v in self.__dict__.items() if k not in self.transient)
+
+    @classmethod
+    def from_packed(cls, state:Dict[str, Any]) -> 'Mode':
+        """
+        Restores a compiled mode from packed_state without rendering any templates
+        """
+        mode = cls.__new__(cls)
+        mode.__dict__.update(state)
+        mode.defaults = {}
+        mode.metrics = {}
+        mode.metrics_lock = threading.Lock()
+        return mode
+
+    def count(self, rows:int = None, bytes:int = None):
+        """
+        Adds to the rows and bytes the current execution produced
+        """
+        with self.metrics_lock:
+            for key, value in [('rows', rows), ('bytes', bytes)]:
+                if value is not None:
+                    self.metrics[key] = self.metrics.get(key, 0) + int(value)
 
     def dict2Attr(self, d: Dict[str, Any]):
         """
@@ -47,6 +235,7 @@ class Mode:
             overrides (Dict[str, Any], optional): Overrides for the defaults. Defaults to None.
             context (Dict[str,Any], optional): Context to use for the query. Defaults to None.
             schema (str, optional): Schema to use for the query. Defaults to 'public'.
+            query (str, optional): Template to render instead of the mode's query. Defaults to None.
         """
         if not overrides:
             overrides = {}
@@ -55,8 +244,8 @@ class Mode:
         args.update({'this':f'{schema}{"." if schema != "" else ""}{node}'})
         if context:
             args.update(context)
-        if hasattr(self,'query'):
-            query = self.query
+        if kwargs.get('query') is not None or hasattr(self,'query'):
+            query = kwargs['query'] if kwargs.get('query') is not None else self.query
             try:
                 template = self.jinjaEnv.from_string(query).render(**args)
             except Exception as e:
@@ -79,12 +268,70 @@ class Mode:
             download_dir (str, optional): Path to download data to. Defaults to None.
         """
         if hasattr(self, 'compiled_query'):
-            steps = self.compiled_query.split(';')
-            for step in steps:
-                rez = connection.execute(step)
-            return rez
+            return self.run_statements(self.compiled_query, connection)
         return None
 
+    def compiled_sql(self) -> List[str]:
+        """
+        Returns every compiled script of this mode, empty before compilation
+        """
+        return [self.compiled_query] if hasattr(self, 'compiled_query') else []
+
+    def run_statements(self, compiled:str, connection:Any):
+        """
+        Executes each statement of a compiled query, returning the result of the last one
+
+        All statements share one session and, when the node runs in a transaction, one commit.
+        On Redshift and SQLite the node then fails as a unit; MySQL commits implicitly after DDL.
+        """
+        rez = None
+        steps = split_statements(compiled)
+        with connection.session(transaction=self.in_transaction()) as session:
+            for step in steps:
+                staged = re.match(r'^\s*/\* curie:validate (\S+) \*/\s*$', step)
+                if staged:
+                    self.validate_stage(staged.group(1), session)
+                    continue
+                rez = session.execute(step)
+                # A node's rows are those of its largest statement, e.g. the CTAS of a replace
+                if session.rowcount is not None and session.rowcount >= 0:
+                    with self.metrics_lock:
+                        self.metrics['rows'] = max(self.metrics.get('rows', 0), session.rowcount)
+        return rez
+
+    def in_transaction(self) -> bool:
+        """
+        Whether the node's statements run in one transaction. Seed scripts run as written unless they opt in,
+        since they may hold statements that cannot run in a transaction (e.g. VACUUM).
+        """
+        transaction = getattr(self, 'transaction', None)
+        if transaction is None:
+            return (getattr(self, 'method', None) or 'seed') != 'seed'
+        return bool(transaction)
+
+    def validate_stage(self, table:str, connection:Any):
+        """
+        Checks a staged table before it replaces the live one. On failure the stage is dropped
+        and the live table is left untouched.
+
+        Args:
+            table (str): The staged table.
+            connection (Any): Connection to validate through.
+        """
+        failures = []
+        min_rows = getattr(self, 'min_rows', None)
+        if min_rows is not None:
+            rows = int(connection.execute(f'SELECT COUNT(*) AS n FROM {table}').iloc[0, 0])
+            if rows < int(min_rows):
+                failures.append(f'{rows} rows is fewer than min_rows ({min_rows})')
+        for check in getattr(self, 'compiled_checks', None) or []:
+            rez = connection.execute(check)
+            if rez is None or len(rez) == 0 or not bool(rez.iloc[0, 0]):
+                failures.append(f'check failed: {check}')
+        if failures:
+            connection.execute(f'DROP TABLE IF EXISTS {table}')
+            raise Exception(f'Validation of {table} failed, the existing table was kept: ' + '; '.join(failures))
+
     def __repr__(self) -> str:
         return self.name
     
@@ -106,15 +353,48 @@ class save(Mode):
                 defaults: Dict[str, Any] = None, 
                 store_results: bool = False,
                 outputs: List[str] = None,
-                meta: Dict[str, Any] = None
+                meta: Dict[str, Any] = None,
+                retries: int = 0,
+                retry_delay: float = 0,
+                filetype: str = None,
+                batch_size: int = None,
+                encoder: str = None,
+                max_pending: int = 2,
+                partition_by: str = None,
+                partitions: int = None,
+                partition_strategy: str = 'minmax',
+                partition_workers: int = None,
+                incremental_column: str = None
                 ):
-        super().__init__(name, script, query, depends_on, method, globs, defaults, meta)
+        super().__init__(name, script, query, depends_on, method, globs, defaults, meta, retries, retry_delay)
         self.variants = variants
         self.store_results = store_results
         self.outputs = outputs
+        if filetype:
+            self.filetype = filetype
+        self.batch_size = batch_size
+        self.encoder = encoder
+        self.max_pending = max_pending
+        self.partition_by = partition_by
+        self.partitions = int(partitions) if partitions else None
+        self.partition_strategy = partition_strategy
+        self.partition_workers = partition_workers
+        self.incremental_column = incremental_column
+        if incremental_column and (variants is not None or store_results):
+            raise Exception('incremental_column cannot be combined with variants or store_results.')
+        self.full_refresh = False
+        self.high_water_mark = None
+        self.observed_mark = None
+        self.mark_lock = threading.Lock()
 
         self.execution_context = {}
-        self.j2 = Environment()
+
+    @classmethod
+    def from_packed(cls, state:Dict[str, Any]) -> 'save':
+        mode = super().from_packed(state)
+        mode.mark_lock = threading.Lock()
+        mode.execution_context = {}
+        return mode
 
 
     def compile(self, node:str, path:str, overrides:Dict[str, Any] = None, context:Dict[str,Any] = None, schema:str = 'public', **kwargs): # Compile the script with jinja and save it to the path (by overwriting the file)'
@@ -127,6 +407,8 @@ class save(Mode):
             overrides (Dict[str, Any], optional): Overrides for the defaults. Defaults to None.
             context (Dict[str,Any], optional): Context to use for the query. Defaults to None.
             schema (str, optional): Schema to use for the query. Defaults to 'public'.
+            full_refresh (bool, optional): Ignore the stored high-water mark. Defaults to False.
+            sample (Dict[str, Any], optional): Sample each query to rows and/or pct, and expand only the first profiles of iterate_on. Defaults to None.
 
         Returns:
             str: The compiled query - if there are variants, this will be the base query
@@ -135,26 +417,33 @@ class save(Mode):
         if hasattr(self, 'script'):
             with open(ensure_rooting(self.script), 'r') as f:
                 self.query = f.read()
+
+        # Incremental nodes expose their stored high-water mark to the template
+        if self.incremental_column:
+            self.full_refresh = bool(kwargs.get('full_refresh', False))
+            self.high_water_mark = None
+            if not self.full_refresh:
+                self.high_water_mark = self.load_mark(node, kwargs.get('download_dir'), kwargs.get('connection'))
+            overrides = dict(overrides) if overrides else {}
+            overrides['is_incremental'] = self.high_water_mark is not None
+            overrides['high_water_mark'] = sql_literal(self.high_water_mark) if self.high_water_mark is not None else None
         
         # Non-variant definitions go first
         if self.variants is None:
             path = ensure_rooting(f'{path}/{self.name}/{node}.sql')
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
+            ensure_dir(os.path.dirname(path))
             with open(path, 'w') as f:
-                rendered = super().compile(node, overrides, context, schema=schema)
+                rendered = self.sampled(super().compile(node, overrides, context, schema=schema), **kwargs)
                 self.compiled_query = rendered
                 f.write(rendered)
             return None
         
         # Oh no, variants!
+        # Every variant file of the node lands in one directory
+        directory = ensure_dir(ensure_rooting(f'{path}/{self.name}/{node}'))
         for vn, variant in enumerate(self.variants):
             # Each variant will store the query in memory - starting with the base query
             variant['query'] = self.query
-            output_name = variant['name']
-            path = ensure_rooting(f'{path}/{self.name}/{node}/{output_name}.sql')
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
             # * Jinja Iteration Profiles look like this: {{refTable.parameter}}
             # * This will return a list of values for that parameter
             # Handle Iteration Profiles
@@ -179,6 +468,9 @@ class save(Mode):
                         if isinstance(variant['iterate_on'][iarg], list):
                             profile[iarg] = variant['iterate_on'][iarg][k]
                     iterator_profiles.append(profile)
+                # A sample only expands the first profiles
+                if kwargs.get('sample') and kwargs['sample'].get('profiles'):
+                    iterator_profiles = iterator_profiles[:int(kwargs['sample']['profiles'])]
                 # Compile the query for each iteration profile and the expected filename using the jinja context
                 self.variants[vn]['queries'] = []
                 self.variants[vn]['filenames'] = []
@@ -193,11 +485,11 @@ class save(Mode):
                     for key in overrides.keys():
                         if key in context.keys():
                             del context[key]
-                    query = super().compile(node, overrides, context, schema=schema)
-                    path = os.path.join(os.path.dirname(path), self.j2.from_string(variant['name']).render(**overrides)+'.sql')
+                    query = self.sampled(super().compile(node, overrides, context, schema=schema), **kwargs)
+                    filename = self.j2.from_string(variant['name']).render(**overrides)
                     self.variants[vn]['queries'].append(query)
-                    self.variants[vn]['filenames'].append(self.j2.from_string(variant['name']).render(**overrides))
-                    with open(path, 'w') as f:
+                    self.variants[vn]['filenames'].append(filename)
+                    with open(os.path.join(directory, filename + '.sql'), 'w') as f:
                         f.write(query)
             # Handle non-iteration profiles
             else:
@@ -205,16 +497,232 @@ class save(Mode):
                      for arg in variant['arguments'].keys(): # using jinja to render variables
                         if isinstance(variant['arguments'][arg], str):
                             variant['arguments'][arg] = self.j2.from_string(variant['arguments'][arg]).render(**overrides)
-                variant['query'] = super().compile(node, overrides, context, schema=schema)
+                variant['query'] = self.sampled(super().compile(node, overrides, context, schema=schema), **kwargs)
                 variant['name'] = self.j2.from_string(variant['name']).render(**overrides)
-                path = os.path.join(os.path.dirname(path), variant['name']+'.sql')
-                with open(path, 'w') as f:
+                with open(os.path.join(directory, variant['name'] + '.sql'), 'w') as f:
                     f.write(variant['query'])
         return None
     
+    def sampled(self, query:str, sample:Dict[str, Any] = None, connection:Any = None, **kwargs) -> str:
+        """
+        Wraps a compiled query in the connection's sampling when compiled with --sample or --sample-pct
+        """
+        if not sample:
+            return query
+        return connection.sample_query(query, rows=sample.get('rows'), pct=sample.get('pct'))
+
+    def jobs(self, node:str, download_dir:str = None):
+        """
+        Lists every query this node will save along with where its output is written
+
+        Args:
+            node (str): The current node.
+            download_dir (str, optional): Path to download data to. Defaults to None.
+
+        Returns:
+            List[Dict[str, Any]]: One entry per file with the label, query, path and filetype
+        """
+        jobs = []
+        default_filetype = getattr(self, 'filetype', 'csv')
+        if hasattr(self, 'variants') and self.variants is not None:
+            for variant in self.variants:
+                filetype = SaveMode.resolve(variant.get('filetype', default_filetype))
+                if 'iterate_on' in variant.keys():
+                    for query, fn in zip(variant['queries'], variant['filenames']):
+                        jobs.append({'label': fn, 'query': query, 'path': ensure_rooting(f'{download_dir}/{node}/{fn}'), 'filetype': filetype})
+                else:
+                    jobs.append({'label': variant['name'], 'query': variant['query'], 'path': ensure_rooting(f'{download_dir}/{node}/{variant["name"]}'), 'filetype': filetype})
+        elif hasattr(self, 'query'):
+            query = self.compiled_query
+            if self.incremental_column and self.high_water_mark is not None:
+                query = f'SELECT * FROM {subquery(query, "_curie_inc")} WHERE {self.incremental_column} > {sql_literal(self.high_water_mark)}'
+            jobs.append({'label': node, 'query': query, 'path': self.dataset_path(node, download_dir), 'filetype': SaveMode.resolve(default_filetype)})
+        return jobs
+
+    def compiled_sql(self) -> List[str]:
+        """
+        Returns every compiled query of this mode, one per variant file, empty before compilation
+        """
+        if self.variants is None:
+            return super().compiled_sql()
+        queries = []
+        for variant in self.variants:
+            if 'iterate_on' in variant.keys():
+                queries += variant.get('queries', [])
+            elif 'query' in variant.keys():
+                queries.append(variant['query'])
+        return queries
+
+    def dataset_path(self, node:str, download_dir:str = None) -> str:
+        """
+        Returns the path of the node's output, without a file extension
+        """
+        return ensure_rooting(f'{download_dir}/{node}')
+
+    def mark_file(self, node:str, download_dir:str = None) -> str:
+        """
+        High-water marks live beside the parts they describe, so cleaning the data resets them
+        """
+        return os.path.join(self.dataset_path(node, download_dir), '_curie_state.json')
+
+    def load_mark(self, node:str, download_dir:str = None, connection:Any = None) -> Any:
+        """
+        Returns the stored high-water mark for the connection profile, or None on a first run
+        """
+        if download_dir is None:
+            return None
+        profile = getattr(connection, 'profile_', None) or 'default'
+        state = read_json(self.mark_file(node, download_dir), {}).get(profile, {})
+        if state.get('column') != self.incremental_column:
+            return None
+        return state.get('high_water_mark')
+
+    def save_mark(self, node:str, download_dir:str, connection:Any, mark:Any):
+        """
+        Persists the high-water mark for the connection profile
+        """
+        path = self.mark_file(node, download_dir)
+        profile = getattr(connection, 'profile_', None) or 'default'
+        if isinstance(mark, numbers.Number) and hasattr(mark, 'item'):
+            mark = mark.item()
+        elif not isinstance(mark, (str, numbers.Number)):
+            mark = str(mark)
+        state = read_json(path, {})
+        state[profile] = {'column': self.incremental_column, 'high_water_mark': mark, 'updated_at': datetime.datetime.now().isoformat()}
+        write_json(path, state)
+
+    def observe(self, frame:Any):
+        """
+        Tracks the largest incremental_column value seen in the fetched results
+        """
+        if frame is None or len(frame) == 0:
+            return None
+        columns = [c for c in frame.columns if str(c).lower() == self.incremental_column.lower()]
+        if len(columns) == 0:
+            raise Exception(f'Incremental column {self.incremental_column} is not in the query results.')
+        value = frame[columns[0]].max()
+        if value is None or value != value:
+            return None
+        with self.mark_lock:
+            if self.observed_mark is None or value > self.observed_mark:
+                self.observed_mark = value
+
+    def partition_cuts(self, query:str, connection:Any) -> List[Any]:
+        """
+        Probes the partition key and returns the cut points between partitions
+
+        The minmax strategy splits [MIN, MAX] of a numeric key into equal widths. The quantile
+        strategy places cuts at the lower bound of each NTILE, which balances skewed keys and
+        works for any ordered type.
+
+        Args:
+            query (str): The compiled query to partition.
+            connection (Any): Connection to probe through.
+
+        Returns:
+            List[Any]: Sorted, distinct cut points - one fewer than the number of partitions
+        """
+        key = self.partition_by
+        strategy = self.partition_strategy
+        if strategy == 'minmax':
+            probe = connection.execute(f'SELECT MIN({key}) AS lo, MAX({key}) AS hi FROM {subquery(query, "_curie_probe")}')
+            lo, hi = probe['lo'].iloc[0], probe['hi'].iloc[0]
+            if lo is None or hi is None or lo != lo or hi != hi:
+                return []
+            if isinstance(lo, numbers.Number) and isinstance(hi, numbers.Number):
+                if isinstance(lo, numbers.Integral) and isinstance(hi, numbers.Integral):
+                    step = -(-(int(hi) - int(lo) + 1) // self.partitions)
+                    cuts = [int(lo) + i * step for i in range(1, self.partitions)]
+                    return sorted(set(c for c in cuts if c <= int(hi)))
+                width = (float(hi) - float(lo)) / self.partitions
+                return sorted(set(float(lo) + i * width for i in range(1, self.partitions))) if width > 0 else []
+            log.warning(f'Partition key {key} is not numeric, falling back to quantile partitioning.')
+            strategy = 'quantile'
+        if strategy == 'quantile':
+            probe = connection.execute(
+                f'SELECT MIN({key}) AS cut FROM ('
+                f'SELECT {key}, NTILE({self.partitions}) OVER (ORDER BY {key}) AS _curie_tile '
+                f'FROM {subquery(query, "_curie_src")} WHERE {key} IS NOT NULL'
+                f') AS _curie_probe GROUP BY _curie_tile'
+            )
+            return sorted(set(probe['cut'].to_list()))[1:]
+        raise Exception(f'Unknown partition_strategy {self.partition_strategy}. Use minmax or quantile.')
+
+    def partition_queries(self, query:str, connection:Any) -> List[str]:
+        """
+        Splits a compiled query into disjoint slices of the partition key.
+        Rows with a NULL key are kept in the first slice so the union is the whole result.
+        """
+        key = self.partition_by
+        cuts = [sql_literal(c) for c in self.partition_cuts(query, connection)]
+        if len(cuts) == 0:
+            return [query]
+        predicates = [f'{key} < {cuts[0]} OR {key} IS NULL']
+        predicates += [f'{key} >= {lo} AND {key} < {hi}' for lo, hi in zip(cuts[:-1], cuts[1:])]
+        predicates += [f'{key} >= {cuts[-1]}']
+        return [f'SELECT * FROM {subquery(query, "_curie_part")} WHERE {predicate}' for predicate in predicates]
+
+    def stream(self, query:str, connection:Any, writer:SavePipeline, path:str, prefix:str, filetype:str):
+        """
+        Writes one query into the dataset directory at path, in batches when batch_size is set
+        """
+        if self.batch_size:
+            for part, batch in enumerate(connection.execute_batches(query, int(self.batch_size))):
+                self.count(rows=len(batch))
+                if self.incremental_column:
+                    self.observe(batch)
+                writer.submit(batch, os.path.join(path, f'{prefix}-{part:05d}.{filetype}'), filetype)
+        else:
+            rez = connection.execute(query)
+            self.count(rows=len(rez) if rez is not None else None)
+            if self.incremental_column:
+                self.observe(rez)
+            if rez is not None and len(rez) == 0 and self.incremental_column:
+                return None
+            writer.submit(rez, os.path.join(path, f'{prefix}.{filetype}'), filetype)
+
+    def writes_parts(self) -> bool:
+        """
+        Whether results are written as a directory of numbered parts rather than a single file
+        """
+        return not self.store_results and bool(self.batch_size or (self.partition_by and self.partitions) or self.incremental_column)
+
+    def fetch(self, job:Dict[str, Any], connection:Any, writer:SavePipeline, prefix:str = 'part'):
+        """
+        Fetches a single job and queues its result with the writer.
+        When batch_size, partition_by or incremental_column is set the result is written as a directory of numbered parts.
+
+        Returns:
+            pandas.DataFrame: The fetched result, or None when the result was written in parts
+        """
+        if not self.writes_parts():
+            os.makedirs(os.path.dirname(job['path']), exist_ok=True)
+            rez = connection.execute(job['query'])
+            self.count(rows=len(rez) if rez is not None else None)
+            writer.submit(rez, f'{job["path"]}.{job["filetype"]}', job['filetype'])
+            return rez
+        os.makedirs(job['path'], exist_ok=True)
+        if not (self.partition_by and self.partitions):
+            self.stream(job['query'], connection, writer, job['path'], prefix, job['filetype'])
+            return None
+        slices = self.partition_queries(job['query'], connection)
+        print(f'\t\tExtracting {len(slices)} partitions on {self.partition_by}...')
+        workers = int(self.partition_workers) if self.partition_workers else len(slices)
+        def extract(i, q):
+            with span('fetch', partition=i):
+                self.stream(q, connection, writer, job['path'], f'{prefix}-{i:05d}', job['filetype'])
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [pool.submit(wrap(extract), i, q) for i, q in enumerate(slices)]
+            for future in futures:
+                future.result()
+        return None
+
     def execute(self, node:str, connection:Any = None, context:Dict[str,Any] = None, download_dir:str = None):
         """
         Executes the query for the specified node
+
+        Each result is encoded by a worker while the next variant or batch is fetched,
+        so extraction runs at the pace of the slower of the network and the encoder.
         
         Args:
             node (str): The current node.
@@ -225,50 +733,70 @@ class save(Mode):
         Returns:
             pandas.DataFrame: The result of the query
         """
-        rez = None
-        # Variants go first
-        # * If there are variants, execute each variant according to the stored query
-        # * Save to the stored filename
-        if hasattr(self, 'variants') and self.variants is not None:
-            for i, variant in enumerate(self.variants):
-                if 'iterate_on' in variant.keys():
-                    for query, fn in zip(variant['queries'],variant['filenames']):
-                        print(f'\t\tExecuting variant {fn}...')
-                        path = ensure_rooting(f'{download_dir}/{node}/{fn}{".csv" if not hasattr(self, "filetype") else "."+self.filetype}')
-                        if not os.path.exists(os.path.dirname(path)):
-                            os.makedirs(os.path.dirname(path))
-                        rez = connection.execute(query)
-                        if hasattr(self, 'filetype') and self.filetype in SaveMode.__dict__.keys() and rez is not None:
-                            getattr(SaveMode, self.filetype)(rez, path)
-                        else:
-                            getattr(SaveMode, 'csv')(rez, path)
-                else:
-                    print(f'\t\tExecuting variant {variant["name"]}...')
-                    path = ensure_rooting(f'{download_dir}/{node}/{variant["name"]}{".csv" if not hasattr(self, "filetype") else "."+self.filetype}')
-                    if not os.path.exists(os.path.dirname(path)):
-                        os.makedirs(os.path.dirname(path))
-                    rez = connection.execute(variant['query'])
-                    if hasattr(self, 'filetype') and self.filetype in SaveMode.__dict__.keys() and rez is not None:
-                        getattr(SaveMode, self.filetype)(rez, path)
-                    else:
-                        getattr(SaveMode, 'csv')(rez, path)
+        jobs = self.jobs(node, download_dir)
+        if len(jobs) == 0:
             return None
-        # If it's normal, do normal things
-        if hasattr(self, 'query'):
-            path = ensure_rooting(f'{download_dir}/{node}{".csv" if not hasattr(self, "filetype") else "."+self.filetype}')
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-            rez = connection.execute(self.compiled_query)
-            if hasattr(self, 'filetype') and self.filetype in SaveMode.__dict__.keys() and rez is not None:
-                getattr(SaveMode, self.filetype)(rez, path)
-            else:
-                getattr(SaveMode, 'csv')(rez, path)
-            return rez
+        rez = None
+        prefix = 'part'
+        if self.incremental_column:
+            # Each run appends a new set of parts, a first run or full refresh starts the dataset over
+            self.observed_mark = None
+            prefix = 'part-' + datetime.datetime.now().strftime('%Y%m%dT%H%M%S%f')
+            if self.high_water_mark is None and os.path.exists(jobs[0]['path']):
+                shutil.rmtree(jobs[0]['path'])
+            print(f'\t\t{"Appending rows after " + str(self.high_water_mark) if self.high_water_mark is not None else "Full extract"} on {self.incremental_column}...')
+        # A lone unbatched result has nothing to overlap with, so it is written in place
+        encoder = self.encoder if len(jobs) > 1 or self.writes_parts() else 'inline'
+        with SavePipeline(max_pending=self.max_pending, encoder=encoder) as writer:
+            for job in jobs:
+                if self.variants is not None:
+                    print(f'\t\tExecuting variant {job["label"]}...')
+                with tags(variant=job['label'] if self.variants is not None else None), span('fetch'):
+                    rez = self.fetch(job, connection, writer, prefix)
+        self.count(bytes=writer.bytes_written())
+        if self.incremental_column and self.observed_mark is not None:
+            self.save_mark(node, download_dir, connection, self.observed_mark)
+        # Variants are only written to disk
+        return None if self.variants is not None else rez
 
 class run(Mode):
-    def compile(self, node:str, path:str, overrides:Dict[str, Any] = None, context:Dict[str,Any] = None, connection:Any = None, schema:str = 'public'): # Compile the script with jinja and save it to the path (by overwriting the file)'
+    materializes = True
+
+    def __init__(self,
+                name: str,
+                script: str = None,
+                query: str = None,
+                depends_on: List[str] = None,
+                method: str = None,
+                globs: Dict[str, Any] = None,
+                defaults: Dict[str, Any] = None,
+                meta: Dict[str, Any] = None,
+                retries: int = 0,
+                retry_delay: float = 0,
+                unique_key: Any = None,
+                incremental_filter: str = None,
+                min_rows: int = None,
+                validate: Any = None,
+                transaction: bool = None
+                ):
+        super().__init__(name, script, query, depends_on, method, globs, defaults, meta, retries, retry_delay)
+        self.transaction = transaction
+        self.unique_key = unique_key
+        self.incremental_filter = incremental_filter
+        self.min_rows = min_rows
+        self.validate = [validate] if isinstance(validate, str) else validate
+        self.compiled_checks = None
+        self.compiled_build = None
+        self.full_refresh = False
+        self.target = None
+
+    def compile(self, node:str, path:str, overrides:Dict[str, Any] = None, context:Dict[str,Any] = None, connection:Any = None, schema:str = 'public', **kwargs): # Compile the script with jinja and save it to the path (by overwriting the file)'
         """
         Compiles the query for the specified node
+
+        Incremental methods (append, merge, upsert) also compile a full build, used when the
+        table does not exist yet or on a full refresh. Only the incremental statements apply
+        incremental_filter, and templates can branch on {{is_incremental}}.
         
         Args:
             node (str): The current node.
@@ -277,37 +805,303 @@ class run(Mode):
             context (Dict[str,Any], optional): Context to use for the query. Defaults to None.
             connection (Any, optional): Connection to use for the query. Defaults to None.
             schema (str, optional): Schema to use for the query. Defaults to 'public'.
+            full_refresh (bool, optional): Always run the full build. Defaults to False.
+            sample (Dict[str, Any], optional): Sample the query to rows and/or pct. Defaults to None.
+            relocate (Dict[str, str], optional): Table names to rewrite in the compiled statements. Defaults to None.
             
             Returns:
                 str: The compiled query
         """
         print(f'{path}/{self.name}/{node}.sql')
         path = ensure_rooting(f'{path}/{self.name}/{node}.sql')
-        if not os.path.exists(os.path.dirname(path)):
-            os.makedirs(os.path.dirname(path))
+        ensure_dir(os.path.dirname(path))
         
         if hasattr(self, 'query'):
-            if hasattr(self, 'method'):
-                rendered = ';'.join(connection.method_patterns()[self.method](self.query))
-            rendered = super().compile(node, overrides, context, schema=schema)
+            source = self.query
         elif hasattr(self, 'script'):
             with open(ensure_rooting(self.script), 'r') as f:
-                if hasattr(self, 'method'):
-                    script = ';'.join(connection.method_patterns()[self.method](f.read()))
-                else:
-                    script = f.read()
-                self.query = script
-            rendered = super().compile(node, overrides, context, schema=schema)
+                source = f.read()
         else:
             raise Exception(f'No script or query defined for mode {self.name}.')
+
+        method = self.method if self.method else 'seed'
+        if method != 'seed':
+            # Patterns wrap the query, so drop its terminator and keep trailing comments off the closing line
+            source = source.strip().rstrip(';') + '\n'
+        patterns = connection.method_patterns()
+        if method not in patterns:
+            raise Exception(f'Unknown method {method} for {node}. Use one of: {", ".join(patterns.keys())}.')
+        if method in connection.keyed_methods and not self.unique_key:
+            raise Exception(f'{method} requires a unique_key for {node}.')
+        sample = kwargs.get('sample')
+        if sample and method != 'seed':
+            source = connection.sample_query(source, rows=sample.get('rows'), pct=sample.get('pct')) + '\n'
+        overrides = dict(overrides) if overrides else {}
+        self.full_refresh = bool(kwargs.get('full_refresh', False))
+        self.target = (schema, node)
+        self.compiled_build = None
+
+        # Checks run against the staged table of a replace, before it is swapped in
+        self.compiled_checks = []
+        for check in self.validate or []:
+            self.compiled_checks.append(super().compile(node, overrides, context, schema=schema, query=check))
+
+        if method in connection.incremental_methods:
+            overrides['is_incremental'] = False
+            self.compiled_build = super().compile(node, overrides, context, schema=schema, query=';\n'.join(patterns['replace'](source, table=node)))
+            if self.incremental_filter:
+                source = f'SELECT * FROM {subquery(source, "_curie_src")} WHERE {self.incremental_filter}'
+            overrides['is_incremental'] = True
+        rendered = super().compile(node, overrides, context, schema=schema, query=';\n'.join(patterns[method](source, unique_key=self.unique_key, table=node)))
+        if sample:
+            # Samples are built in their own schema and read the samples of the tables they depend on
+            create = connection.create_schema(schema)
+            rendered = (f'{create};\n' if create else '') + relocate(rendered, kwargs.get('relocate'))
+            if self.compiled_build is not None:
+                self.compiled_build = (f'{create};\n' if create else '') + relocate(self.compiled_build, kwargs.get('relocate'))
+            self.compiled_checks = [relocate(check, kwargs.get('relocate')) for check in self.compiled_checks]
         self.compiled_query = rendered
         with open(path, 'w') as f:
             f.write(rendered)
+        if self.compiled_build is not None:
+            with open(path[:-len('.sql')] + '.build.sql', 'w') as f:
+                f.write(self.compiled_build)
         return None
     
+    def compiled_sql(self) -> List[str]:
+        return super().compiled_sql() + ([self.compiled_build] if self.compiled_build is not None else [])
+
     def execute(self, node: str, connection: Any = None, context: Dict[str, Any] = None, download_dir: str = None):
+        """
+        Executes the query for the specified node, building the table from scratch when an
+        incremental method has nothing to add to yet
+        """
+        if self.compiled_build is not None and (self.full_refresh or not connection.table_exists(*self.target)):
+            print(f'\t\tBuilding {node} from scratch...')
+            return self.run_statements(self.compiled_build, connection)
         # Use the super execute method
         return super().execute(node, connection, context, download_dir)
     
     def __repr__(self):
-        return 'run'
\ No newline at end of file
+        return 'run'
+
+class test(Mode):
+    """
+    Checks a node's output against its declared `fields`
+
+    Added to every node that declares fields. A table built in run mode is checked in the
+    warehouse with one aggregate scan, plus a grouped scan for a composite primary key and a
+    catalog lookup for the declared types. Files written in save mode are read once, only
+    the checked columns, and checked vectorized with Arrow.
+
+    Args:
+        name (str): Name of the mode.
+        fields (List[Dict[str, Any]]): The node's fields.
+        table (bool, optional): Check the table the node builds. Defaults to False.
+        files (bool, optional): Check the files the node saves. Defaults to False.
+    """
+    # One failed test does not stop the others
+    keep_going = True
+
+    def __init__(self,
+                name: str,
+                fields: List[Dict[str, Any]] = None,
+                table: bool = False,
+                files: bool = False,
+                globs: Dict[str, Any] = None,
+                defaults: Dict[str, Any] = None,
+                meta: Dict[str, Any] = None
+                ):
+        super().__init__(name, globs=globs, defaults=defaults, meta=meta)
+        self.fields = fields
+        self.rules = checks.rules(fields)
+        self.table = table
+        self.files = files
+        self.target = None
+        self.statements = []
+        self.download_dir = None
+
+    def compile(self, node:str, path:str, overrides:Dict[str, Any] = None, context:Dict[str,Any] = None, schema:str = 'public', **kwargs):
+        """
+        Compiles the check queries for the node's table and writes them to the path
+        """
+        self.target = (schema, node)
+        self.download_dir = kwargs.get('download_dir')
+        self.statements = []
+        if self.table and (self.rules['not_null'] or self.rules['key']):
+            table = f'{schema}{"." if schema != "" else ""}{node}'
+            self.statements.append(checks.aggregate_query(table, self.rules))
+            composite = checks.key_query(table, self.rules)
+            if composite is not None:
+                self.statements.append(composite)
+        if self.statements:
+            path = ensure_rooting(f'{path}/{self.name}/{node}.sql')
+            ensure_dir(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(';\n'.join(self.statements))
+        return None
+
+    def compiled_sql(self) -> List[str]:
+        return list(self.statements)
+
+    def execute(self, node:str, connection:Any = None, context:Dict[str,Any] = None, download_dir:str = None):
+        """
+        Runs the node's checks, raising with every failure once all of them ran
+        """
+        from .utils.datasets import datasets, output_files, read_output
+        failures = []
+        if self.table:
+            schema, name = self.target
+            table = f'{schema}{"." if schema != "" else ""}{name}'
+            failures += [f'{table} {f}' for f in checks.table_failures(table, schema, name, self.rules, connection)]
+        if self.files:
+            download_dir = download_dir if download_dir is not None else self.download_dir
+            found = datasets(ensure_rooting(f'{download_dir}/{node}'))
+            if not found:
+                print(f'\t\tNo saved output for {node}, its files were not checked.')
+            columns = set(self.rules['not_null'] + self.rules['key'] + list(self.rules['types'].keys()))
+            for label, dataset in found.items():
+                # csv holds no types, its values are parsed against the declared ones instead
+                text = all(f.endswith('.csv') for f in output_files(dataset))
+                frame = read_output(dataset, columns=columns, text=True)
+                self.count(rows=frame.num_rows)
+                failures += [f'{label} {f}' for f in checks.frame_failures(frame, self.rules, text=text)]
+        if failures:
+            for failure in failures:
+                print(f'\t\tFailed {node}: {failure}')
+            raise Exception(f'{len(failures)} check(s) failed for {node}: ' + '; '.join(failures))
+        print(f'\t\t{checks.count(self.rules)} check(s) passed.')
+        return None
+
+    def __repr__(self):
+        return 'test'
+class python(Mode):
+    """
+    A transform written in Python rather than SQL
+
+    Selected for any node whose mode definition has a `callable` instead of a script or query.
+    The callable receives each upstream node's output as a keyword argument and returns a
+    table, which is written with the SaveMode writers to the download directory.
+    """
+    def __init__(self,
+                name: str,
+                callable: str = None,
+                depends_on: List[str] = None,
+                globs: Dict[str, Any] = None,
+                defaults: Dict[str, Any] = None,
+                meta: Dict[str, Any] = None,
+                retries: int = 0,
+                retry_delay: float = 0,
+                filetype: str = 'parquet',
+                batch_size: int = None,
+                batch_on: str = None,
+                workers: int = None,
+                input_format: str = 'arrow',
+                arguments: Dict[str, Any] = None
+                ):
+        super().__init__(name, depends_on=depends_on, globs=globs, defaults=defaults, meta=meta, retries=retries, retry_delay=retry_delay)
+        self.callable = callable
+        self.filetype = SaveMode.resolve(filetype)
+        self.batch_size = int(batch_size) if batch_size else None
+        self.batch_on = batch_on
+        self.workers = workers
+        self.input_format = input_format
+        self.arguments = arguments if arguments else {}
+        if input_format not in ['arrow', 'pandas']:
+            raise Exception(f'Unknown input_format {input_format}. Use arrow or pandas.')
+        self.inputs = {}
+        self.compiled_arguments = {}
+
+    def compile(self, node:str, path:str, overrides:Dict[str, Any] = None, context:Dict[str,Any] = None, schema:str = 'public', **kwargs):
+        """
+        Resolves where each input is read from and renders the callable's arguments
+
+        In run mode upstream SQL nodes are read from their tables, otherwise inputs are the
+        files upstream nodes wrote to the download directory. The plan is written to <node>.json.
+
+        Args:
+            node (str): The current node.
+            path (str): Path to save the plan to.
+            overrides (Dict[str, Any], optional): Overrides for the defaults. Defaults to None.
+            context (Dict[str,Any], optional): Context to use for the arguments. Defaults to None.
+            schema (str, optional): Schema of the node. Defaults to 'public'.
+        """
+        context = context if context else {}
+        args = dict(self.defaults)
+        args.update(overrides if overrides else {})
+        self.inputs = {}
+        for dep in getattr(self, 'depends_on', None) or []:
+            upstream = context.get(dep, {})
+            if self.name == 'run' and 'callable' not in upstream.get(self.name, {}):
+                dep_schema = upstream.get('schema')
+                self.inputs[dep] = {'table': f'{dep_schema}.{dep}' if dep_schema else dep}
+            else:
+                self.inputs[dep] = {'output': dep}
+        if self.batch_size and self.batch_on is None and len(self.inputs) > 0:
+            self.batch_on = list(self.inputs.keys())[0]
+        if self.batch_on is not None and self.batch_on not in self.inputs:
+            raise Exception(f'batch_on {self.batch_on} is not a dependency of {node}.')
+        self.compiled_arguments = dict((k, self.jinjaEnv.from_string(v).render(**args) if isinstance(v, str) else v) for k, v in self.arguments.items())
+
+        path = ensure_rooting(f'{path}/{self.name}/{node}.json')
+        ensure_dir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            json.dump({'callable': self.callable, 'inputs': self.inputs, 'arguments': self.compiled_arguments, 'batch_size': self.batch_size, 'batch_on': self.batch_on}, f, indent=2, default=str)
+        return None
+
+    def execute(self, node:str, connection:Any = None, context:Dict[str,Any] = None, download_dir:str = None):
+        """
+        Runs the callable in a process pool
+
+        Inputs are spooled once as Arrow IPC files that every worker memory maps, so
+        upstream data is not pickled between processes. With batch_size the batch_on input
+        is split into slices that run in parallel and are written as numbered parts.
+
+        Args:
+            node (str): The current node.
+            connection (Any, optional): Connection to read upstream tables through. Defaults to None.
+            context (Dict[str,Any], optional): Unused. Defaults to None.
+            download_dir (str, optional): Path inputs are read from and the result is written to. Defaults to None.
+        """
+        from .utils.datasets import read_output, spool, run_transform
+        import tempfile
+        output = ensure_rooting(f'{download_dir}/{node}')
+        root = ensure_rooting('.')
+        with tempfile.TemporaryDirectory(prefix='curie-') as spool_dir:
+            inputs, rows = {}, {}
+            for dep, source in self.inputs.items():
+                if 'table' in source:
+                    table = connection.execute(f'SELECT * FROM {source["table"]}')
+                else:
+                    table = read_output(ensure_rooting(f'{download_dir}/{source["output"]}'))
+                rows[dep] = len(table)
+                inputs[dep] = spool(table, os.path.join(spool_dir, f'{dep}.arrow'))
+                del table
+
+            # Replace the previous output, whichever layout it was written in
+            if os.path.isdir(output):
+                shutil.rmtree(output)
+            for filetype in ['csv', 'json', 'parquet']:
+                if os.path.exists(f'{output}.{filetype}'):
+                    os.remove(f'{output}.{filetype}')
+
+            tasks = []
+            if self.batch_size and self.batch_on is not None:
+                os.makedirs(output, exist_ok=True)
+                for part, offset in enumerate(range(0, max(rows[self.batch_on], 1), self.batch_size)):
+                    tasks.append({'path': os.path.join(output, f'part-{part:05d}.{self.filetype}'), 'batch_on': self.batch_on, 'offset': offset, 'length': self.batch_size})
+                print(f'\t\tTransforming {rows[self.batch_on]} rows of {self.batch_on} in {len(tasks)} batches...')
+            else:
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+                tasks.append({'path': f'{output}.{self.filetype}'})
+
+            workers = int(self.workers) if self.workers else os.cpu_count()
+            with ProcessPoolExecutor(max_workers=max(1, min(workers, len(tasks))), mp_context=multiprocessing.get_context('spawn')) as pool:
+                futures = [pool.submit(run_transform, self.callable, root, inputs, self.compiled_arguments, task['path'], self.filetype, self.input_format, task.get('batch_on'), task.get('offset', 0), task.get('length')) for task in tasks]
+                written = [future.result() for future in futures]
+        written = [result for result in written if result is not None]
+        self.count(rows=sum(result['rows'] for result in written), bytes=sum(os.path.getsize(result['path']) for result in written))
+        return [result['path'] for result in written]
+
+    def __repr__(self):
+        return 'python'
@@ -0,0 +1,183 @@
+from typing import Any, Callable, Dict, List
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .tracing import wrap
+
+# Assumed duration in seconds of a node with neither history nor a cost hint, when nothing else ran yet
+DEFAULT_COST = 1.0
+def shared_budget(workers:int) -> threading.BoundedSemaphore:
+    """
+    Worker slots several schedulers can share, e.g. the pipelines of one invocation, see Scheduler.run
+    """
+    return threading.BoundedSemaphore(max(1, int(workers)))
+
+class Scheduler:
+    """
+    Runs nodes in parallel, starting the ready node with the longest remaining path first
+
+    A node's rank is its own estimated duration plus the largest rank among its dependents,
+    i.e. the length of the longest chain it still holds up. Starting high-rank nodes first
+    keeps long chains from starting late, which is what bounds a parallel build's makespan.
+
+    Args:
+        dependencies (Dict[str, List[str]]): Node name to the nodes it depends on. Only these nodes are scheduled.
+        costs (Dict[str, float]): Estimated duration of each node in seconds.
+        workers (int, optional): Nodes run at the same time. Defaults to 1.
+    """
+    def __init__(self, dependencies:Dict[str, List[str]], costs:Dict[str, float], workers:int = 1):
+        self.nodes = list(dependencies.keys())
+        # Dependencies outside the scheduled set are treated as already satisfied
+        self.dependencies = dict((node, [d for d in deps if d in dependencies]) for node, deps in dependencies.items())
+        self.dependents = dict((node, []) for node in self.nodes)
+        for node, deps in self.dependencies.items():
+            for dep in deps:
+                self.dependents[dep].append(node)
+        self.position = dict((node, i) for i, node in enumerate(self.nodes))
+        self.costs = costs
+        self.workers = max(1, int(workers))
+        self.ranks = self.rank()
+
+    def rank(self) -> Dict[str, float]:
+        ranks = {}
+        remaining = dict((node, len(self.dependents[node])) for node in self.nodes)
+        stack = [node for node in self.nodes if remaining[node] == 0]
+        while stack:
+            node = stack.pop()
+            ranks[node] = self.costs[node] + max([ranks[child] for child in self.dependents[node]], default=0.0)
+            for dep in self.dependencies[node]:
+                remaining[dep] -= 1
+                if remaining[dep] == 0:
+                    stack.append(dep)
+        return ranks
+
+    def order(self, ready:List[str]) -> List[Any]:
+        # Ties go to the node defined first, so runs without history keep the pipeline's order
+        return [(-self.ranks[node], self.position[node], node) for node in ready]
+
+    def waiting(self) -> Dict[str, int]:
+        return dict((node, len(self.dependencies[node])) for node in self.nodes)
+
+    def release(self, node:str, waiting:Dict[str, int], heap:List[Any]):
+        """
+        Marks a node finished and queues the dependents it was the last dependency of
+        """
+        for child in self.dependents[node]:
+            waiting[child] -= 1
+            if waiting[child] == 0:
+                heapq.heappush(heap, (-self.ranks[child], self.position[child], child))
+
+    def plan(self) -> Dict[str, Any]:
+        """
+        Simulates the schedule with the estimated durations
+
+        Returns:
+            Dict[str, Any]: Start and finish of each node in seconds, the makespan and the critical path
+        """
+        waiting, running, slots = self.waiting(), [], {}
+        clock = 0.0
+        heap = self.order([node for node in self.nodes if waiting[node] == 0])
+        heapq.heapify(heap)
+        while heap or running:
+            while heap and len(running) < self.workers:
+                _, _, node = heapq.heappop(heap)
+                slots[node] = {'start': clock, 'finish': clock + self.costs[node]}
+                heapq.heappush(running, (clock + self.costs[node], self.position[node], node))
+            clock, _, node = heapq.heappop(running)
+            self.release(node, waiting, heap)
+        path, node = [], max(self.nodes, key=lambda n: self.ranks[n], default=None)
+        while node is not None:
+            path.append(node)
+            node = max(self.dependents[node], key=lambda n: self.ranks[n], default=None)
+        return {'nodes': slots, 'makespan': clock, 'critical_path': path, 'workers': self.workers}
+
+    def run(self, execute:Callable[[str], Any], on_finish:Callable[[str, float, str], Any] = None, keep_going:bool = False, budget:threading.BoundedSemaphore = None):
+        """
+        Executes every node once its dependencies finished
+
+        After a failure no new nodes are started, nodes already running are waited for and
+        the first error is raised. With keep_going, only the dependents of a failed node are
+        skipped and the first error is raised once everything else ran.
+
+        Args:
+            execute (Callable[[str], Any]): Runs one node.
+            on_finish (Callable[[str, float, str, Exception], Any], optional): Called with the node, its duration, 'success' or 'failed' and the error.
+            keep_going (bool, optional): Run independent nodes after a failure. Defaults to False.
+            budget (threading.BoundedSemaphore, optional): Slots shared with other schedulers, each node holds one while it runs. Defaults to None.
+        """
+        slots = budget
+        def timed(node):
+            if slots is not None:
+                slots.acquire()
+            began = time.monotonic()
+            try:
+                execute(node)
+            except Exception as e:
+                if on_finish is not None:
+                    on_finish(node, time.monotonic() - began, 'failed', e)
+                raise
+            finally:
+                if slots is not None:
+                    slots.release()
+            if on_finish is not None:
+                on_finish(node, time.monotonic() - began, 'success', None)
+
+        waiting = self.waiting()
+        heap = self.order([node for node in self.nodes if waiting[node] == 0])
+        heapq.heapify(heap)
+        if self.workers == 1:
+            error = None
+            while heap:
+                _, _, node = heapq.heappop(heap)
+                try:
+                    timed(node)
+                except Exception as e:
+                    if not keep_going:
+                        raise
+                    error = error or e
+                    continue
+                self.release(node, waiting, heap)
+            if error is not None:
+                raise error
+            return None
+
+        error = None
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while heap or running:
+                while heap and len(running) < self.workers and (error is None or keep_going):
+                    _, _, node = heapq.heappop(heap)
+                    # Each node runs with the run's query tags and trace
+                    running[pool.submit(wrap(timed), node)] = node
+                if not running:
+                    break
+                finished, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    node = running.pop(future)
+                    if future.exception() is not None:
+                        error = error or future.exception()
+                    else:
+                        self.release(node, waiting, heap)
+                if error is not None and not keep_going:
+                    heap = []
+        if error is not None:
+            raise error
+        return None
+
+def format_seconds(seconds:float) -> str:
+    seconds = int(round(seconds))
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+def describe_plan(plan:Dict[str, Any], sources:Dict[str, str]) -> str:
+    """
+    Renders a simulated plan as a table ordered by start time
+    """
+    lines = [f'Estimated makespan {format_seconds(plan["makespan"])} on {plan["workers"]} workers', '']
+    lines.append(f'{"start":>9}  {"finish":>9}  {"estimate":>9}  {"source":<8}  node')
+    for node, slot in sorted(plan['nodes'].items(), key=lambda item: (item[1]['start'], item[1]['finish'])):
+        lines.append(f'{format_seconds(slot["start"]):>9}  {format_seconds(slot["finish"]):>9}  {format_seconds(slot["finish"] - slot["start"]):>9}  {sources.get(node, ""):<8}  {node}')
+    lines.append('')
+    lines.append('Critical path: ' + ' -> '.join(plan['critical_path']))
+    return '\n'.join(lines)
@@ -0,0 +1,312 @@
+from typing import Any, Dict
+import argparse
+import contextlib
+import contextvars
+import hmac
+import http.client
+import io
+import ipaddress
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from . import Curie
+from .utils.paths import ensure_rooting
+
+# Buffer the prints of the current request go to, carried into worker threads by tracing.wrap
+current_output = contextvars.ContextVar('curie_output', default=None)
+
+# Shared secret clients present as a bearer token, see serve
+TOKEN_ENV = 'CURIE_SERVE_TOKEN'
+
+class ThreadOutput(io.TextIOBase):
+    """
+    Sends prints made while running a request, on its thread or the workers it starts, to that request's buffer, everything else to the real stream
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    @contextlib.contextmanager
+    def capture(self, buffer):
+        token = current_output.set(buffer)
+        try:
+            yield buffer
+        finally:
+            current_output.reset(token)
+
+    def write(self, text):
+        buffer = current_output.get()
+        return (buffer if buffer is not None else self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+class Daemon:
+    """
+    Keeps a project loaded between etl runs
+
+    Parsed pipelines, resolved secrets, compiled templates and pooled connections are reused
+    across requests. Before each run the files the project was loaded from are checked: a
+    changed project, connections or env file reloads the whole project, a changed pipeline
+    file reloads only that pipeline. Every run starts from a fresh copy of its DAG.
+
+    Args:
+        pool_size (int, optional): Idle connections kept open per connection profile. Defaults to 4.
+    """
+    def __init__(self, pool_size:int = 4):
+        self.pool_size = pool_size
+        self.curie = None
+        self.stamps = {}
+        self.pipeline_stamps = {}
+        self.loaded_at = None
+        self.runs = 0
+        self.lock = threading.RLock()
+        self.pipeline_locks = {}
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+
+    @staticmethod
+    def stamp(path:str) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load(self):
+        if self.curie is not None:
+            # Connections still in use by a running request are closed when they are released
+            for connection in self.curie.project.connections.values():
+                connection.pool_size_ = 0
+                connection.close_pool()
+        self.curie = Curie(defer_imports=True)
+        for connection in self.curie.project.connections.values():
+            connection.pool_size_ = max(connection.pool_size_, self.pool_size)
+        self.stamps = dict((path, self.stamp(path)) for path in self.curie.project.sources)
+        self.pipeline_stamps = dict((name, self.stamp(ensure_rooting(pipeline.path))) for name, pipeline in self.curie.project.pipelines.items())
+        self.loaded_at = time.time()
+        print(f'Loaded project {self.curie.path} with {len(self.curie.project.pipelines)} pipelines')
+
+    def refresh(self):
+        """
+        Reloads whatever changed on disk since it was loaded
+        """
+        with self.lock:
+            if self.curie is None or any(self.stamp(path) != stamp for path, stamp in self.stamps.items()):
+                return self.load()
+            for name, pipeline in self.curie.project.pipelines.items():
+                current = self.stamp(ensure_rooting(pipeline.path))
+                if self.pipeline_stamps.get(name) != current:
+                    with self.pipeline_lock(name):
+                        pipeline.load()
+                    self.pipeline_stamps[name] = current
+                    print(f'Reloaded pipeline {name}')
+
+    def pipeline_lock(self, name:str) -> threading.Lock:
+        with self.lock:
+            return self.pipeline_locks.setdefault(name, threading.Lock())
+
+    def run(self, request:Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Runs an etl request the way `curie etl` would, returning its output and status
+        """
+        from .__main__ import ETL_OPTIONS, run_etl
+        args = argparse.Namespace(**dict((key, request.get(key)) for key in ETL_OPTIONS))
+        args.start = args.start if args.start else '.'
+        args.workers = args.workers if args.workers else 1
+        self.refresh()
+        started = time.time()
+        buffer = io.StringIO()
+        status = 'ok'
+        with sys.stdout.capture(buffer):
+            try:
+                # Runs of one pipeline share its DAG, so they take turns; other pipelines run concurrently
+                names = args.pipeline if isinstance(args.pipeline, list) else [args.pipeline]
+                names = list(self.curie.project.pipelines) if 'all' in names else names
+                with contextlib.ExitStack() as locks:
+                    for name in sorted(set(names)):
+                        locks.enter_context(self.pipeline_lock(name))
+                    for name in names:
+                        if name in self.curie.project.pipelines:
+                            self.curie.project.pipelines[name].reset()
+                    run_etl(self.curie.fork(), args)
+            except SystemExit as e:
+                status = 'ok' if not e.code else 'error'
+            except Exception:
+                status = 'error'
+                buffer.write(traceback.format_exc())
+        self.runs += 1
+        return {'status': status, 'output': buffer.getvalue(), 'seconds': round(time.time() - started, 3)}
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'status': 'ok',
+            'project': self.curie.path if self.curie else None,
+            'pipelines': list(self.curie.project.pipelines.keys()) if self.curie else [],
+            'loaded_at': self.loaded_at,
+            'runs': self.runs,
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    daemon = None
+    token = None
+
+    def authorized(self) -> bool:
+        """
+        Checks the request's bearer token when the daemon has one, replying 401 when it does not match
+        """
+        if not self.token:
+            return True
+        presented = self.headers.get('Authorization', '')
+        if hmac.compare_digest(presented.encode(), f'Bearer {self.token}'.encode()):
+            return True
+        self.reply(401, {'status': 'error', 'output': 'Missing or invalid token'})
+        return False
+
+    def reply(self, code:int, body:Dict[str, Any]):
+        payload = json.dumps(body, default=str).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if not self.authorized():
+            return None
+        if self.path.rstrip('/') in ['', '/status']:
+            return self.reply(200, self.daemon.status())
+        self.reply(404, {'status': 'error', 'output': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return None
+        if self.path.rstrip('/') != '/run':
+            return self.reply(404, {'status': 'error', 'output': f'Unknown path {self.path}'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        except json.JSONDecodeError as e:
+            return self.reply(400, {'status': 'error', 'output': f'Invalid request: {e}'})
+        result = self.daemon.run(request)
+        self.reply(200 if result['status'] == 'ok' else 500, result)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'local'
+
+    def log_message(self, format, *args):
+        logging.info('%s - %s', self.address_string(), format % args)
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+@contextlib.contextmanager
+def umask(mask:int):
+    previous = os.umask(mask)
+    try:
+        yield
+    finally:
+        os.umask(previous)
+
+def is_loopback(host:str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def serve(host:str = '127.0.0.1', port:int = 8765, socket_path:str = None, pool_size:int = 4, allow_remote:bool = False, token:str = None):
+    """
+    Runs the daemon until interrupted
+
+    A run executes the project's SQL with its credentials, so the daemon only listens on
+    loopback addresses or a Unix socket readable by its owner. Any other address needs
+    allow_remote and a token, which every request must then send as a bearer token.
+
+    Args:
+        host (str, optional): Address to listen on. Defaults to 127.0.0.1.
+        port (int, optional): Port to listen on. Defaults to 8765.
+        socket_path (str, optional): Listen on a Unix socket instead of a port. Defaults to None.
+        pool_size (int, optional): Idle connections kept open per connection profile. Defaults to 4.
+        allow_remote (bool, optional): Allow listening on a non-loopback address. Defaults to False.
+        token (str, optional): Token required from clients. Defaults to the CURIE_SERVE_TOKEN environment variable.
+    """
+    token = token if token else os.environ.get(TOKEN_ENV)
+    if not socket_path and not is_loopback(host):
+        if not allow_remote:
+            raise SystemExit(f'Refusing to listen on {host}, which is not a loopback address. Pass --allow-remote to do so.')
+        if not token:
+            raise SystemExit(f'Listening on {host} requires a token, set {TOKEN_ENV}.')
+    daemon = Daemon(pool_size=pool_size)
+    daemon.load()
+    handler = type('CurieHandler', (Handler,), {'daemon': daemon, 'token': token})
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        # Other local users cannot connect
+        with umask(0o177):
+            server = UnixHTTPServer(socket_path, handler)
+        print(f'Serving on unix://{os.path.abspath(socket_path)}')
+    else:
+        server = ThreadingHTTPServer((host, port), handler)
+        print(f'Serving on http://{host}:{port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for connection in daemon.curie.project.connections.values():
+            connection.close_pool()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path:str, timeout:float = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+def forward(server:str, request:Dict[str, Any], token:str = None) -> int:
+    """
+    Sends an etl request to a running daemon and prints its output
+
+    Args:
+        server (str): http://host:port or unix:///path/to/socket.
+        request (Dict[str, Any]): The etl arguments.
+        token (str, optional): Token the daemon requires. Defaults to the CURIE_SERVE_TOKEN environment variable.
+
+    Returns:
+        int: Exit code, 0 when the run succeeded
+    """
+    url = urlparse(server)
+    if url.scheme == 'unix':
+        conn = UnixHTTPConnection(url.path)
+    else:
+        conn = http.client.HTTPConnection(url.hostname, url.port or 8765)
+    token = token if token else os.environ.get(TOKEN_ENV)
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    try:
+        conn.request('POST', '/run', body=json.dumps(request), headers=headers)
+        result = json.loads(conn.getresponse().read())
+    except (ConnectionError, FileNotFoundError) as e:
+        logging.error(f'Could not reach curie daemon at {server}: {e}')
+        return 1
+    finally:
+        conn.close()
+    print(result.get('output', ''), end='')
+    logging.info(f'Daemon run finished in {result.get("seconds")}s')
+    return 0 if result.get('status') == 'ok' else 1
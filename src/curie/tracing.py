@@ -0,0 +1,164 @@
+from typing import Any, Dict, List
+import contextvars
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+
+from .utils.state import state_path
+
+# Tags describing what the current code is running on behalf of, e.g. run_id, pipeline, mode, node, variant
+current_tags = contextvars.ContextVar('curie_tags', default={})
+current_trace = contextvars.ContextVar('curie_trace', default=None)
+current_span = contextvars.ContextVar('curie_span', default=None)
+
+# OTLP span kinds and status codes
+INTERNAL, CLIENT = 1, 3
+STATUS_OK, STATUS_ERROR = 1, 2
+
+@contextmanager
+def tags(**values):
+    """
+    Adds tags for the duration of the block, they follow the code into tagged threads
+    """
+    token = current_tags.set({**current_tags.get(), **dict((k, v) for k, v in values.items() if v is not None)})
+    try:
+        yield
+    finally:
+        current_tags.reset(token)
+
+def tag_query(query:str) -> str:
+    """
+    Prefixes a statement with a comment naming the run, pipeline, mode, node and variant it belongs to,
+    so warehouse query logs (STL_QUERY, performance_schema) can be traced back to the DAG
+    """
+    values = current_tags.get()
+    if not values:
+        return query
+    comment = json.dumps(values, separators=(',', ':'), default=str).replace('*/', '* /')
+    return f'/* curie {comment} */ {query}'
+
+def wrap(fn):
+    """
+    Binds a callable to the current tags and span, for work handed to a thread pool.
+    Each call runs in its own copy, so the wrapped callable may run on several threads at once.
+    """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
+
+class Trace:
+    """
+    Collects the spans of one run and exports them as OTLP JSON
+
+    Each export appends one ExportTraceServiceRequest per line to .curie/traces/<date>.jsonl,
+    the format read by the OpenTelemetry collector's otlpjsonfile receiver.
+
+    Args:
+        run_id (str): Identifies the run, also used as the trace id.
+        attributes (Dict[str, Any], optional): Resource attributes, e.g. pipeline and mode. Defaults to None.
+    """
+    def __init__(self, run_id:str, attributes:Dict[str, Any] = None):
+        self.run_id = run_id
+        self.trace_id = run_id.replace('-', '')[:32].rjust(32, '0')
+        self.attributes = attributes if attributes else {}
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span:Dict[str, Any]):
+        with self.lock:
+            self.spans.append(span)
+
+    def export(self, path:str = None) -> str:
+        """
+        Appends the spans collected since the last export, returning the file written
+        """
+        with self.lock:
+            spans, self.spans = self.spans, []
+        if not spans:
+            return None
+        path = path if path else state_path('traces', time.strftime('%Y-%m-%d') + '.jsonl')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        request = {'resourceSpans': [{
+            'resource': {'attributes': attributes({'service.name': 'curie', **self.attributes})},
+            'scopeSpans': [{'scope': {'name': 'curie'}, 'spans': spans}],
+        }]}
+        with open(path, 'a') as f:
+            f.write(json.dumps(request, default=str) + '\n')
+        return path
+
+def attributes(values:Dict[str, Any]) -> List[Dict[str, Any]]:
+    converted = []
+    for key, value in values.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            converted.append({'key': key, 'value': {'boolValue': value}})
+        elif isinstance(value, int):
+            converted.append({'key': key, 'value': {'intValue': str(value)}})
+        elif isinstance(value, float):
+            converted.append({'key': key, 'value': {'doubleValue': value}})
+        else:
+            converted.append({'key': key, 'value': {'stringValue': str(value)}})
+    return converted
+
+@contextmanager
+def trace(run_id:str, **resource):
+    """
+    Starts collecting spans for a run and tags its statements with the run id, exporting when the block ends
+    """
+    current = Trace(run_id, resource)
+    trace_token = current_trace.set(current)
+    try:
+        with tags(run_id=run_id, **resource):
+            yield current
+    finally:
+        current_trace.reset(trace_token)
+        current.export()
+
+@contextmanager
+def span(name:str, kind:int = INTERNAL, start_ns:int = None, **values):
+    """
+    Records a span around the block, nested under the current span. Does nothing outside a trace.
+
+    Args:
+        name (str): Span name, e.g. compile, execute, fetch, write or query.
+        kind (int, optional): INTERNAL, or CLIENT for statements sent to the database. Defaults to INTERNAL.
+        start_ns (int, optional): Start time when the work began before the block. Defaults to now.
+    """
+    current = current_trace.get()
+    if current is None:
+        yield None
+        return
+    record = {
+        'traceId': current.trace_id,
+        'spanId': secrets.token_hex(8),
+        'name': name,
+        'kind': kind,
+        'startTimeUnixNano': str(start_ns if start_ns else time.time_ns()),
+        'attributes': attributes({**current_tags.get(), **values}),
+    }
+    parent = current_span.get()
+    if parent is not None:
+        record['parentSpanId'] = parent
+    token = current_span.set(record['spanId'])
+    try:
+        yield record
+        record['status'] = {'code': STATUS_OK}
+    except BaseException as e:
+        record['status'] = {'code': STATUS_ERROR, 'message': str(e)[:1000]}
+        raise
+    finally:
+        current_span.reset(token)
+        record['endTimeUnixNano'] = str(time.time_ns())
+        current.add(record)
+
+def record_span(name:str, start_ns:int, end_ns:int, **values):
+    """
+    Records a span for work timed elsewhere, e.g. in a worker process
+    """
+    with span(name, start_ns=start_ns, **values) as record:
+        pass
+    if record is not None:
+        record['endTimeUnixNano'] = str(end_ns)
@@ -0,0 +1,189 @@
+from typing import Any, Dict, List
+import csv
+import glob
+import importlib
+import importlib.util
+import os
+import sys
+
+# Filetypes written by SaveMode, in the order outputs are looked up
+FILETYPES = ['parquet', 'csv', 'json']
+
+def _arrow():
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise ImportError('Python transform nodes require pyarrow. Install it with `pip install pyarrow`.')
+
+def output_files(path:str) -> List[str]:
+    """
+    Returns the files holding a node's output, written either as <path>.<filetype> or as a directory of parts
+
+    Args:
+        path (str): The node's output path without a file extension.
+    """
+    for filetype in FILETYPES:
+        if os.path.isfile(f'{path}.{filetype}'):
+            return [f'{path}.{filetype}']
+    if os.path.isdir(path):
+        for filetype in FILETYPES:
+            files = sorted(glob.glob(os.path.join(path, '**', f'*.{filetype}'), recursive=True))
+            if files:
+                return files
+    return []
+
+def datasets(path:str) -> Dict[str, str]:
+    """
+    Returns the datasets a save node wrote at path by label, one per variant when it has variants
+
+    Args:
+        path (str): The node's output path without a file extension.
+    """
+    if any(os.path.isfile(f'{path}.{filetype}') for filetype in FILETYPES):
+        return {os.path.basename(path): path}
+    if not os.path.isdir(path):
+        return {}
+    entries = sorted(os.listdir(path))
+    if any(e.startswith('part') and e.rsplit('.', 1)[-1] in FILETYPES for e in entries):
+        return {os.path.basename(path): path}
+    found = {}
+    for entry in entries:
+        label = entry.rsplit('.', 1)[0] if os.path.isfile(os.path.join(path, entry)) else entry
+        if label.startswith('_curie') or label in found:
+            continue
+        if output_files(os.path.join(path, label)):
+            found[label] = os.path.join(path, label)
+    return found
+
+def read_output(path:str, columns:List[str] = None, text:bool = False) -> Any:
+    """
+    Reads a node's output as one Arrow table, parquet files are memory mapped
+
+    Args:
+        path (str): The node's output path without a file extension.
+        columns (List[str], optional): Only these columns, matched without case, parquet and csv files skip reading the others. Defaults to every column.
+        text (bool, optional): Read csv columns as text, empty cells as nulls, and json values as written, rather than inferring their types. Defaults to False.
+
+    Returns:
+        pyarrow.Table: The output, with every part concatenated
+    """
+    pa = _arrow()
+    files = output_files(path)
+    if not files:
+        raise FileNotFoundError(f'No output found at {path}. Run its node first.')
+    columns = None if columns is None else set(c.lower() for c in columns)
+    tables = []
+    for file in files:
+        if file.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            wanted = None if columns is None else [c for c in pq.read_schema(file).names if c.lower() in columns]
+            tables.append(pq.read_table(file, columns=wanted, memory_map=True))
+        elif file.endswith('.csv'):
+            import pyarrow.csv as pcsv
+            with open(file, newline='') as f:
+                header = next(csv.reader(f), [])
+            wanted = header if columns is None else [c for c in header if c.lower() in columns]
+            tables.append(pcsv.read_csv(file, convert_options=pcsv.ConvertOptions(
+                include_columns=wanted,
+                column_types=dict((c, pa.string()) for c in wanted) if text else None,
+                strings_can_be_null=text)))
+        else:
+            import pandas as pd
+            frame = pd.read_json(file, orient='records', dtype=False, convert_dates=False) if text else pd.read_json(file, orient='records')
+            tables.append(pa.Table.from_pandas(frame, preserve_index=False))
+    if columns is not None:
+        tables = [t.select([c for c in t.column_names if c.lower() in columns]) for t in tables]
+    return tables[0] if len(tables) == 1 else pa.concat_tables(tables)
+
+def spool(table:Any, path:str) -> str:
+    """
+    Writes a table as an Arrow IPC file that worker processes can memory map without copying
+    """
+    pa = _arrow()
+    if not isinstance(table, pa.Table):
+        table = pa.Table.from_pandas(table, preserve_index=False)
+    with pa.OSFile(path, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+def open_spool(path:str) -> Any:
+    """
+    Memory maps a spooled Arrow IPC file, the returned table references the mapped pages
+    """
+    pa = _arrow()
+    return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+
+def callable_path(target:str, root:str) -> str:
+    """
+    Returns the source file of a 'module:function' or 'path/to/file.py:function' target, or None
+    """
+    module = target.rsplit(':', 1)[0]
+    if module.endswith('.py'):
+        return os.path.join(root, module)
+    candidate = os.path.join(root, *module.split('.')) + '.py'
+    return candidate if os.path.isfile(candidate) else None
+
+def load_callable(target:str, root:str) -> Any:
+    """
+    Imports the function named by a target, resolving modules and files against the project root
+
+    Args:
+        target (str): 'package.module:function' or 'path/to/file.py:function'.
+        root (str): The project root.
+    """
+    if ':' not in target:
+        raise ValueError(f'Callable {target} must look like module:function or path/to/file.py:function.')
+    module, function = target.rsplit(':', 1)
+    if module.endswith('.py'):
+        path = os.path.join(root, module)
+        spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(path))[0], path)
+        loaded = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(loaded)
+    else:
+        if root not in sys.path:
+            sys.path.insert(0, root)
+        loaded = importlib.import_module(module)
+    return getattr(loaded, function)
+
+def run_transform(target:str, root:str, inputs:Dict[str, str], arguments:Dict[str, Any], path:str, filetype:str, input_format:str = 'arrow', batch_on:str = None, offset:int = 0, length:int = None) -> Dict[str, Any]:
+    """
+    Runs a transform callable on memory-mapped inputs and writes its result.
+    Kept at module level so it can be shipped to a process pool.
+
+    Args:
+        target (str): The callable to run.
+        root (str): The project root, workers do not inherit it.
+        inputs (Dict[str, str]): Upstream node name to spooled Arrow file.
+        arguments (Dict[str, Any]): Extra keyword arguments for the callable.
+        path (str): File to write the result to.
+        filetype (str): Filetype to write.
+        input_format (str, optional): 'arrow' or 'pandas'. Defaults to 'arrow'.
+        batch_on (str, optional): Input sliced to [offset, offset + length) for this call. Defaults to None.
+        offset (int, optional): First row of the batch_on slice. Defaults to 0.
+        length (int, optional): Rows in the batch_on slice. Defaults to the rest of the input.
+
+    Returns:
+        Dict[str, Any]: The path written and its row count, or None when the callable returned nothing
+    """
+    pa = _arrow()
+    from ..modes import write_output
+    tables = {}
+    for name, spooled in inputs.items():
+        table = open_spool(spooled)
+        if name == batch_on:
+            table = table.slice(offset, length)
+        tables[name] = table.to_pandas() if input_format == 'pandas' else table
+    result = load_callable(target, root)(**tables, **arguments)
+    if result is None:
+        return None
+    if isinstance(result, pa.RecordBatch):
+        result = pa.Table.from_batches([result])
+    if isinstance(result, pa.Table):
+        if filetype == 'parquet':
+            import pyarrow.parquet as pq
+            pq.write_table(result, path, compression='snappy')
+            return {'path': path, 'rows': result.num_rows}
+        result = result.to_pandas()
+    return {'path': write_output(filetype, result, path), 'rows': len(result)}
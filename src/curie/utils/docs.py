@@ -1,19 +1,24 @@
+import hashlib
 import importlib.resources as pkg_resources
 import inspect
+import json
 import logging as log
+import multiprocessing
 import os
 import re
-from functools import wraps
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, wraps
 from glob import glob
 from typing import Any
 
 import jinja2
 import sqlparse
-import yaml
 from dotenv import load_dotenv
 from jinja2 import Template
 
+from ..graph import flowchart
 from .paths import ensure_rooting
+from .state import read_json, read_yaml, state_path, write_json
 
 global loader, jenv
 loader = jinja2.FileSystemLoader(searchpath="./")
@@ -21,12 +26,27 @@ jenv = jinja2.Environment(loader=loader)
 
 
 
-def import_raw(path):
-    s = open(ensure_rooting(path)).read()
-    return sqlparse.format(s, reindent=True, keyword_case='upper')
-
+@lru_cache(maxsize=4096)
 def prettySQL(s):
-    return sqlparse.format(s, reindent=True, keyword_case='upper')
+    # Formatting is the slowest part of a page, each distinct script is formatted once and kept
+    # under .curie/cache/sql, so editing one script only formats that script again
+    path = state_path('cache', 'sql', hashlib.sha1(s.encode()).hexdigest() + '.sql')
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    formatted = sqlparse.format(s, reindent=True, keyword_case='upper')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(formatted)
+    os.replace(tmp, path)
+    return formatted
+
+def import_raw(path):
+    with open(ensure_rooting(path)) as f:
+        return prettySQL(f.read())
 
 def title(s):
     return s.title()
@@ -39,10 +59,70 @@ jenv.globals.update(
     import_raw=import_raw,
     title=title,
     prettySQL=prettySQL,
+    flowchart=flowchart,
 )
 
+# Pipelines with more nodes than this get their fan in and fan out collapsed in the docs flowcharts
+COLLAPSE = 50
+# Fingerprint of every rendered pipeline page, pages whose fingerprint is unchanged are not rendered again
+MANIFEST = ('cache', 'docs.json')
+
+@lru_cache(maxsize=None)
+def template_source(name):
+    return pkg_resources.files('curie.static.jinja').joinpath(name).read_text()
+
+@lru_cache(maxsize=None)
+def template(name):
+    """
+    Compiles one of Curie's page templates, once per process
+    """
+    return jenv.from_string(template_source(name))
+
+def render(name, endpoint, context):
+    """
+    Renders a page template to a file under the project root
+    """
+    endpoint = ensure_rooting(endpoint)
+    os.makedirs(os.path.dirname(endpoint), exist_ok=True)
+    with open(endpoint, 'w') as f:
+        f.write(template(name).render(**context))
+    return endpoint
+
+def fingerprint(blueprint_file, pipe, blueprint, collapse):
+    """
+    Hashes everything a pipeline's page is rendered from: the blueprint, its entry in the project,
+    the scripts its nodes read and the template itself
+    """
+    digest = hashlib.sha256()
+    digest.update(template_source('pipeline.md.j2').encode())
+    digest.update(json.dumps([pipe, collapse], sort_keys=True, default=str).encode())
+    with open(blueprint_file, 'rb') as f:
+        digest.update(f.read())
+    etl = blueprint.get('etl') if isinstance(blueprint, dict) else None
+    for node in (etl or {}).values():
+        for definition in (node.values() if isinstance(node, dict) else []):
+            script = definition.get('script') if isinstance(definition, dict) else None
+            if script:
+                digest.update(script.encode())
+                path = ensure_rooting(script)
+                if os.path.exists(path):
+                    with open(path, 'rb') as f:
+                        digest.update(f.read())
+    return digest.hexdigest()
+
 class Documentation:
-    def __init__(self, config=None):
+    """
+    Renders the project's documentation pages
+
+    Pipeline pages are only rendered again when their fingerprint changed since the last
+    generation, and the pages that did change are rendered in parallel.
+
+    Args:
+        config (str, optional): Path to the project file. Defaults to the one in the working directory.
+        full (bool, optional): Render every page, ignoring the fingerprints. Defaults to False.
+        workers (int, optional): Processes rendering pages. Defaults to the number of CPUs.
+    """
+    def __init__(self, config=None, full=False, workers=None):
         # Glob project.yaml / project.yml
         if config is None:
             config = glob('./project.yaml') + glob('./project.yml')
@@ -53,7 +133,7 @@ class Documentation:
             else:
                 config = config[0]
         self.config = ensure_rooting(config)
-        self.project = yaml.safe_load(open(self.config).read())['Project']
+        self.project = read_yaml(self.config)['Project']
 
         self.site_config = self.project['Documentation']
         self.site_config['site']['nav'] = {'pipelines': []}
@@ -62,23 +142,52 @@ class Documentation:
 
         pipes = list( self.render_pipelines(self.project)['Pipelines'] )
 
+        manifest_path = state_path(*MANIFEST)
+        manifest = {} if full else read_json(manifest_path, {})
+        self.rendered, self.skipped = [], []
+        pages = []
         for pipe in pipes:
             blueprint_file = ensure_rooting(pipe['pipeline'])
             if not os.path.exists(blueprint_file):
                 raise FileNotFoundError(f"Blueprint file for {pipe} not found at {blueprint_file}.")
-            blueprint = yaml.safe_load(open(blueprint_file).read())
-            self.render_pipe(pipe, blueprint)
-        
+            blueprint = read_yaml(blueprint_file)
+            page = self.render_pipe(pipe, blueprint)
+            page['fingerprint'] = fingerprint(blueprint_file, pipe, blueprint, page['context']['collapse'])
+            if manifest.get(pipe['name']) == page['fingerprint'] and os.path.exists(ensure_rooting(page['endpoint'])):
+                self.skipped.append(pipe['name'])
+            else:
+                pages.append(page)
+        self.render_pages(pages, workers)
+        self.rendered = [page['name'] for page in pages]
+        # Pipelines removed from the project drop out of the manifest
+        manifest = dict((pipe['name'], manifest[pipe['name']]) for pipe in pipes if pipe['name'] in manifest)
+        manifest.update((page['name'], page['fingerprint']) for page in pages)
+        write_json(manifest_path, manifest)
+
         self.render_site_config()
-        print(self.site_config)
-    
-    def document(template, endpoint):
+        print(f'Rendered {len(self.rendered)} pipeline page(s), {len(self.skipped)} unchanged.')
+
+    def render_pages(self, pages, workers=None):
+        """
+        Renders pipeline pages, in worker processes when there is more than one
+        """
+        workers = min(int(workers) if workers else os.cpu_count(), len(pages))
+        if workers <= 1:
+            for page in pages:
+                render('pipeline.md.j2', page['endpoint'], page['context'])
+            return
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            futures = [pool.submit(render, 'pipeline.md.j2', page['endpoint'], page['context']) for page in pages]
+            for future in futures:
+                future.result()
+
+    def document(template_name, endpoint):
         def decorator(func):
             def wrapper(*args, **kwargs):
                 mapped_args = dict(zip(inspect.getfullargspec(func).args, args))
                 mapped_args.update(kwargs)
                 del mapped_args['self']
-                _template = jenv.from_string(pkg_resources.read_text('curie.static.jinja', template))
+                _template = template(template_name)
 
                 _endpoint = ensure_rooting(Template(endpoint).render(**mapped_args))
                 results = func(*args, **kwargs)
@@ -100,10 +209,13 @@ class Documentation:
     def render_pipelines(self, pathways):
         return pathways
     
-    @document('pipeline.md.j2', './docs/pipes/{{pipe.name}}.md')
     def render_pipe(self, pipe, config):
         self.site_config['site']['nav']['pipelines'].append({'name': pipe['name'], 'link': f'pipes/{pipe["name"]}.md'})
-        return {'def':pipe,'config':config}
+        return {
+            'name': pipe['name'],
+            'endpoint': f'./docs/pipes/{pipe["name"]}.md',
+            'context': {'def':pipe,'config':config,'collapse':self.site_config.get('collapse', COLLAPSE)},
+        }
     
     @document('docs-settings.yaml.j2', 'docs-settings.yaml')
     def render_site_config(self):
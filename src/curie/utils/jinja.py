@@ -1,5 +1,7 @@
 import jinja2
 import datetime
+import threading
+from collections import OrderedDict
 
 # A class to replace undefined variables with the original variable name as jinja ( {{undef_var}} -> {{undef_var}} )
 class CurieUndefined(jinja2.Undefined):
@@ -14,10 +16,49 @@ class CurieUndefined(jinja2.Undefined):
         return self._undefined_name
 
 class Environment(jinja2.Environment):
+    # Compiled templates shared by every default-configured environment, keyed by source
+    template_cache = OrderedDict()
+    template_cache_size = 512
+    template_lock = threading.Lock()
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.funcs = {
             'current_date': lambda format: datetime.datetime.now().strftime(format),
         }
         self.globals.update(self.funcs)
-        self.undefined = CurieUndefined
\ No newline at end of file
+        self.undefined = CurieUndefined
+        self.shares_templates = len(args) == 0 and len(kwargs) == 0
+
+    def from_string(self, source, globals=None, template_class=None):
+        """
+        Compiles a template once per source, so variants and repeated runs skip parsing
+        """
+        if not self.shares_templates or globals is not None or template_class is not None or not isinstance(source, str):
+            return super().from_string(source, globals, template_class)
+        cache = Environment.template_cache
+        with Environment.template_lock:
+            if source in cache:
+                cache.move_to_end(source)
+                return cache[source]
+        template = super().from_string(source)
+        with Environment.template_lock:
+            cache[source] = template
+            if len(cache) > Environment.template_cache_size:
+                cache.popitem(last=False)
+        return template
+
+__shared__ = None
+__shared_lock__ = threading.Lock()
+
+def shared_environment() -> Environment:
+    """
+    Returns the project-wide template environment. Every mode renders through it rather than
+    owning one, so memory grows with the definitions and not with an environment per mode.
+    """
+    global __shared__
+    if __shared__ is None:
+        with __shared_lock__:
+            if __shared__ is None:
+                __shared__ = Environment()
+    return __shared__
@@ -1,20 +1,74 @@
+import functools
 import os
+import re
 global __project_root__
 
-def find_root(landmark: str = 'project.yaml') -> str:
+# Directories created since the last compile started
+__made_dirs__ = set()
+
+# Project files, in the order they are looked for
+LANDMARKS = ['project.yaml', 'project.yml']
+# Never searched below the working directory for a project: downloads, compiled scripts and tooling.
+# CURIE_IGNORE adds more names, separated like PATH.
+IGNORED_DIRS = ['data', 'compiled', 'site', 'node_modules', 'venv', '__pycache__']
+# How far below the working directory a project is looked for when none is found above it
+SEARCH_DEPTH = 3
+
+def project_file(directory:str, landmarks:list = None) -> str:
+    for landmark in landmarks if landmarks else LANDMARKS:
+        if os.path.isfile(os.path.join(directory, landmark)):
+            return os.path.join(directory, landmark)
+    return None
+
+def find_project(landmarks:list = None, search_below:bool = True) -> str:
     """
-    Find the root directory of a project.
+    Finds the project file: the one CURIE_PROJECT names (the file or its directory), else the
+    nearest one in the working directory or its parents, else the only one a few levels below
+    it. The search below skips hidden and ignored directories, so downloaded data never
+    slows it down.
+
+    Args:
+        landmarks (list, optional): Project file names. Defaults to project.yaml and project.yml.
+        search_below (bool, optional): Look below the working directory when none is found above. Defaults to True.
+
+    Returns:
+        str: Absolute path to the project file
     """
-    root = os.getcwd()
+    configured = os.environ.get('CURIE_PROJECT')
+    if configured:
+        found = os.path.abspath(configured) if os.path.isfile(configured) else project_file(os.path.abspath(configured), landmarks)
+        if found is None:
+            raise FileNotFoundError(f'CURIE_PROJECT is set to {configured}, which is neither a project file nor a directory holding one.')
+        return found
+    directory = os.getcwd()
     while True:
-        if os.path.exists(os.path.join(root, landmark)):
-            return root
-        else:
-            root = os.path.dirname(root)
-            # Test if we have reached the root of the drive
-            if root == os.path.dirname(root):
-                raise FileNotFoundError(f'Could not identify the project root. Please ensure that {landmark} exists in the project root.')
-    return None
+        found = project_file(directory, landmarks)
+        if found is not None:
+            return found
+        if directory == os.path.dirname(directory):
+            break
+        directory = os.path.dirname(directory)
+    if not search_below:
+        raise FileNotFoundError('Could not find project.yaml in the current directory or any of its parents.')
+    ignored = set(IGNORED_DIRS + [d for d in os.environ.get('CURIE_IGNORE', '').split(os.pathsep) if d])
+    start = os.getcwd()
+    found = []
+    for directory, dirnames, _ in os.walk(start):
+        depth = os.path.relpath(directory, start).count(os.sep) + (0 if directory == start else 1)
+        dirnames[:] = [] if depth >= SEARCH_DEPTH else sorted(d for d in dirnames if not d.startswith('.') and d not in ignored)
+        if directory != start and project_file(directory, landmarks):
+            found.append(project_file(directory, landmarks))
+    if len(found) == 0:
+        raise FileNotFoundError('Could not find project.yaml in the current directory, its parents or its subdirectories. Set CURIE_PROJECT to its path.')
+    if len(found) > 1:
+        raise FileNotFoundError(f'Found more than one project below the current directory ({", ".join(os.path.relpath(f) for f in found)}). Set CURIE_PROJECT to the one to use.')
+    return found[0]
+
+def find_root(landmark: str = 'project.yaml') -> str:
+    """
+    Find the root directory of a project, the directory of its project file in the working directory or above it.
+    """
+    return os.path.dirname(find_project([landmark] + [l for l in LANDMARKS if l != landmark], search_below=False))
 
 try:
     __project_root__ = find_root()
@@ -33,10 +87,15 @@ def ensure_rooting(path) -> str:
     """
     Ensure that the path is rooted to the project.
     """
-    if os.path.isabs(path) and path.startswith(__project_root__):
+    return rooted(__project_root__, path)
+
+@functools.lru_cache(maxsize=8192)
+def rooted(root:str, path) -> str:
+    # Resolved once per root and path, compiles and runs resolve the same few paths for every node
+    if os.path.isabs(path) and path.startswith(root):
         return path
     else:
-        return os.path.normpath(os.path.join(__project_root__, path))
+        return os.path.normpath(os.path.join(root, path))
 
 def unroot(path) -> str:
     global __project_root__
@@ -47,3 +106,41 @@ def unroot(path) -> str:
         return str(os.path.relpath(path, __project_root__)).replace('\\', '/')
     else:
         return path
+
+def ensure_dir(path) -> str:
+    """
+    Creates a directory unless this process already did since forget_dirs, so writing many files into one directory costs a single makedirs
+    """
+    if path not in __made_dirs__:
+        os.makedirs(path, exist_ok=True)
+        __made_dirs__.add(path)
+    return path
+
+def forget_dirs():
+    """
+    Forgets the directories ensure_dir created, e.g. before a compile, since they may have been cleaned since
+    """
+    __made_dirs__.clear()
+
+def sample_path(path) -> str:
+    """
+    Returns the sibling directory sample runs use in place of path, e.g. data/Unknown_sample
+    """
+    if not path:
+        return path
+    return path.rstrip('/\\') + '_sample'
+
+def sweep_path(path, label:str) -> str:
+    """
+    Returns the directory one run of a sweep uses in place of path, e.g. data/Unknown/region-us
+    """
+    if not path:
+        return path
+    return os.path.join(path.rstrip('/\\'), label)
+
+def sweep_label(overrides:dict) -> str:
+    """
+    Names a run of a sweep after its overrides, usable as a directory name
+    """
+    label = '_'.join(f'{name}-{value}' for name, value in overrides.items())
+    return re.sub(r'[^\w.-]+', '-', label).strip('-') or 'default'
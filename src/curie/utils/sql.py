@@ -0,0 +1,29 @@
+import re
+from typing import List
+
+import sqlparse
+
+# Curie's own markers are comments, but they must survive splitting
+MARKER = re.compile(r'^\s*/\* curie:')
+
+def split_statements(sql:str) -> List[str]:
+    """
+    Splits a compiled script into statements.
+
+    Unlike splitting on ';' this respects string literals, comments and dollar quoting.
+    Terminators are removed and empty or comment-only statements are dropped.
+
+    Args:
+        sql (str): The compiled script.
+
+    Returns:
+        List[str]: The statements in order
+    """
+    statements = []
+    for statement in sqlparse.split(sql):
+        statement = statement.strip().rstrip(';').strip()
+        if MARKER.match(statement):
+            statements.append(statement)
+        elif sqlparse.format(statement, strip_comments=True).strip().rstrip(';').strip():
+            statements.append(statement)
+    return statements
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import marshal
+import os
+import sys
+import tempfile
+from typing import Any
+
+import yaml
+
+from .paths import ensure_rooting
+
+STATE_DIR = '.curie'
+# The C loader when PyYAML was built against libyaml
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+def state_path(*parts:str) -> str:
+    """
+    Returns a path inside the project's local state directory (<root>/.curie)
+    """
+    return ensure_rooting(os.path.join(STATE_DIR, *parts))
+
+def read_json(path:str, default:Any = None) -> Any:
+    """
+    Reads a JSON state file, returning default if it does not exist or is unreadable
+    """
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+def write_json(path:str, data:Any):
+    """
+    Atomically replaces a JSON state file so an interrupted run never leaves it half written
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def read_yaml(path:str, cache:bool = True) -> Any:
+    """
+    Parses a YAML file, from a cached copy when the file has not changed since it was last parsed
+
+    Parsed documents are cached in .curie/cache/yaml in marshal format, keyed by the file's
+    path, modification time and size, so a warm start skips parsing entirely. Documents
+    marshal cannot hold (e.g. timestamps) are parsed every time.
+
+    Args:
+        path (str): Path to the YAML file.
+        cache (bool, optional): Read and write the cache. Defaults to True.
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = state_path('cache', 'yaml', hashlib.sha1(path.encode()).hexdigest() + f'.py{sys.version_info[0]}{sys.version_info[1]}')
+    if cache:
+        try:
+            with open(cached, 'rb') as f:
+                entry = marshal.load(f)
+            if entry[0] == path and tuple(entry[1]) == key:
+                return entry[2]
+        except (OSError, EOFError, ValueError, TypeError, IndexError):
+            pass
+    with open(path, 'r') as f:
+        data = yaml.load(f, Loader=YAML_LOADER)
+    if cache:
+        try:
+            encoded = marshal.dumps((path, key, data))
+            os.makedirs(os.path.dirname(cached), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cached), prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(encoded)
+            os.replace(tmp, cached)
+        except (OSError, ValueError):
+            # Unmarshallable documents and read-only projects are parsed every time
+            pass
+    return data
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from curie.connect import SQLite
+from curie.utils.paths import set_root
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    """
+    A SQLite profile on a fresh database file in the test's directory
+    """
+    set_root(str(tmp_path))
+    database = SQLite('db.sqlite', pool_size=2, max_concurrency=1)
+    yield database
+    database.close_pool()
@@ -0,0 +1,62 @@
+import threading
+import time
+
+from curie.admission import Admission, waiting
+from curie.tracing import Trace, current_trace, tags
+
+
+def queue_spans(run):
+    current = Trace('test')
+    token = current_trace.set(current)
+    try:
+        with waiting() as queued:
+            run()
+    finally:
+        current_trace.reset(token)
+    return [s for s in current.spans if s['name'] == 'queue'], queued[0]
+
+
+def test_immediate_admission_is_not_a_wait():
+    admission = Admission(max_concurrency=1)
+    spans, queued = queue_spans(lambda: admission.enter())
+    assert spans == [] and queued == 0.0
+    assert admission.active == 1
+
+
+def test_blocked_admission_is_recorded():
+    admission = Admission(max_concurrency=1)
+    admission.enter()
+    timer = threading.Timer(0.1, admission.leave)
+    timer.start()
+    spans, queued = queue_spans(lambda: admission.enter())
+    timer.join()
+    assert len(spans) == 1 and queued >= 0.05
+    assert admission.active == 1
+
+
+def test_admission_order_follows_priority():
+    admission = Admission(max_concurrency=1, priorities={'hi': 1})
+    admission.enter()
+    order = []
+
+    def enter(name):
+        with tags(node=name):
+            admission.enter()
+        order.append(name)
+        admission.leave()
+
+    threads = []
+    for name in ['lo0', 'lo1', 'hi']:
+        threads.append(threading.Thread(target=enter, args=(name,)))
+        threads[-1].start()
+        time.sleep(0.05)
+    admission.leave()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert order == ['hi', 'lo0', 'lo1']
+
+
+def test_throttle_within_burst_is_not_a_wait():
+    admission = Admission(queries_per_second=1000, burst=2)
+    spans, queued = queue_spans(lambda: [admission.throttle(), admission.throttle()])
+    assert spans == [] and queued == 0.0
@@ -0,0 +1,54 @@
+import pytest
+
+from curie.artifact import HEADER, Plan, execute, pack
+from curie.dag import DAG
+
+
+@pytest.fixture
+def compiled(sqlite, tmp_path):
+    dag = DAG({
+        'a': {'schema': 'main', 'run': {'query': 'SELECT 1 AS x', 'method': 'replace'}},
+        'b': {'schema': 'main', 'run': {'query': 'SELECT x + 1 AS y FROM main.a', 'method': 'replace', 'depends_on': ['a']}},
+    })
+    dag.compile('run', compile_path=str(tmp_path / 'compiled'), connection=sqlite, download_dir=str(tmp_path / 'data'))
+    return dag
+
+
+def test_pack_round_trip(compiled, tmp_path):
+    path = pack(compiled, 'run', str(tmp_path / 'p.plan'), pipeline='p', profile='local')
+    plan = Plan(path)
+    try:
+        assert plan.index['order'] == ['a', 'b']
+        assert plan.index['nodes']['b']['depends_on'] == ['a']
+        rebuilt = plan.dag()
+    finally:
+        plan.close()
+    for name in ['a', 'b']:
+        assert rebuilt.nodes[name].schema == 'main'
+        assert rebuilt.nodes[name].modes['run'].compiled_sql() == compiled.nodes[name].modes['run'].compiled_sql()
+
+
+def test_corrupt_payload_is_refused(compiled, tmp_path):
+    path = pack(compiled, 'run', str(tmp_path / 'p.plan'), pipeline='p')
+    data = bytearray(open(path, 'rb').read())
+    data[-2] ^= 0xFF
+    open(path, 'wb').write(bytes(data))
+    plan = Plan(path)
+    try:
+        with pytest.raises(Exception, match='corrupt'):
+            plan.dag()
+    finally:
+        plan.close()
+
+
+def test_other_files_are_refused(tmp_path):
+    path = tmp_path / 'not.plan'
+    path.write_bytes(b'\0' * HEADER.size)
+    with pytest.raises(Exception, match='not a Curie plan'):
+        Plan(str(path))
+
+
+def test_execute_plan(compiled, sqlite, tmp_path):
+    path = pack(compiled, 'run', str(tmp_path / 'p.plan'), pipeline='p', profile='local')
+    execute(path, sqlite)
+    assert list(sqlite.execute('SELECT y FROM main.b')['y']) == [2]
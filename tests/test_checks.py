@@ -0,0 +1,96 @@
+import os
+
+import pandas as pd
+
+from curie.checks import aggregate_query, frame_failures, key_query, rules, table_failures
+from curie.utils.datasets import read_output
+
+
+def build(sqlite, rows):
+    sqlite.execute('CREATE TABLE t (a INTEGER, b TEXT, c INTEGER)')
+    for row in rows:
+        sqlite.execute('INSERT INTO t VALUES ({})'.format(', '.join('NULL' if v is None else repr(v) for v in row)))
+
+
+def test_rules_from_fields():
+    found = rules([
+        {'name': 'a', 'primary_key': True, 'type': 'int'},
+        {'name': 'b', 'nullable': False, 'type': 'varchar(10)'},
+        {'name': 'c', 'type': 'unknown'},
+    ])
+    assert found == {'not_null': ['a', 'b'], 'key': ['a'], 'types': {'a': 'integer', 'b': 'string'}}
+
+
+def test_single_key_counts_nulls_once(sqlite):
+    build(sqlite, [(1, 'x', 1), (1, 'y', 1), (None, 'z', 1), (None, 'z', 1)])
+    row = sqlite.execute(aggregate_query('t', {'not_null': ['a'], 'key': ['a'], 'types': {}})).iloc[0]
+    assert row['curie_rows'] == 4
+    assert row['curie_nulls_0'] == 2
+    # The two null keys are reported as nulls, not as a duplicate
+    assert row['curie_duplicates'] == 1
+
+
+def test_composite_key_skips_nulls(sqlite):
+    build(sqlite, [(1, 'x', 1), (1, 'x', 2), (1, None, 1), (1, None, 1), (2, 'y', 1)])
+    query = key_query('t', {'not_null': [], 'key': ['a', 'b'], 'types': {}})
+    assert int(sqlite.execute(query).iloc[0, 0]) == 1
+    assert key_query('t', {'not_null': [], 'key': ['a'], 'types': {}}) is None
+
+
+def test_single_and_composite_keys_agree(sqlite):
+    build(sqlite, [(1, 'x', 1), (1, 'x', 1), (None, 'x', 1), (None, 'x', 1)])
+    single = rules([{'name': 'a', 'primary_key': True}])
+    composite = rules([{'name': 'a', 'primary_key': True}, {'name': 'b', 'primary_key': True}])
+    assert table_failures('t', '', 't', single, sqlite) == ['a: 2 null value(s)', 'a: 1 duplicate key row(s)']
+    assert table_failures('t', '', 't', composite, sqlite) == ['a: 2 null value(s)', 'a, b: 1 duplicate key row(s)']
+
+
+def test_frames_match_the_sql_checks():
+    frame = pd.DataFrame({'a': [1, 1, None, None], 'b': ['x', 'x', 'x', 'x']})
+    composite = rules([{'name': 'a', 'primary_key': True}, {'name': 'b', 'primary_key': True}])
+    assert frame_failures(frame, composite) == ['a: 2 null value(s)', 'a, b: 1 duplicate key row(s)']
+
+
+def saved(tmp_path, name, text):
+    path = tmp_path / name
+    path.write_text(text)
+    return str(tmp_path / name.rsplit('.', 1)[0])
+
+
+def text_failures(path, fields):
+    checked = rules(fields)
+    columns = checked['not_null'] + checked['key'] + list(checked['types'])
+    return frame_failures(read_output(path, columns=columns, text=True), checked, text=os.path.exists(path + '.csv'))
+
+
+def test_csv_digits_are_strings(tmp_path):
+    path = saved(tmp_path, 'out.csv', 'id,zip\n1,02134\n2,10001\n')
+    assert text_failures(path, [{'name': 'id', 'type': 'integer'}, {'name': 'zip', 'type': 'string'}]) == []
+
+
+def test_csv_values_must_parse(tmp_path):
+    path = saved(tmp_path, 'out.csv', 'id,amount,day\n1.0,2.5,2024-01-31\n,x,2024-02-30\n')
+    fields = [{'name': 'id', 'type': 'integer', 'nullable': False}, {'name': 'amount', 'type': 'number'}, {'name': 'day', 'type': 'date'}]
+    assert text_failures(path, fields) == [
+        'id: 1 null value(s)',
+        'amount: expected number, found values that do not parse as number',
+        'day: expected date, found values that do not parse as date',
+    ]
+
+
+def test_csv_reads_only_checked_columns(tmp_path):
+    path = saved(tmp_path, 'out.csv', 'id,zip,other\n1,02134,x\n')
+    table = read_output(path, columns=['ID', 'zip'], text=True)
+    assert table.column_names == ['id', 'zip']
+    assert table.column('zip').to_pylist() == ['02134']
+
+
+def test_json_keeps_written_types(tmp_path):
+    path = saved(tmp_path, 'out.json', '[{"id": 1.0, "zip": "02134"}, {"id": null, "zip": "10001"}]')
+    assert text_failures(path, [{'name': 'id', 'type': 'integer'}, {'name': 'zip', 'type': 'string'}]) == []
+
+
+def test_whole_floats_are_integers(tmp_path):
+    frame = pd.DataFrame({'id': [1.0, None, 3.0], 'ratio': [1.0, 1.5, None]})
+    fields = [{'name': 'id', 'type': 'integer'}, {'name': 'ratio', 'type': 'integer'}]
+    assert frame_failures(frame, rules(fields)) == ['ratio: expected integer, found double']
@@ -0,0 +1,50 @@
+import pytest
+
+
+def test_execute_returns_rows(sqlite):
+    sqlite.execute('CREATE TABLE t (a INTEGER)')
+    sqlite.execute('INSERT INTO t VALUES (1), (2), (3)')
+    df = sqlite.execute('SELECT a FROM t ORDER BY a')
+    assert list(df['a']) == [1, 2, 3]
+    assert sqlite.admission_.active == 0
+
+
+def test_execute_batches_splits_rows(sqlite):
+    sqlite.execute('CREATE TABLE t (a INTEGER)')
+    sqlite.execute('INSERT INTO t VALUES (1), (2), (3)')
+    batches = list(sqlite.execute_batches('SELECT a FROM t ORDER BY a', batch_size=2))
+    assert [len(b) for b in batches] == [2, 1]
+    assert sqlite.admission_.active == 0
+
+
+def test_execute_batches_releases_on_query_error(sqlite):
+    with pytest.raises(Exception):
+        list(sqlite.execute_batches('SELECT * FROM missing'))
+    assert sqlite.admission_.active == 0
+    # The failed connection is closed, not returned to the pool
+    assert sqlite.idle_ == []
+
+
+def test_execute_batches_releases_when_cursor_fails(sqlite, monkeypatch):
+    conn = sqlite.connect()
+
+    def broken():
+        raise RuntimeError('no cursor')
+
+    monkeypatch.setattr(conn, 'cursor', broken)
+    monkeypatch.setattr(sqlite, 'checkout', lambda: conn)
+    with pytest.raises(RuntimeError):
+        list(sqlite.execute_batches('SELECT 1'))
+    assert sqlite.admission_.active == 0
+    # The slot is free again, a second query is admitted rather than blocking
+    monkeypatch.undo()
+    assert list(sqlite.execute('SELECT 1 AS a')['a']) == [1]
+
+
+def test_execute_batches_releases_when_abandoned(sqlite):
+    sqlite.execute('CREATE TABLE t (a INTEGER)')
+    sqlite.execute('INSERT INTO t VALUES (1), (2), (3)')
+    batches = sqlite.execute_batches('SELECT a FROM t', batch_size=1)
+    next(batches)
+    batches.close()
+    assert sqlite.admission_.active == 0
@@ -0,0 +1,91 @@
+import argparse
+import threading
+import time
+
+import pytest
+
+from curie.__main__ import run_concurrently, sweep_runs
+from curie.scheduler import Scheduler, shared_budget
+
+
+def sweep_args(matrix=None, sweep=None):
+    return argparse.Namespace(override_matrix=matrix, sweep=sweep)
+
+
+def test_sweeps_expand_to_every_combination():
+    runs = sweep_runs(sweep_args(sweep=['region=us,eu', 'year=2023,2024']))
+    assert runs == {
+        'region-us_year-2023': {'region': 'us', 'year': '2023'},
+        'region-us_year-2024': {'region': 'us', 'year': '2024'},
+        'region-eu_year-2023': {'region': 'eu', 'year': '2023'},
+        'region-eu_year-2024': {'region': 'eu', 'year': '2024'},
+    }
+
+
+def test_matrix_of_lists_combines_with_sweeps(tmp_path):
+    matrix = tmp_path / 'matrix.yaml'
+    matrix.write_text('region: [us, eu]\nyear: 2024\n')
+    runs = sweep_runs(sweep_args(str(matrix), ['tier=a,b']))
+    assert len(runs) == 4
+    assert runs['region-eu_year-2024_tier-b'] == {'region': 'eu', 'year': 2024, 'tier': 'b'}
+
+
+def test_matrix_of_runs(tmp_path):
+    matrix = tmp_path / 'matrix.yaml'
+    matrix.write_text('- {region: us west}\n- {region: us/west}\n- {}\n')
+    runs = sweep_runs(sweep_args(str(matrix)))
+    # Labels are directory names, a clash gets a suffix
+    assert list(runs.keys()) == ['region-us-west', 'region-us-west-1', 'default']
+
+
+def test_invalid_sweep_exits():
+    with pytest.raises(SystemExit):
+        sweep_runs(sweep_args(sweep=['region']))
+
+
+def nodes(budget, ran, name):
+    names = dict((f'{name}.{i}', []) for i in range(3))
+    Scheduler(names, dict((n, 1.0) for n in names), workers=2).run(ran.append, budget=budget)
+
+
+def test_nested_runs_share_the_budget_without_deadlock():
+    ran = []
+
+    def run_sweep(name, budget):
+        run_concurrently('run', {f'{name}-x': [], f'{name}-y': []}, lambda label, inner: nodes(inner, ran, label), 4, budget)
+
+    thread = threading.Thread(target=run_concurrently, args=('pipeline', {'p': [], 'q': ['p']}, run_sweep, 1), daemon=True)
+    thread.start()
+    thread.join(timeout=10)
+    assert not thread.is_alive(), 'nested runs deadlocked on the shared budget'
+    assert len(ran) == 12
+
+
+def test_runs_without_concurrency_do_not_overlap():
+    lock = threading.Lock()
+    running, peak, order = [0], [0], []
+
+    def run_one(name, budget):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        order.append(name)
+        with lock:
+            running[0] -= 1
+
+    run_concurrently('run', {'a': [], 'b': [], 'c': []}, run_one, 4, concurrent=False)
+    assert peak[0] == 1 and order == ['a', 'b', 'c']
+
+
+def test_failed_runs_exit_after_the_rest_ran():
+    ran = []
+
+    def run_one(name, budget):
+        ran.append(name)
+        if name == 'a':
+            raise ValueError('a failed')
+
+    with pytest.raises(SystemExit):
+        run_concurrently('pipeline', {'a': [], 'b': ['a'], 'c': []}, run_one, 2)
+    assert sorted(ran) == ['a', 'c']
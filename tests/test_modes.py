@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+from curie.modes import SavePipeline, run
+
+
+def test_save_pipeline_writes_in_threads(tmp_path):
+    paths = [str(tmp_path / f'part-{i}.csv') for i in range(5)]
+    with SavePipeline(max_pending=2) as writer:
+        for i, path in enumerate(paths):
+            writer.submit(pd.DataFrame({'a': [i]}), path, 'csv')
+    assert writer.threads is None
+    assert sorted(writer.written) == sorted(paths)
+    assert [pd.read_csv(p)['a'][0] for p in paths] == list(range(5))
+
+
+def test_save_pipeline_raises_write_errors(tmp_path):
+    with pytest.raises(Exception):
+        with SavePipeline() as writer:
+            writer.submit(pd.DataFrame({'a': [1]}), str(tmp_path / 'missing' / 'part.csv'), 'csv')
+    assert writer.threads is None
+
+
+def test_seed_runs_outside_a_transaction(sqlite):
+    node = run('t')
+    assert not node.in_transaction()
+    # VACUUM fails inside a transaction
+    node.run_statements('CREATE TABLE t (a INTEGER);\nVACUUM;', sqlite)
+    assert len(sqlite.execute("SELECT name FROM sqlite_master WHERE name = 't'")) == 1
+
+
+def test_seed_opts_in_to_a_transaction(sqlite):
+    node = run('t', transaction=True)
+    assert node.in_transaction()
+    with pytest.raises(Exception):
+        node.run_statements('CREATE TABLE t (a INTEGER);\nSELECT * FROM missing;', sqlite)
+    assert len(sqlite.execute("SELECT name FROM sqlite_master WHERE name = 't'")) == 0
+
+
+def test_other_methods_default_to_a_transaction():
+    assert run('t', method='replace').in_transaction()
+    assert not run('t', method='replace', transaction=False).in_transaction()
+
+
+def build(sqlite, tmp_path, query, **options):
+    node = run('t', query=query, **options)
+    node.compile('t', str(tmp_path / 't.sql'), connection=sqlite, schema='main')
+    node.execute('t', connection=sqlite)
+    return sqlite.execute('SELECT id, v FROM main.t ORDER BY id')
+
+
+@pytest.mark.parametrize('method', ['merge', 'upsert'])
+def test_keyed_methods_replace_matching_rows(sqlite, tmp_path, method):
+    build(sqlite, tmp_path, "SELECT 1 AS id, 'a' AS v UNION ALL SELECT 2, 'a'", method=method, unique_key='id')
+    rows = build(sqlite, tmp_path, "SELECT 1 AS id, 'b' AS v UNION ALL SELECT 3, 'b'", method=method, unique_key='id')
+    assert rows.values.tolist() == [[1, 'b'], [2, 'a'], [3, 'b']]
+
+
+@pytest.mark.parametrize('method', ['merge', 'upsert'])
+def test_keyed_methods_require_a_unique_key(sqlite, tmp_path, method):
+    with pytest.raises(Exception, match='unique_key'):
+        run('t', query='SELECT 1 AS id', method=method).compile('t', str(tmp_path / 't.sql'), connection=sqlite, schema='main')
@@ -0,0 +1,88 @@
+import threading
+import time
+
+import pytest
+
+from curie.scheduler import Scheduler, shared_budget
+
+
+def chain():
+    # a -> b -> c is the long chain, d runs on its own
+    dependencies = {'d': [], 'a': [], 'b': ['a'], 'c': ['b']}
+    costs = {'a': 1.0, 'b': 1.0, 'c': 1.0, 'd': 2.0}
+    return dependencies, costs
+
+
+def test_critical_path_starts_first():
+    dependencies, costs = chain()
+    order = []
+    Scheduler(dependencies, costs, workers=1).run(order.append)
+    # a holds up the longest chain, so it starts ahead of d although d is defined first
+    assert order == ['a', 'd', 'b', 'c']
+
+
+def test_ties_keep_definition_order():
+    order = []
+    Scheduler({'x': [], 'y': [], 'z': []}, {'x': 1.0, 'y': 1.0, 'z': 1.0}).run(order.append)
+    assert order == ['x', 'y', 'z']
+
+
+def test_plan_reports_makespan_and_critical_path():
+    dependencies, costs = chain()
+    plan = Scheduler(dependencies, costs, workers=2).plan()
+    assert plan['makespan'] == 3.0
+    assert plan['critical_path'] == ['a', 'b', 'c']
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_failure_stops_new_nodes(workers):
+    dependencies, costs = chain()
+    ran, finished = [], []
+
+    def execute(node):
+        ran.append(node)
+        if node == 'a':
+            raise ValueError('a failed')
+
+    with pytest.raises(ValueError):
+        Scheduler(dependencies, costs, workers=workers).run(execute, lambda node, seconds, status, error: finished.append((node, status)))
+    assert 'b' not in ran and 'c' not in ran
+    assert ('a', 'failed') in finished
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+def test_keep_going_skips_only_dependents(workers):
+    dependencies, costs = chain()
+    ran = []
+
+    def execute(node):
+        ran.append(node)
+        if node == 'a':
+            raise ValueError('a failed')
+
+    with pytest.raises(ValueError):
+        Scheduler(dependencies, costs, workers=workers).run(execute, keep_going=True)
+    assert sorted(ran) == ['a', 'd']
+
+
+def test_budget_caps_nodes_across_schedulers():
+    slots = shared_budget(2)
+    lock = threading.Lock()
+    running, peak = [0], [0]
+
+    def execute(node):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+
+    nodes = dict((f'n{i}', []) for i in range(6))
+    costs = dict((n, 1.0) for n in nodes)
+    threads = [threading.Thread(target=Scheduler(nodes, costs, workers=4).run, args=(execute,), kwargs={'budget': slots}) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    assert peak[0] == 2
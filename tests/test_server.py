@@ -0,0 +1,72 @@
+import http.client
+import io
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from curie.server import Handler, ThreadOutput, is_loopback, serve
+from curie.tracing import wrap
+
+
+def test_output_of_worker_threads_is_captured():
+    stream = io.StringIO()
+    output = ThreadOutput(stream)
+    buffer = io.StringIO()
+    with output.capture(buffer):
+        output.write('main\n')
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(wrap(lambda i: output.write(f'worker {i}\n')), range(2)))
+    output.write('after\n')
+    assert sorted(buffer.getvalue().splitlines()) == ['main', 'worker 0', 'worker 1']
+    assert stream.getvalue() == 'after\n'
+
+
+def test_loopback_addresses():
+    assert is_loopback('127.0.0.1')
+    assert is_loopback('::1')
+    assert is_loopback('localhost')
+    assert not is_loopback('0.0.0.0')
+    assert not is_loopback('example.com')
+
+
+def test_serve_refuses_remote_addresses(monkeypatch):
+    monkeypatch.delenv('CURIE_SERVE_TOKEN', raising=False)
+    with pytest.raises(SystemExit, match='allow-remote'):
+        serve(host='0.0.0.0')
+    with pytest.raises(SystemExit, match='token'):
+        serve(host='0.0.0.0', allow_remote=True)
+
+
+class Status:
+    def status(self):
+        return {'status': 'ok'}
+
+
+@pytest.fixture
+def daemon():
+    handler = type('TestHandler', (Handler,), {'daemon': Status(), 'token': 'secret'})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def get_status(port, headers):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+    try:
+        conn.request('GET', '/status', headers=headers)
+        response = conn.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        conn.close()
+
+
+def test_requests_need_the_token(daemon):
+    assert get_status(daemon, {})[0] == 401
+    assert get_status(daemon, {'Authorization': 'Bearer wrong'})[0] == 401
+    assert get_status(daemon, {'Authorization': 'Bearer secret'}) == (200, {'status': 'ok'})